@@ -2,14 +2,18 @@
 Agentic RAG 决策控制器
 负责调用LLM进行检索决策，但保持完全可控
 """
+import hashlib
 import json
 import logging
-from typing import List, Dict, Any
+import time
+from typing import List, Dict, Any, Optional
 
 from langchain_core.documents import Document
 from langchain_core.messages import SystemMessage, HumanMessage, AIMessage
 
 from agentic_rag_toolkit import RetrievalDecision, TOOL_DEFINE_PROMPT, TOOL_SELECT_PROMPT, CONTROLLER_SYSTEM_PROMPT
+from history_utils import compact_history
+from token_utils import count_tokens
 from utils import get_langchain_llm
 
 logger = logging.getLogger(__name__)
@@ -17,6 +21,267 @@ logger = logging.getLogger(__name__)
 
 # logger.setLevel(logging.DEBUG)
 
+# system: 静态指令，位于对话最前且跨轮次、跨请求不变，可命中模型服务的前缀缓存
+SYSTEM_PROMPT = f"{CONTROLLER_SYSTEM_PROMPT}\n\n{TOOL_DEFINE_PROMPT}\n\n{TOOL_SELECT_PROMPT}"
+
+
+def _compact_json(obj: Any) -> str:
+    """紧凑 JSON（无缩进与多余空格）"""
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+# ============= 控制器对话 =============
+class ControllerConversation:
+    """
+    单次检索过程中与控制器的持续对话
+    - 消息只追加、不修改：system 在前，随后是对话上下文，之后每轮追加上一轮的决策（assistant）
+      与其执行结果、新增切片（user），前缀保持稳定
+    - 切片只发送一次：按 pk 去重，内容与已发送切片完全相同时只给出引用
+    """
+
+    def __init__(self, question: str, history: Optional[list] = None, known_files: Optional[List[Document]] = None):
+        self.question = question
+        self.history = history or []
+        # 同一会话此前检索过的文件（只含元信息）
+        self.known_files = known_files or []
+        self.messages: list = [SystemMessage(content=SYSTEM_PROMPT)]
+        self.prompt_tokens = count_tokens(SYSTEM_PROMPT)
+        # 已同步的 trace 条数
+        self._synced = 0
+        self._sent_keys = set()
+        # 内容哈希 -> "fileName#chunkIndex"
+        self._sent_contents: Dict[bytes, str] = {}
+        self._known_files = set()
+
+    def advance(self, reference_docs: List[Document], trace: List[Dict], current_round: int, max_rounds: int) -> int:
+        """
+        追加本轮的增量消息，返回本次追加的 token 数
+
+        - 第一轮：对话上下文
+        - 之后：上一轮决策 + 执行结果 + 新增切片
+        """
+        appended: list = []
+        parts = []
+        if len(self.messages) == 1:
+            history = self.history.copy()
+            history.append({"role": "user", "content": self.question})
+            conversation_context = {
+                "current_question": self.question,
+                "history": RetrievalController._format_history(history),
+            }
+            parts.append(f"## 对话上下文\n{_compact_json(conversation_context)}")
+            if self.known_files:
+                files = [
+                    {
+                        "fileName": f.metadata.get("fileName"),
+                        "documentId": f.metadata.get("documentId"),
+                        "maxChunkIndex": f.metadata.get("maxChunkIndex"),
+                    }
+                    for f in self.known_files
+                ]
+                self._known_files.update(f["fileName"] for f in files)
+                parts.append(f"## 此前对话中检索过的文件（可直接用于文件级工具）\n{_compact_json(files)}")
+
+        new_items = trace[self._synced:]
+        self._synced = len(trace)
+        if new_items:
+            # 同一轮的多个工具调用共享一次决策
+            appended.append(AIMessage(content=_compact_json(new_items[0].get("decision", {}))))
+            results = [RetrievalController._format_tool_call(item) for item in new_items]
+            parts.append(f"## 工具执行结果\n{_compact_json(results)}")
+
+        new_docs = self._take_new_docs(reference_docs)
+        if new_docs:
+            parts.append(
+                f"## 新增文档切片（共 {len(new_docs)} 个，已累计 {len(reference_docs)} 个；按文件聚合，按chunkIndex排序）\n"
+                f"{_compact_json(self._format_docs_by_file(new_docs))}"
+            )
+        elif new_items:
+            parts.append("## 新增文档切片\n无")
+
+        round_hint = f"## 当前轮次: {current_round}/{max_rounds}" + (
+            " ⚠️ 最后一轮，若信息仍不足请停止并基于现有内容作答" if current_round == max_rounds else ""
+        )
+        parts.append(f"{round_hint}\n\n请基于对话中的全部信息和决策策略，输出结构化决策（仅JSON对象）。")
+        appended.append(HumanMessage(content="\n\n".join(parts)))
+
+        tokens = sum(count_tokens(m.content) for m in appended)
+        self.messages.extend(appended)
+        self.prompt_tokens += tokens
+        return tokens
+
+    def _take_new_docs(self, reference_docs: List[Document]) -> List[Document]:
+        new_docs = []
+        for doc in reference_docs:
+            key = doc.metadata.get("pk") or (doc.metadata.get("fileName"), doc.metadata.get("chunkIndex"))
+            if key not in self._sent_keys:
+                self._sent_keys.add(key)
+                new_docs.append(doc)
+        return new_docs
+
+    def _format_docs_by_file(self, docs: List[Document]) -> List[Dict[str, Any]]:
+        """
+        格式化新增切片：按文件聚合，文件元信息只在该文件首次出现时给出
+
+        Returns:
+            [
+                {
+                    "fileName": str,
+                    "documentId": int,        # 仅首次出现
+                    "maxChunkIndex": int,     # 仅首次出现
+                    "chunks": [
+                        {"chunkIndex": int, "retrieved_round": int, "content": str}
+                        或 {"chunkIndex": int, "retrieved_round": int, "same_as": "fileName#chunkIndex"}
+                    ]
+                }
+            ]
+        """
+        files = []
+        for file_name, file_chunks in sorted(
+                RetrievalController._aggregate_docs_by_file(docs).items(), key=lambda kv: str(kv[0])
+        ):
+            file_info: Dict[str, Any] = {"fileName": file_name}
+            if file_name not in self._known_files:
+                self._known_files.add(file_name)
+                file_info["documentId"] = file_chunks[0].metadata.get("documentId")
+                file_info["maxChunkIndex"] = file_chunks[0].metadata.get("maxChunkIndex")
+
+            chunks = []
+            for chunk in file_chunks:
+                chunk_index = chunk.metadata.get("chunkIndex", 0)
+                chunk_info = {"chunkIndex": chunk_index, "retrieved_round": chunk.metadata.get("retrieved_round")}
+                digest = hashlib.blake2b(chunk.page_content.encode("utf-8"), digest_size=16).digest()
+                same_as = self._sent_contents.get(digest)
+                if same_as is None:
+                    self._sent_contents[digest] = f"{file_name}#{chunk_index}"
+                    chunk_info["content"] = chunk.page_content
+                else:
+                    chunk_info["same_as"] = same_as
+                chunks.append(chunk_info)
+            file_info["chunks"] = chunks
+            files.append(file_info)
+        return files
+
+
+# ============= 轮次预算 =============
+class RetrievalBudget:
+    """
+    Agentic 检索的轮次预算
+    每轮结束后记录新增切片数、rerank 分数提升与耗时，满足以下任一条件时不再请求控制器决策，
+    直接基于已检索的文档生成回答：
+    - 设置了 max_zero_yield_rounds 时，连续该轮数无新增切片（只列出文件的轮次不计入）
+    - 设置了 time_budget 时，已用时间达到该秒数，或按平均每轮耗时预计下一轮会超出
+    - 设置了 min_rerank_gain 时，新增切片的最高 rerank 分数未能将累计最高分提升该幅度的轮次同样视为无增量
+    - 设置了 answer_confidence 时，控制器已不再列出缺失信息且参考文档的最高 rerank 分数达到该阈值，
+      省去最后一轮通常只会得到 stop 的决策，直接开始生成回答。
+      该条件会改变检索深度，默认关闭，仅在请求显式给出 earlyAnswerScore 时启用
+
+    所有条件都会改变检索深度，默认均关闭（只受 max_rounds 限制），
+    通过 options 按请求启用：zeroYieldRounds / retrievalTimeBudget / minRerankGain / earlyAnswerScore
+    （回答模型的提前预热由 pipelinedAnswer 控制，与停止条件无关）
+    """
+
+    def __init__(
+            self,
+            max_zero_yield_rounds: int = 0,
+            time_budget: Optional[float] = None,
+            min_rerank_gain: Optional[float] = None,
+            answer_confidence: Optional[float] = None,
+    ):
+        self.max_zero_yield_rounds = max_zero_yield_rounds
+        self.time_budget = time_budget
+        self.min_rerank_gain = min_rerank_gain
+        self.answer_confidence = answer_confidence
+        self.zero_yield_streak = 0
+        self.missing_info: Optional[List[str]] = None
+        self.best_rerank_score: Optional[float] = None
+        # 每轮统计：{"round", "new_added", "rerank_gain", "seconds"}
+        self.rounds: List[Dict[str, Any]] = []
+        self._start = time.perf_counter()
+        self._round_start = self._start
+
+    @classmethod
+    def from_options(cls, options: Optional[dict]) -> "RetrievalBudget":
+        options = options or {}
+        time_budget = options.get('retrievalTimeBudget')
+        min_rerank_gain = options.get('minRerankGain')
+        answer_confidence = options.get('earlyAnswerScore')
+        return cls(
+            max_zero_yield_rounds=int(options.get('zeroYieldRounds') or 0),
+            time_budget=float(time_budget) if time_budget is not None else None,
+            min_rerank_gain=float(min_rerank_gain) if min_rerank_gain is not None else None,
+            answer_confidence=float(answer_confidence) if answer_confidence is not None else None,
+        )
+
+    @property
+    def elapsed(self) -> float:
+        return time.perf_counter() - self._start
+
+    def start(self):
+        """检索开始时调用，重置计时"""
+        self._start = time.perf_counter()
+        self._round_start = self._start
+
+    def begin_round(self):
+        self._round_start = time.perf_counter()
+
+    def end_round(
+            self,
+            round_no: int,
+            new_docs: List[Document],
+            informative: bool = False,
+            missing_info: Optional[List[str]] = None,
+    ):
+        """
+        记录一轮的结果
+
+        Args:
+            round_no: 轮次
+            new_docs: 本轮新增的参考切片
+            informative: 本轮是否有不产生切片但提供了信息的调用（如列出文件）
+            missing_info: 本轮决策给出的缺失信息
+        """
+        self.missing_info = missing_info
+        scores = [d.metadata["rerank_score"] for d in new_docs if d.metadata.get("rerank_score") is not None]
+        rerank_gain = None
+        if scores:
+            round_best = max(scores)
+            rerank_gain = round_best - self.best_rerank_score if self.best_rerank_score is not None else round_best
+            self.best_rerank_score = max(round_best, self.best_rerank_score or round_best)
+
+        productive = bool(new_docs)
+        if productive and self.min_rerank_gain is not None and rerank_gain is not None and len(scores) == len(new_docs):
+            productive = rerank_gain >= self.min_rerank_gain
+        if productive:
+            self.zero_yield_streak = 0
+        elif not informative:
+            self.zero_yield_streak += 1
+
+        self.rounds.append({
+            "round": round_no,
+            "new_added": len(new_docs),
+            "rerank_gain": round(rerank_gain, 4) if rerank_gain is not None else None,
+            "seconds": round(time.perf_counter() - self._round_start, 2),
+        })
+
+    def exhausted(self) -> Optional[str]:
+        """预算用尽（或已可以作答）时返回原因，否则返回 None"""
+        if (self.answer_confidence is not None and self.missing_info is not None and not self.missing_info
+                and self.best_rerank_score is not None and self.best_rerank_score >= self.answer_confidence):
+            return f"已无缺失信息，参考文档最高相关度 {self.best_rerank_score:.2f} 达到阈值 {self.answer_confidence:g}"
+        if self.max_zero_yield_rounds > 0 and self.zero_yield_streak >= self.max_zero_yield_rounds:
+            return f"连续 {self.zero_yield_streak} 轮无新增有效切片"
+        if self.time_budget is None:
+            return None
+        elapsed = self.elapsed
+        if elapsed >= self.time_budget:
+            return f"检索已用时 {elapsed:.1f}s，达到时间预算 {self.time_budget:g}s"
+        if self.rounds:
+            average = sum(r["seconds"] for r in self.rounds) / len(self.rounds)
+            if elapsed + average > self.time_budget:
+                return f"检索已用时 {elapsed:.1f}s，预计下一轮将超出时间预算 {self.time_budget:g}s"
+        return None
+
 
 # ============= 决策控制器 =============
 class RetrievalController:
@@ -40,25 +305,10 @@ class RetrievalController:
 
     @staticmethod
     def _format_history(history: list) -> str:
-        """格式化对话历史"""
+        """格式化对话历史（按控制器的 token 预算压缩，较早的对话以摘要代替）"""
         if not history:
             return "无对话历史"
-
-        lines = []
-        for msg in history:
-            if isinstance(msg, HumanMessage):
-                role, content = "用户", msg.content
-            elif isinstance(msg, AIMessage):
-                role, content = "助手", msg.content
-            elif isinstance(msg, dict):
-                role_key = msg.get("role", "")
-                role = "用户" if role_key == "user" else "助手" if role_key == "assistant" else role_key
-                content = msg.get("content", "")
-            else:
-                role, content = "未知", str(msg)
-            lines.append(f"{role}: {content}")
-
-        return "\n".join(lines)
+        return compact_history(history, "controller").to_text()
 
     @staticmethod
     def _aggregate_docs_by_file(docs: List[Document]) -> Dict[str, List[Document]]:
@@ -85,119 +335,48 @@ class RetrievalController:
         return file_docs
 
     @staticmethod
-    def _format_docs_by_file(docs: List[Document]) -> Dict[str, Any]:
+    def _format_tool_call(item: Dict) -> Dict:
         """
-        格式化文档：按文件聚合并显示完整信息（包含内容）
-        
+        格式化一次工具调用的执行结果（工具参数已包含在对应的决策消息中，不再重复）
+
         Returns:
             {
-                "total_files": int,
-                "total_chunks": int,
-                "files": [
-                    {
-                        "fileName": str,
-                        "documentId": int,
-                        "maxChunkIndex": int,
-                        "retrieved_chunk_count": int,
-                        "chunks": [
-                            {
-                                "chunkIndex": int,
-                                "retrieved_round": int,
-                                "content": str
-                            }
-                        ]
-                    }
-                ]
+                "round": 1,
+                "tool": "search_by_multi_queries_in_database",
+                "result": "..." or {...}
             }
         """
-        file_docs = RetrievalController._aggregate_docs_by_file(docs)
+        decision = item.get("decision", {})
+        result_data = item.get("result")
 
-        result = {
-            "total_files": len(file_docs),
-            "total_chunks": len(docs),
-            "files": []
+        call_info = {
+            "round": item.get("round"),
+            "tool": item.get("tool"),
         }
 
-        for file_name, file_chunks in sorted(file_docs.items()):
-            if not file_chunks:
-                continue
-
-            first_chunk = file_chunks[0]
-
-            # 按chunkIndex排序chunk
-            sorted_chunks = sorted(file_chunks, key=lambda d: d.metadata.get("chunkIndex", 0))
-
-            chunks_data = []
-            for chunk in sorted_chunks:
-                chunks_data.append({
-                    "chunkIndex": chunk.metadata.get("chunkIndex", 0),
-                    "retrieved_round": chunk.metadata.get("retrieved_round"),
-                    "content": chunk.page_content
-                })
-
-            file_info = {
-                "fileName": file_name,
-                "documentId": first_chunk.metadata.get("documentId"),
-                "maxChunkIndex": first_chunk.metadata.get("maxChunkIndex"),
-                "retrieved_chunk_count": len(file_chunks),
-                "chunks": chunks_data
-            }
-
-            result["files"].append(file_info)
-
-        return result
-
-    @staticmethod
-    def _format_tool_call_history(trace: List[Dict]) -> List[Dict]:
-        """
-        格式化工具调用历史
-        
-        Args:
-            trace: 执行轨迹列表
-        
-        Returns:
-            [
-                {
-                    "round": 1,
-                    "tool": "search_by_multi_queries_in_database",
-                    "params": {...},
-                    "result": "..." or {...}
-                }
-            ]
-        """
-        history = []
-        for item in trace:
-            decision = item.get("decision", {})
-            result_data = item.get("result")
-
-            call_info = {
-                "round": item.get("round"),
-                "tool": decision.get("tool"),
-                "params": decision.get("params", {}),
-                "existing_info": decision.get("existing_info", []),
-                "missing_info": decision.get("missing_info", []),
-            }
-
-            if result_data is None:
-                call_info["result"] = f"停止: {decision.get('reason', '未知原因')}"
-            elif isinstance(result_data, dict):
-                if result_data.get("type") == "file_list":
-                    call_info["result"] = result_data
-                elif result_data.get("type") == "document_retrieval":
-                    call_info["result"] = result_data.get("description", "检索完成")
-                else:
-                    call_info["result"] = str(result_data)
+        if result_data is None:
+            call_info["result"] = f"停止: {decision.get('reason', '未知原因')}"
+        elif isinstance(result_data, dict):
+            if result_data.get("type") == "file_list":
+                call_info["result"] = result_data
+            elif result_data.get("type") == "document_retrieval":
+                call_info["result"] = result_data.get("description", "检索完成")
             else:
                 call_info["result"] = str(result_data)
+        else:
+            call_info["result"] = str(result_data)
 
-            history.append(call_info)
+        return call_info
 
-        return history
+    def start_conversation(
+            self, question: str, history: Optional[list] = None, known_files: Optional[List[Document]] = None
+    ) -> ControllerConversation:
+        """开始一次检索过程的控制器对话（known_files 为同一会话此前检索过的文件）"""
+        return ControllerConversation(question, history, known_files)
 
     async def decide_next_action(
             self,
-            question: str,
-            history: list,
+            conversation: ControllerConversation,
             current_round: int,
             max_rounds: int,
             reference_docs: List[Document],
@@ -207,8 +386,7 @@ class RetrievalController:
         决策下一步行动
 
         Args:
-            question: 用户问题
-            history: 对话历史
+            conversation: 本次检索过程的控制器对话（由 start_conversation 创建）
             current_round: 当前轮次
             max_rounds: 最大轮次
             reference_docs: 所有累积的文档
@@ -217,62 +395,23 @@ class RetrievalController:
         Returns:
             RetrievalDecision: 决策结果
         """
-
-        # 1. 对话上下文（用于判断能否回答）
-        history = history.copy()
-        history.append({"role": "user", "content": question})
-        conversation_context = {
-            "current_question": question,
-            "history": self._format_history(history),
-        }
-
-        # 2. RAG检索信息（按文件聚合并排序）
-        docs_info = self._format_docs_by_file(reference_docs)
-
-        # 3. 工具调用历史（包含参数和结果）
-        tool_history = self._format_tool_call_history(trace)
-
-        # system: 静态指令，可被缓存
-        system_prompt = f"{CONTROLLER_SYSTEM_PROMPT}\n\n{TOOL_DEFINE_PROMPT}\n\n{TOOL_SELECT_PROMPT}"
-
-        round_hint = f"## 当前轮次: {current_round}/{max_rounds}" + (
-            " ⚠️ 最后一轮，若信息仍不足请停止并基于现有内容作答" if current_round == max_rounds else ""
-        )
-
-        user_prompt = f"""## 一、对话上下文
-
-{json.dumps(conversation_context, ensure_ascii=False, indent=2)}
-
-## 二、已检索的文档和对应切片（按文件聚合，按chunkIndex排序）
-
-{json.dumps(docs_info, ensure_ascii=False, indent=2)}
-
-## 三、工具调用历史
-
-{json.dumps(tool_history, ensure_ascii=False, indent=2)}
-
----
-
-{round_hint}
-
-请基于以上三类信息和决策策略，输出结构化决策（仅JSON对象）。"""
-
-        messages = [
-            SystemMessage(content=system_prompt),
-            HumanMessage(content=user_prompt),
-        ]
+        appended_tokens = conversation.advance(reference_docs, trace, current_round, max_rounds)
 
         logger.debug(
             f"\n{'=' * 60}\n"
-            f"[Round {current_round}] decide_next_action INPUT\n"
+            f"[Round {current_round}] decide_next_action INPUT (appended)\n"
             f"{'=' * 60}\n"
-            f"[SYSTEM]\n{system_prompt}\n\n"
-            f"[USER]\n{user_prompt}\n"
-            f"{'=' * 60}"
+            + "\n\n".join(f"[{m.type.upper()}]\n{m.content}" for m in conversation.messages[-2:])
+            + f"\n{'=' * 60}"
         )
 
+        start = time.perf_counter()
         try:
-            decision = await self.llm.ainvoke(messages)
+            decision = await self.llm.ainvoke(conversation.messages)
+            logger.info(
+                f"[Round {current_round}] 控制器决策耗时 {time.perf_counter() - start:.2f}s，"
+                f"本轮追加 {appended_tokens} tokens，对话累计 {conversation.prompt_tokens} tokens"
+            )
             logger.debug(
                 f"\n{'=' * 60}\n"
                 f"[Round {current_round}] decide_next_action OUTPUT\n"
@@ -4,36 +4,49 @@ Agentic RAG 工具集
 """
 import asyncio
 import logging
-from typing import List, Dict, Any, Optional, Literal
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Literal, Iterable, Tuple
 
 from langchain_core.documents import Document
 from pydantic import BaseModel, Field
 
 from aiohttp_utils import rerank
+from cache_utils import CollectionVersionRegistry, RetrievalCache
+from keyword_index_utils import CollectionKeywordIndex, fetch_matched_rows
+from milvus_utils import CollectionCapabilities
 from utils import filter_grade_threshold
 
 logger = logging.getLogger(__name__)
 
 
 # ============= 决策模型 =============
-class RetrievalDecision(BaseModel):
-    """检索决策结构化输出"""
-    action: Literal["continue", "stop"] = Field(description="是否继续检索: continue=继续, stop=停止")
-    reason: str = Field(
-        description="如果选择工具，需说明选择该工具的理由；如果停止检索，需说明为什么当前信息已足够或无法继续。")
+# 单轮最多并行执行的工具调用数
+MAX_TOOL_CALLS = 4
+
 
-    # 如果action=continue, 以下字段必填
-    tool: Optional[Literal[
+class ToolCall(BaseModel):
+    """单次工具调用"""
+    tool: Literal[
         "search_by_grep",  # 1. 关键词检索（grep），支持全库/单文件/多文件
         "search_by_filename_and_chunk_range",  # 2. 按文件名获取连续chunk范围
         "extend_file_chunk_context_window",  # 3. 快速扩展chunk上下文窗口
         "search_by_multi_queries_in_database",  # 4. 全库语义检索(多query+rerank)
         "list_filename_by_like"  # 5. 根据模式匹配列出文件
-    ]] = Field(default=None, description="下一步要使用的检索工具")
+    ] = Field(description="要使用的检索工具")
+
+    params: Dict[str, Any] = Field(description="工具参数,根据tool不同而不同")
+
+
+class RetrievalDecision(BaseModel):
+    """检索决策结构化输出"""
+    action: Literal["continue", "stop"] = Field(description="是否继续检索: continue=继续, stop=停止")
+    reason: str = Field(
+        description="如果选择工具，需说明选择这些工具的理由；如果停止检索，需说明为什么当前信息已足够或无法继续。")
 
-    params: Optional[Dict[str, Any]] = Field(
-        default=None,
-        description="工具参数,根据tool不同而不同"
+    # 如果action=continue, 至少包含一个工具调用；多个调用之间必须相互独立，会并行执行
+    tool_calls: List[ToolCall] = Field(
+        default_factory=list,
+        description=f"本轮要执行的工具调用（1~{MAX_TOOL_CALLS} 个，相互独立，并行执行）"
     )
 
     existing_info: List[str] = Field(
@@ -46,66 +59,311 @@ class RetrievalDecision(BaseModel):
     )
 
 
+# ============= 切片邻域缓存 =============
+class ChunkNeighborhoodCache:
+    """
+    切片邻域缓存，key 为 (collection, fileName, chunkIndex)
+    - 任一工具命中的切片，会在后台以一次批量查询预取其前后 neighbor_window 个切片
+    - 按范围读取时优先命中缓存，仅对缺口发起 Milvus 查询
+    默认随 RetrievalToolkit 按请求创建，也可由调用方传入以在会话内复用
+    """
+
+    def __init__(self, neighbor_window: int = 2, max_chunks: int = 4096, max_prefetch: int = 64):
+        self.neighbor_window = neighbor_window
+        self.max_chunks = max_chunks
+        self.max_prefetch = max_prefetch
+        # value 为 None 表示已查询确认不存在（越界或已删除）
+        self._chunks: "OrderedDict[Tuple[str, str, int], Optional[Document]]" = OrderedDict()
+        # (collection, fileName) -> 进行中的预取任务
+        self._pending: Dict[Tuple[str, str], asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _copy(doc: Document) -> Document:
+        # 调用方会改写 metadata（如 retrieved_round），缓存中保存独立副本
+        return Document(page_content=doc.page_content, metadata=dict(doc.metadata))
+
+    def _set(self, key: Tuple[str, str, int], doc: Optional[Document]):
+        self._chunks[key] = doc
+        self._chunks.move_to_end(key)
+        while len(self._chunks) > self.max_chunks:
+            self._chunks.popitem(last=False)
+
+    def get(self, collection: str, file_name: str, indices: Iterable[int]) -> Tuple[Dict[int, Document], List[int]]:
+        """
+        Returns:
+            (命中的切片 {chunkIndex: Document}, 未缓存的 chunkIndex 列表)
+        """
+        found, gaps = {}, []
+        for idx in indices:
+            key = (collection, file_name, idx)
+            if key not in self._chunks:
+                gaps.append(idx)
+                continue
+            self._chunks.move_to_end(key)
+            doc = self._chunks[key]
+            if doc is not None:
+                found[idx] = self._copy(doc)
+        self.hits += len(found)
+        self.misses += len(gaps)
+        return found, gaps
+
+    def put(self, collection: str, file_name: str, docs: List[Document], requested: Iterable[int]):
+        """写入一次范围查询的结果，请求了但未返回的 chunkIndex 记为不存在"""
+        returned = set()
+        for doc in docs:
+            idx = doc.metadata.get("chunkIndex")
+            if idx is None:
+                continue
+            returned.add(idx)
+            self._set((collection, file_name, idx), self._copy(doc))
+        for idx in requested:
+            if idx not in returned:
+                self._set((collection, file_name, idx), None)
+
+    def remember(self, collection: str, docs: List[Document]):
+        """记录其他工具命中的完整切片"""
+        for doc in docs:
+            file_name = doc.metadata.get("fileName")
+            idx = doc.metadata.get("chunkIndex")
+            if file_name is None or idx is None or not doc.page_content:
+                continue
+            key = (collection, file_name, idx)
+            if key not in self._chunks:
+                self._set(key, self._copy(doc))
+
+    def neighbors_to_prefetch(self, collection: str, docs: List[Document]) -> Dict[str, List[int]]:
+        """计算命中切片的未缓存邻域，按文件分组"""
+        wanted: Dict[str, set] = {}
+        for doc in docs:
+            file_name = doc.metadata.get("fileName")
+            idx = doc.metadata.get("chunkIndex")
+            if file_name is None or idx is None:
+                continue
+            max_idx = doc.metadata.get("maxChunkIndex")
+            upper = idx + self.neighbor_window
+            if max_idx is not None:
+                upper = min(upper, max_idx)
+            for i in range(max(0, idx - self.neighbor_window), upper + 1):
+                if (collection, file_name, i) not in self._chunks:
+                    wanted.setdefault(file_name, set()).add(i)
+        return {f: sorted(idx_set)[:self.max_prefetch] for f, idx_set in wanted.items()}
+
+    def is_pending(self, collection: str, file_name: str) -> bool:
+        task = self._pending.get((collection, file_name))
+        return task is not None and not task.done()
+
+    def track(self, collection: str, file_name: str, task: asyncio.Task):
+        key = (collection, file_name)
+        self._pending[key] = task
+        task.add_done_callback(lambda t: self._pending.pop(key, None) if self._pending.get(key) is t else None)
+
+    async def wait_pending(self, collection: str, file_name: str):
+        """等待该文件进行中的预取完成（不传播预取异常，也不因调用方取消而取消预取）"""
+        task = self._pending.get((collection, file_name))
+        if task is not None and not task.done():
+            await asyncio.wait({task})
+
+
 # ============= 检索工具集 (5个工具) =============
 class RetrievalToolkit:
     """原子化检索工具集 - 完全透明可控"""
 
-    def __init__(self, vector_store, retriever):
+    def __init__(
+            self,
+            vector_store,
+            retriever,
+            capabilities: Optional[CollectionCapabilities] = None,
+            keyword_index: Optional[CollectionKeywordIndex] = None,
+            chunk_cache: Optional[ChunkNeighborhoodCache] = None,
+            collection_key: Optional[str] = None
+    ):
         self.vector_store = vector_store
         self.retriever = retriever
+        self.capabilities = capabilities or CollectionCapabilities()
+        # 本地倒排索引，仅在 collection 不支持 Milvus 全文检索时使用
+        self.keyword_index = keyword_index
+        # 切片邻域缓存，减少多轮检索中重复的范围查询
+        self.chunk_cache = chunk_cache or ChunkNeighborhoodCache()
+        # "{db}.{collection}" 标识，用于检索结果缓存；为空时不缓存
+        self.collection_key = collection_key
 
     @staticmethod
     def _escape(s: str) -> str:
         """转义特殊字符"""
         return s.replace("\\", "\\\\").replace('"', '\\"').replace("'", "\\'")
 
-    async def _milvus_filter(
+    async def _milvus_query(
             self,
             filter_expr: str,
             offset: int = 0,
             limit: int = 20,
             output_fields: Optional[List[str]] = None
     ) -> List[Document]:
-        """底层Milvus查询封装"""
+        """底层Milvus查询封装（查询失败时抛出异常）"""
         if output_fields is None:
-            output_fields = ["text", "pk", "documentId", "chunkIndex", "fileName", "maxChunkIndex"]
-        try:
-            rows = await self.vector_store.aclient.query(
-                collection_name=self.vector_store.collection_name,
-                filter=filter_expr,
-                output_fields=output_fields,
-                offset=offset,
-                limit=limit,
-            )
+            output_fields = self.capabilities.output_fields
+        rows = await self.vector_store.aclient.query(
+            collection_name=self.vector_store.collection_name,
+            filter=filter_expr,
+            output_fields=output_fields,
+            offset=offset,
+            limit=limit,
+        )
 
-            docs = []
-            for r in rows:
-                docs.append(Document(
-                    page_content=r.get("text", ""),
-                    metadata={k: v for k, v in r.items() if k != "text"}
-                ))
+        docs = []
+        for r in rows:
+            docs.append(Document(
+                page_content=r.get("text", ""),
+                metadata={k: v for k, v in r.items() if k != "text"}
+            ))
 
-            return docs
+        return docs
 
+    async def _milvus_filter(
+            self,
+            filter_expr: str,
+            offset: int = 0,
+            limit: int = 20,
+            output_fields: Optional[List[str]] = None
+    ) -> List[Document]:
+        """底层Milvus查询封装（查询失败时返回空列表）"""
+        try:
+            return await self._milvus_query(filter_expr, offset, limit, output_fields)
         except Exception as e:
             logger.error(f"❌ Milvus查询失败: {e}")
             return []
 
+    async def _fetch_chunks(self, file_name: str, indices: List[int]) -> List[Document]:
+        """一次查询拉取同一文件的多个切片，并写入邻域缓存"""
+        filter_expr = f'fileName == "{self._escape(file_name)}" and chunkIndex in {sorted(indices)}'
+        docs = await self._milvus_query(filter_expr=filter_expr, limit=len(indices))
+        self.chunk_cache.put(self.vector_store.collection_name, file_name, docs, indices)
+        return docs
+
+    async def _prefetch_neighbors(self, file_name: str, indices: List[int]):
+        try:
+            docs = await self._fetch_chunks(file_name, indices)
+            logger.debug(f"📦 预取相邻切片: file='{file_name}', 请求{len(indices)}个, 返回{len(docs)}个")
+        except Exception as e:
+            logger.debug(f"⚠️ 预取相邻切片失败: {e}")
+
+    def _schedule_prefetch(self, docs: List[Document]):
+        """记录命中的切片，并在后台预取其相邻切片"""
+        if not self.capabilities.has_chunk_index or not self.capabilities.has_file_name:
+            return
+        collection = self.vector_store.collection_name
+        # 去掉检索过程附加的字段（rerank_score 等），与范围查询结果保持一致
+        fields = self.capabilities.output_fields
+        self.chunk_cache.remember(collection, [
+            Document(page_content=d.page_content, metadata={k: d.metadata[k] for k in fields if k in d.metadata})
+            for d in docs
+        ])
+        for file_name, indices in self.chunk_cache.neighbors_to_prefetch(collection, docs).items():
+            # 同一文件已有预取在途时跳过，后续范围读取会补齐缺口
+            if not indices or self.chunk_cache.is_pending(collection, file_name):
+                continue
+            task = asyncio.create_task(self._prefetch_neighbors(file_name, indices))
+            self.chunk_cache.track(collection, file_name, task)
+
+    @staticmethod
+    def _contains_keywords(text: str, keywords: List[str], match_type: Literal["AND", "OR"]) -> bool:
+        """子串校验，与 text like "%kw%" 的 AND/OR 组合语义一致"""
+        if match_type == "AND":
+            return all(kw in text for kw in keywords)
+        return any(kw in text for kw in keywords)
+
+    async def _phrase_match_filter(
+            self,
+            keywords: List[str],
+            match_type: Literal["AND", "OR"],
+            limit: int,
+            extra_filter: Optional[str] = None,
+    ) -> Optional[List[Document]]:
+        """
+        基于 PHRASE_MATCH 的关键词过滤（text 字段开启 enable_match 时）
+        PHRASE_MATCH 按分词匹配，大小写、短于 n-gram 的关键词等与 LIKE 子串语义不同，
+        命中结果再做子串校验，保持 grep 的精确匹配语义
+
+        Returns:
+            文档列表；无校验通过的结果时返回 None，调用方回退到 LIKE
+        """
+        keyword_expr = f" {match_type} ".join(f'PHRASE_MATCH(text, "{self._escape(kw)}")' for kw in keywords)
+        filter_expr = f'({extra_filter}) and ({keyword_expr})' if extra_filter else keyword_expr
+        # 多取一些候选，抵消子串校验过滤掉的部分
+        docs = await self._milvus_filter(filter_expr=filter_expr, limit=limit * 2)
+        docs = [d for d in docs if self._contains_keywords(d.page_content, keywords, match_type)][:limit]
+        return docs or None
+
+    async def _indexed_keyword_filter(
+            self,
+            keywords: List[str],
+            match_type: Literal["AND", "OR"],
+            limit: int,
+            extra_filter: Optional[str] = None,
+    ) -> Optional[List[Document]]:
+        """
+        基于本地倒排索引的关键词过滤（等价于 text like 的 AND/OR 组合）
+
+        Returns:
+            文档列表；索引不可用时返回 None，调用方回退到 LIKE
+        """
+        if self.keyword_index is None:
+            return None
+        # 倒排求交/并为 CPU 计算，放到线程中执行，避免阻塞事件循环
+        candidates = await asyncio.to_thread(self.keyword_index.match, keywords, match_type)
+        if candidates is None:
+            return None
+
+        try:
+            rows = await fetch_matched_rows(
+                self.vector_store,
+                candidates,
+                predicate=lambda row: self._contains_keywords(row.get("text", ""), keywords, match_type),
+                output_fields=self.capabilities.output_fields,
+                limit=limit,
+                extra_filter=extra_filter,
+            )
+        except Exception as e:
+            logger.error(f"❌ 倒排索引候选拉取失败: {e}")
+            return None
+        if rows is None:
+            # 候选过多，逐批拉取不如 LIKE 扫描
+            return None
+        return [
+            Document(page_content=r.get("text", ""), metadata={k: v for k, v in r.items() if k != "text"})
+            for r in rows
+        ]
+
     async def _vector_search(
             self,
             query: str,
             top_k: int = 10,
     ) -> List[Document]:
-        """底层向量检索封装"""
+        """底层向量检索封装（结果按 collection 版本缓存）"""
+        # 检索开始时的版本，检索期间入库则结果写入旧版本
+        version = CollectionVersionRegistry.get(self.collection_key) if self.collection_key else 0
+        if self.collection_key:
+            cached = RetrievalCache.get(self.collection_key, version, "toolkit_vector", query, top_k)
+            if cached is not None:
+                return cached
         try:
             # 向量检索
             search_kwargs = {"k": top_k}
             docs = await self.retriever.ainvoke(query, search_kwargs=search_kwargs)
-            # 尝试将query切分为多个keywords进行过滤（如果query中包含空格）
-            keywords = query.split(" ")
-            if len(keywords) > 1:
-                expr_filter = " OR ".join([f'text like "%{self._escape(kw)}%"' for kw in keywords])
-                docs.extend(await self._milvus_filter(filter_expr=expr_filter, limit=top_k))
+            # 混合检索已包含 BM25 关键词召回，无需再做 LIKE 扫描
+            if not self.capabilities.hybrid:
+                # 尝试将query切分为多个keywords进行过滤（如果query中包含空格）
+                keywords = query.split(" ")
+                if len(keywords) > 1:
+                    keyword_docs = await self._indexed_keyword_filter(keywords, "OR", limit=top_k)
+                    if keyword_docs is None:
+                        expr_filter = " OR ".join([f'text like "%{self._escape(kw)}%"' for kw in keywords])
+                        keyword_docs = await self._milvus_filter(filter_expr=expr_filter, limit=top_k)
+                    docs.extend(keyword_docs)
+            if self.collection_key:
+                RetrievalCache.put(self.collection_key, version, "toolkit_vector", query, top_k, docs)
             return docs
 
         except Exception as e:
@@ -142,20 +400,27 @@ class RetrievalToolkit:
         logger.info(
             f"🔍 [1.grep检索] keywords={keywords}, type={match_type}, top_k={top_k}, scope={scope}, files={file_names}")
 
-        keyword_conditions = [f'text like "%{self._escape(kw)}%"' for kw in keywords]
-        keyword_expr = f" {match_type} ".join(keyword_conditions)
-
+        file_expr = None
         if file_names:
             file_conditions = [f'fileName == "{self._escape(fn)}"' for fn in file_names]
             file_expr = " OR ".join(file_conditions)
-            filter_expr = f'({file_expr}) and ({keyword_expr})'
+
+        if self.capabilities.needs_keyword_index:
+            # 旧版 collection 优先使用本地倒排索引，仅拉取候选 pk
+            docs = await self._indexed_keyword_filter(keywords, match_type, limit=top_k, extra_filter=file_expr)
         else:
-            filter_expr = keyword_expr
+            # text 字段开启 enable_match 时先用 PHRASE_MATCH 走倒排索引，避免 LIKE 全表扫描
+            docs = await self._phrase_match_filter(keywords, match_type, limit=top_k, extra_filter=file_expr)
 
-        docs = await self._milvus_filter(
-            filter_expr=filter_expr,
-            limit=top_k
-        )
+        if docs is None:
+            keyword_conditions = [f'text like "%{self._escape(kw)}%"' for kw in keywords]
+            keyword_expr = f" {match_type} ".join(keyword_conditions)
+            filter_expr = f'({file_expr}) and ({keyword_expr})' if file_expr else keyword_expr
+
+            docs = await self._milvus_filter(
+                filter_expr=filter_expr,
+                limit=top_k
+            )
 
         logger.info(f"✅ grep检索结果: {len(docs)}条")
 
@@ -189,20 +454,24 @@ class RetrievalToolkit:
         file_name = file_name.replace(" ", "")
         logger.info(f"🔍 [2.文件chunk范围] file='{file_name}', range=[{start_chunk_index}, {end_chunk_index}]")
 
-        filter_expr = f'fileName == "{self._escape(file_name)}" and chunkIndex >= {start_chunk_index} and chunkIndex <= {end_chunk_index}'
-
         limit = end_chunk_index - start_chunk_index + 1
         if limit > 21:
             raise RuntimeError(f"单次chunk范围不能超过20个，当前为{limit}个，请缩小范围或分多次调用")
 
-        docs = await self._milvus_filter(
-            filter_expr=filter_expr,
-            limit=limit
-        )
+        # 先等待该文件在途的预取，再从缓存读取，仅查询缺口
+        collection = self.vector_store.collection_name
+        await self.chunk_cache.wait_pending(collection, file_name)
+        found, gaps = self.chunk_cache.get(collection, file_name, range(start_chunk_index, end_chunk_index + 1))
+        if gaps:
+            try:
+                for doc in await self._fetch_chunks(file_name, gaps):
+                    found[doc.metadata.get("chunkIndex", 0)] = doc
+            except Exception as e:
+                logger.error(f"❌ Milvus查询失败: {e}")
 
-        docs.sort(key=lambda d: d.metadata.get("chunkIndex", 0))
+        docs = sorted(found.values(), key=lambda d: d.metadata.get("chunkIndex", 0))
 
-        logger.info(f"✅ 文件chunk范围检索结果: {len(docs)}条")
+        logger.info(f"✅ 文件chunk范围检索结果: {len(docs)}条（缓存命中{limit - len(gaps)}个，查询{len(gaps)}个）")
 
         return {
             "results": docs,
@@ -420,6 +689,18 @@ class RetrievalToolkit:
         }
 
     # ============= 工具执行统一入口 =============
+    async def execute_tools(self, calls: List[ToolCall]) -> List[Any]:
+        """
+        并行执行一组相互独立的工具调用
+
+        Returns:
+            与 calls 一一对应的结果列表，执行失败的调用对应位置为异常对象
+        """
+        return await asyncio.gather(
+            *(self.execute_tool(call.tool, call.params) for call in calls),
+            return_exceptions=True
+        )
+
     async def execute_tool(
             self,
             tool: str,
@@ -438,18 +719,21 @@ class RetrievalToolkit:
         logger.info(f"🔧 执行工具: {tool}, 参数: {params}")
         if tool and params:
             if tool == "search_by_grep":
-                return await self.search_by_grep(**params)
+                result = await self.search_by_grep(**params)
             elif tool == "search_by_filename_and_chunk_range":
-                return await self.search_by_filename_and_chunk_range(**params)
+                result = await self.search_by_filename_and_chunk_range(**params)
             elif tool == "extend_file_chunk_context_window":
-                return await self.extend_file_chunk_context_window(**params)
+                result = await self.extend_file_chunk_context_window(**params)
             elif tool == "search_by_multi_queries_in_database":
-                return await self.search_by_multi_queries_in_database(**params)
+                result = await self.search_by_multi_queries_in_database(**params)
 
             elif tool == "list_filename_by_like":
+                # 仅返回元信息，不参与邻域预取
                 return await self.list_filename_by_like(**params)
             else:
                 raise ValueError(f"未知工具: {tool}")
+            self._schedule_prefetch(result["results"])
+            return result
         else:
             raise ValueError("工具名称和参数不能为空")
 
@@ -467,7 +751,7 @@ TOOL_DEFINE_PROMPT = """## Agentic RAG 检索工具定义
 [1] search_by_grep
 ======================================================================
 用途：
-- 基于关键词精确匹配检索正文内容
+- 基于关键词精确匹配检索正文内容（区分大小写的子串匹配）
 - 支持全库、单文件、多文件范围检索
 
 适合：
@@ -614,8 +898,9 @@ TOOL_SELECT_PROMPT = """## 检索决策规范
 {
   "action": "continue" | "stop",
   "reason": "简洁说明决策依据",
-  "tool": "search_by_grep" | "search_by_filename_and_chunk_range" | "extend_file_chunk_context_window" | "search_by_multi_queries_in_database" | "list_filename_by_like" | null,
-  "params": {} | null,
+  "tool_calls": [
+    {"tool": "search_by_grep" | "search_by_filename_and_chunk_range" | "extend_file_chunk_context_window" | "search_by_multi_queries_in_database" | "list_filename_by_like", "params": {}}
+  ],
   "existing_info": ["..."],
   "missing_info": ["..."]
 }
@@ -658,6 +943,11 @@ C. 成本控制：
    - 能用 grep，不优先用语义检索
    - 能用上下文扩展，不优先用范围读取
 
+D. 并行调用：
+   - 本轮需要的多个检索互不依赖时（如 grep 关键词 X、扩展已命中 chunk 的上下文、列出匹配 Y 的文件），
+     放入同一个 tool_calls 列表并行执行，最多 4 个，减少决策轮次
+   - 后一个调用的参数依赖前一个调用的结果时（如需先列出文件才能确定 file_name），必须分轮执行
+
 ======================================================================
 [第 3 步] 参数构造要求
 ======================================================================
@@ -692,7 +982,7 @@ list_filename_by_like:
 [第 4 步] 防循环规则
 ======================================================================
 
-1. 禁止重复调用完全相同的 tool + params
+1. 禁止重复调用完全相同的 tool + params（同一轮内也不允许）
 2. 同一工具重试时，必须显著修改关键参数
 3. 连续两轮结果过少时，应考虑切换工具
 4. 连续三轮没有新增信息时，应 stop
@@ -716,8 +1006,8 @@ missing_info:
 [输出一致性要求]
 ======================================================================
 
-1. action="continue" 时，tool 和 params 必须非空
-2. action="stop" 时，tool 和 params 必须为 null
+1. action="continue" 时，tool_calls 至少包含一个调用，每个调用的 tool 和 params 必须非空
+2. action="stop" 时，tool_calls 必须为空列表
 3. existing_info 和 missing_info 必须是字符串数组
 4. reason 只写 1~2 句，简洁具体
 5. 只输出 JSON，不输出任何额外说明
@@ -731,9 +1021,12 @@ CONTROLLER_SYSTEM_PROMPT = """你是 Agentic RAG 的检索决策控制器。你
 2. 已检索到的文档切片及其元信息（如 fileName、chunkIndex、maxChunkIndex）
 3. 工具调用历史（用于判断覆盖度、失败原因和避免重复）
 
+多轮检索在同一段对话中进行：你此前输出的决策会保留在对话中，每轮只追加该决策的工具执行结果与新增的文档切片，
+之前发送过的切片不会重复发送，判断时请综合整段对话中的全部切片。
+
 你的核心目标：
 1. 判断当前信息是否足以回答问题
-2. 若不足，选择下一步最合适的检索工具
+2. 若不足，选择下一步最合适的检索工具（相互独立的多个检索可在同一轮并行调用）
 3. 构造合法、有效、且不重复的参数
 4. 持续维护 existing_info 与 missing_info，使检索逐轮收敛
 
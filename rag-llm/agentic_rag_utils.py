@@ -5,16 +5,21 @@
 - LangChain仅提供辅助(LLM调用、Embedding、文档处理)
 - 全程可追踪、可调试
 """
+import asyncio
 import json
 import logging
 import os
-from typing import List, Dict, Any, Optional
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import List, Dict, Any, Optional, Tuple, AsyncIterator
 
 from langchain_core.documents import Document
 from langchain_core.messages import HumanMessage, AIMessage
 
-from agentic_rag_controller import RetrievalController
-from agentic_rag_toolkit import RetrievalToolkit
+from agentic_rag_controller import RetrievalController, RetrievalBudget
+from agentic_rag_toolkit import RetrievalToolkit, ChunkNeighborhoodCache, RetrievalDecision, MAX_TOOL_CALLS
+from cache_utils import LRUCache, CollectionVersionRegistry
+from keyword_index_utils import KeywordIndexManager
 from milvus_utils import MilvusClientManager
 from rag_utils import merge_consecutive_chunks
 from utils import get_embedding_instance
@@ -22,6 +27,12 @@ from utils import get_official_llm, unified_llm_stream
 
 logger = logging.getLogger(__name__)
 
+# 后台任务（连接预热）的强引用，避免任务未完成即被回收
+_background_tasks = set()
+
+# 会话内记录的已检索文件数上限
+MAX_SESSION_FILES = 200
+
 
 # ============= 核心Agentic RAG类 =============
 class AgenticRAGService:
@@ -36,9 +47,12 @@ class AgenticRAGService:
             self,
             user_id: int,
             kb_id: int,
+            chunk_cache: Optional[ChunkNeighborhoodCache] = None,
     ):
         self.user_id = user_id
         self.kb_id = kb_id
+        # 切片邻域缓存，未传入时由工具集按请求创建
+        self.chunk_cache = chunk_cache
 
         # Milvus配置
         self.milvus_uri = os.environ.get("MILVUS_URI")
@@ -53,9 +67,38 @@ class AgenticRAGService:
         self.vector_store = None
         self.toolkit = None
         self.controller = None
+        # 此前各轮对话检索过的文件（key为documentId，只保留元信息），会话内复用时提供给控制器
+        self.session_files: "OrderedDict[int, Document]" = OrderedDict()
 
         logger.info(f"🚀 AgenticRAG初始化: user_id={user_id}, kb_id={kb_id}")
 
+    async def ensure_ready(self):
+        """
+        确保服务可用：首次使用时初始化；会话内复用时确认 collection 仍处于加载状态
+        （空闲释放后由 get_instance 重新 load），实例被重建（如迁移）时重新初始化
+        """
+        if not self.toolkit or not self.controller:
+            await self.initialize()
+            return
+        store = await MilvusClientManager.get_instance(
+            self.user_id,
+            self.kb_id,
+            self.milvus_uri,
+            self.milvus_token,
+            get_embedding_instance(self.embedding_config)
+        )
+        if store is not self.vector_store:
+            logger.info("♻️ 知识库实例已变化，重新初始化")
+            await self.initialize()
+
+    def _remember_files(self, all_docs: Dict[int, Document]):
+        """记录本轮检索涉及的文件，最多保留 MAX_SESSION_FILES 个（最近使用的在后）"""
+        for doc_id, doc in all_docs.items():
+            self.session_files.pop(doc_id, None)
+            self.session_files[doc_id] = doc
+        while len(self.session_files) > MAX_SESSION_FILES:
+            self.session_files.popitem(last=False)
+
     async def initialize(self):
         """异步初始化"""
         # 获取embedding实例
@@ -73,13 +116,27 @@ class AgenticRAGService:
         if not self.vector_store:
             raise RuntimeError("无法连接到Milvus知识库")
 
-        # 初始化retriever
+        # 初始化retriever（混合检索 collection 使用 RRF 融合）
+        capabilities = MilvusClientManager.get_capabilities(self.user_id, self.kb_id)
         retriever = self.vector_store.as_retriever(
-            search_kwargs={"k": 10}
+            search_kwargs=capabilities.search_kwargs(10)
         )
 
+        # 不支持 Milvus 全文检索的 collection 使用本地倒排索引替代 LIKE 扫描
+        keyword_index = None
+        if capabilities.needs_keyword_index:
+            keyword_index = KeywordIndexManager.get_index(self.user_id, self.kb_id)
+            keyword_index.ensure_built(self.vector_store, capabilities.has_file_name)
+
         # 初始化工具集
-        self.toolkit = RetrievalToolkit(self.vector_store, retriever)
+        self.toolkit = RetrievalToolkit(
+            self.vector_store,
+            retriever,
+            capabilities,
+            keyword_index,
+            self.chunk_cache,
+            MilvusClientManager.collection_key(self.user_id, self.kb_id),
+        )
 
         # 初始化决策控制器
         self.controller = RetrievalController()
@@ -173,11 +230,101 @@ class AgenticRAGService:
                 "description": f"使用工具检索到了 {retrieved} 个文档切片，去重后新增 {new_added} 个文档切片，当前累计 {accumulated} 个文档切片"
             }
 
+    def _merge_tool_result(
+            self,
+            tool: str,
+            tool_result: Dict[str, Any],
+            round_no: int,
+            reference_docs: Dict[str, Document],
+            all_docs: Dict[int, Document],
+    ) -> Dict[str, Any]:
+        """将一次工具调用的结果合并到 reference_docs（按pk去重）与 all_docs，返回格式化结果"""
+        new_docs = tool_result["results"]
+        before_count = len(reference_docs)
+
+        # list_filename_by_like 只返回元信息，不加入reference_docs
+        if tool != "list_filename_by_like":
+            for doc in new_docs:
+                pk = doc.metadata.get("pk")
+                if pk and pk not in reference_docs:
+                    doc.metadata["retrieved_round"] = round_no
+                    reference_docs[pk] = doc
+        # 无论是否加入reference_docs，都记录所有遇到的文档信息（直接存Document对象）
+        for doc in new_docs:
+            doc_id = doc.metadata.get("documentId")
+            if doc_id and doc_id not in all_docs:
+                # 创建一个轻量级Document对象（只保留metadata，不保留page_content节省内存）
+                all_docs[doc_id] = Document(
+                    page_content="",
+                    metadata={
+                        "fileName": doc.metadata.get("fileName"),
+                        "documentId": doc.metadata.get("documentId"),
+                        "maxChunkIndex": doc.metadata.get("maxChunkIndex"),
+                    }
+                )
+
+        after_count = len(reference_docs)
+        return self._format_tool_result(
+            tool=tool,
+            tool_result=tool_result,
+            retrieved=len(new_docs),
+            new_added=after_count - before_count,
+            accumulated=after_count
+        )
+
+    @staticmethod
+    def _format_call_process(
+            decision: RetrievalDecision, tool: Optional[str], params: Optional[Dict[str, Any]],
+            formatted_result: Dict[str, Any]
+    ) -> Tuple[str, str]:
+        """构建一次工具调用的 process 描述与内容"""
+        # 统一使用content_parts列表构建content
+        content_parts = []
+
+        # 1. 决策理由
+        if decision.reason:
+            content_parts.append(f"理由: {decision.reason}")
+        # 2. 已有信息
+        if decision.existing_info:
+            content_parts.append(f"已有信息: {decision.existing_info}")
+        # 3. 缺失信息
+        if decision.missing_info:
+            content_parts.append(f"缺失信息: {decision.missing_info}")
+        # 4. 工具名称
+        content_parts.append(f"工具: {tool}")
+        # 5. 调用参数
+        params_str = json.dumps(params, ensure_ascii=False, indent=2)
+        content_parts.append(f"参数: {params_str}")
+        # 6. 执行结果（根据工具类型格式化）
+        if formatted_result.get("type") == "file_list":
+            # 文件列表工具
+            total_files = formatted_result.get('total_files', 0)
+            description = f"列出 {total_files} 个文件"
+            content_parts.append(f"结果: 列出 {total_files} 个文件")
+        elif formatted_result.get("type") == "document_retrieval":
+            # 文档检索工具
+            retrieved = formatted_result.get('retrieved', 0)
+            new_added = formatted_result.get('new_added', 0)
+            accumulated = formatted_result.get('accumulated', 0)
+            description = f"检索 {retrieved} 个，新增 {new_added} 个，累计 {accumulated} 个"
+            content_parts.append(f"结果: 检索 {retrieved} 个，新增 {new_added} 个，累计 {accumulated} 个")
+        elif formatted_result.get("type") == "error":
+            # 错误情况
+            description = "error"
+            content_parts.append(f"执行工具时出错: {formatted_result.get('description')}")
+        else:
+            description = "执行完成"
+            content_parts.append(f"工具执行结果: {json.dumps(formatted_result, ensure_ascii=False)}")
+
+        content_parts = ["```"] + content_parts + ["```"]
+        return description, "\n".join(content_parts)
+
     async def retrieve_with_process(
             self,
             question: str,
             history: Optional[list] = None,
-            max_rounds: int = 20
+            max_rounds: int = 20,
+            budget: Optional[RetrievalBudget] = None,
     ):
         """
         Agentic检索主流程（生成器版本，yield process信息）
@@ -186,25 +333,52 @@ class AgenticRAGService:
             question: 用户问题
             history: 对话历史
             max_rounds: 最大检索轮次
+            budget: 轮次预算（无增量、超时时提前停止），未传入时不提前停止，只受 max_rounds 限制
 
         Yields:
             process信息字典或最终结果
         """
         history = history or []
+        budget = budget or RetrievalBudget()
+        budget.start()
 
-        if not self.toolkit or not self.controller:
-            await self.initialize()
+        await self.ensure_ready()
 
         all_docs: Dict[int, Document] = {}  # 收集检索过程中遇到的所有文档，key为documentId
         reference_docs: Dict[str, Document] = {}  # 收集用于回答的参考文档，key为pk
         trace = []
+        # 控制器对话在各轮之间保持，每轮只追加增量
+        conversation = self.controller.start_conversation(question, history, list(self.session_files.values()))
 
         for round_no in range(1, max_rounds + 1):
+            # 预算用尽时不再请求控制器决策，直接基于已有文档作答
+            stop_reason = budget.exhausted() if round_no > 1 else None
+            if stop_reason:
+                logger.info(f"⏹️ 提前停止检索: {stop_reason}")
+                trace.append({
+                    "round": round_no,
+                    "tool": None,
+                    "params": None,
+                    "result": None,
+                    "decision": {"action": "stop", "reason": stop_reason}
+                })
+                yield {
+                    "type": "process",
+                    "payload": {
+                        "step": f"round_{round_no}",
+                        "title": "停止检索",
+                        "description": "提前结束检索",
+                        "content": "\n".join(["```", f"理由: {stop_reason}", "```"]),
+                        "status": "completed"
+                    }
+                }
+                break
+
             logger.info(f"\n📍 第{round_no}轮")
+            budget.begin_round()
 
             decision = await self.controller.decide_next_action(
-                question=question,
-                history=history,
+                conversation=conversation,
                 reference_docs=list(reference_docs.values()),
                 trace=trace,
                 current_round=round_no,
@@ -216,6 +390,8 @@ class AgenticRAGService:
                 logger.info(f"⏹️ 决策停止: {decision.reason}")
                 trace.append({
                     "round": round_no,
+                    "tool": None,
+                    "params": None,
                     "result": None,
                     "decision": decision.model_dump()
                 })
@@ -240,109 +416,67 @@ class AgenticRAGService:
                     }
                 }
                 break
-            try:
-                tool_result = await self.toolkit.execute_tool(decision.tool, decision.params)
-                new_docs = tool_result["results"]
-                before_count = len(reference_docs)
-
-                # list_filename_by_like 只返回元信息，不加入reference_docs
-                if decision.tool != "list_filename_by_like":
-                    for doc in new_docs:
-                        pk = doc.metadata.get("pk")
-                        if pk and pk not in reference_docs:
-                            doc.metadata["retrieved_round"] = round_no
-                            reference_docs[pk] = doc
-                # 无论是否加入reference_docs，都记录所有遇到的文档信息（直接存Document对象）
-                for doc in new_docs:
-                    doc_id = doc.metadata.get("documentId")
-                    if doc_id and doc_id not in all_docs:
-                        # 创建一个轻量级Document对象（只保留metadata，不保留page_content节省内存）
-                        all_docs[doc_id] = Document(
-                            page_content="",
-                            metadata={
-                                "fileName": doc.metadata.get("fileName"),
-                                "documentId": doc.metadata.get("documentId"),
-                                "maxChunkIndex": doc.metadata.get("maxChunkIndex"),
-                            }
-                        )
-
-                after_count = len(reference_docs)
-                new_added = after_count - before_count
-
-                logger.info(f"📊 本轮新增: {new_added}, 累积总数: {after_count}")
-
-                formatted_result = self._format_tool_result(
-                    tool=decision.tool,
-                    tool_result=tool_result,
-                    retrieved=len(new_docs),
-                    new_added=new_added,
-                    accumulated=after_count
-                )
-                if new_added == 0:
-                    logger.warning(f"⚠️ 本轮无新增文档")
-            except Exception as e:
-                formatted_result = {
-                    "type": "error",
-                    "description": str(e)
-                }
-
-            trace.append({
-                "round": round_no,
-                "result": formatted_result,
-                "decision": decision.model_dump()
-            })
-
-            # yield每一轮的process信息
-            # 统一使用content_parts列表构建content
-            content_parts = []
-
-            # 1. 决策理由
-            if decision.reason:
-                content_parts.append(f"理由: {decision.reason}")
-            # 2. 已有信息
-            if decision.existing_info:
-                content_parts.append(f"已有信息: {decision.existing_info}")
-            # 3. 缺失信息
-            if decision.missing_info:
-                content_parts.append(f"缺失信息: {decision.missing_info}")
-            # 4. 工具名称
-            content_parts.append(f"工具: {decision.tool}")
-            # 5. 调用参数
-            params_str = json.dumps(decision.params, ensure_ascii=False, indent=2)
-            content_parts.append(f"参数: {params_str}")
-            # 6. 执行结果（根据工具类型格式化）
-            if formatted_result.get("type") == "file_list":
-                # 文件列表工具
-                total_files = formatted_result.get('total_files', 0)
-                description = f"列出 {total_files} 个文件"
-                content_parts.append(f"结果: 列出 {total_files} 个文件")
-            elif formatted_result.get("type") == "document_retrieval":
-                # 文档检索工具
-                retrieved = formatted_result.get('retrieved', 0)
-                new_added = formatted_result.get('new_added', 0)
-                accumulated = formatted_result.get('accumulated', 0)
-                description = f"检索 {retrieved} 个，新增 {new_added} 个，累计 {accumulated} 个"
-                content_parts.append(f"结果: 检索 {retrieved} 个，新增 {new_added} 个，累计 {accumulated} 个")
-            elif formatted_result.get("type") == "error":
-                # 错误情况
-                description = "error"
-                content_parts.append(f"执行工具时出错: {formatted_result.get('description')}")
-            else:
-                description = "执行完成"
-                content_parts.append(f"工具执行结果: {json.dumps(formatted_result, ensure_ascii=False)}")
+            calls = decision.tool_calls[:MAX_TOOL_CALLS]
+            if len(decision.tool_calls) > MAX_TOOL_CALLS:
+                logger.warning(f"⚠️ 本轮工具调用 {len(decision.tool_calls)} 个，超出上限，仅执行前 {MAX_TOOL_CALLS} 个")
+
+            # 相互独立的工具调用并行执行，结果按调用顺序合并去重
+            tool_results = await self.toolkit.execute_tools(calls) if calls else []
+            if not calls:
+                tool_results = [ValueError("工具名称和参数不能为空")]
+            round_new_added = 0
+            informative = False
+
+            for call_no, tool_result in enumerate(tool_results, start=1):
+                call = calls[call_no - 1] if calls else None
+                tool = call.tool if call else None
+                params = call.params if call else None
+                if isinstance(tool_result, Exception):
+                    formatted_result = {
+                        "type": "error",
+                        "description": str(tool_result)
+                    }
+                else:
+                    formatted_result = self._merge_tool_result(
+                        tool, tool_result, round_no, reference_docs, all_docs
+                    )
+                    round_new_added += formatted_result.get("new_added", 0)
+                    informative = informative or formatted_result.get("total_files", 0) > 0
 
-            content_parts = ["```"] + content_parts + ["```"] if content_parts else []
+                trace.append({
+                    "round": round_no,
+                    "tool": tool,
+                    "params": params,
+                    "result": formatted_result,
+                    "decision": decision.model_dump()
+                })
 
-            yield {
-                "type": "process",
-                "payload": {
-                    "step": f"round_{round_no}",
-                    "title": decision.tool,
-                    "description": description,
-                    "content": "\n".join(content_parts),
-                    "status": "completed"
+                description, content = self._format_call_process(decision, tool, params, formatted_result)
+                # 单轮多个调用时，每个调用对应一个步骤
+                step = f"round_{round_no}" if len(tool_results) == 1 else f"round_{round_no}_{call_no}"
+                yield {
+                    "type": "process",
+                    "payload": {
+                        "step": step,
+                        "title": tool,
+                        "description": description,
+                        "content": content,
+                        "status": "completed"
+                    }
                 }
-            }
+
+            logger.info(f"📊 第{round_no}轮 {len(tool_results)} 个调用共新增: {round_new_added}, 累积总数: {len(reference_docs)}")
+            if round_new_added == 0:
+                logger.warning(f"⚠️ 本轮无新增文档")
+            budget.end_round(
+                round_no,
+                [d for d in reference_docs.values() if d.metadata.get("retrieved_round") == round_no],
+                informative=informative,
+                missing_info=decision.missing_info
+            )
+
+        logger.info(f"📈 检索轮次统计（用时 {budget.elapsed:.1f}s）: {json.dumps(budget.rounds, ensure_ascii=False)}")
+        self._remember_files(all_docs)
 
         # 最终结果
         yield {
@@ -350,7 +484,7 @@ class AgenticRAGService:
             "payload": {
                 "reference_documents": list(reference_docs.values()),
                 "trace": trace,
-                "total_rounds": len(trace),
+                "total_rounds": trace[-1]["round"] if trace else 0,
                 "all_documents": sorted(all_docs.values(), key=lambda d: d.metadata.get("fileName", ""))  # 按文件名排序
             }
         }
@@ -387,6 +521,24 @@ class AgenticRAGService:
         all_documents = []
         all_docs_table = ""
 
+        # 回答模型与对话消息不依赖检索结果，提前准备；流水线模式（pipelinedAnswer，默认开启）下同时预热
+        # 到模型服务的连接，检索结束后即可开始生成。只影响延迟，检索何时停止由 RetrievalBudget 决定
+        llm = get_official_llm(
+            model_info,
+            enable_web_search=options.get('webSearch', False) if options else False,
+            enable_thinking=options.get('thinking', False) if options else False
+        )
+        history_messages = []
+        for msg in history:
+            if isinstance(msg, HumanMessage):
+                history_messages.append({"role": "user", "content": msg.content})
+            elif isinstance(msg, AIMessage):
+                history_messages.append({"role": "assistant", "content": msg.content})
+        if options.get('pipelinedAnswer', True) if options else True:
+            warmup_task = asyncio.create_task(llm.warmup())
+            _background_tasks.add(warmup_task)
+            warmup_task.add_done_callback(_background_tasks.discard)
+
         # 执行Agentic RAG流程
         try:
             logger.info("开始Agentic检索流程...")
@@ -404,7 +556,8 @@ class AgenticRAGService:
             async for item in self.retrieve_with_process(
                     question=question,
                     history=history,
-                    max_rounds=max_rounds
+                    max_rounds=max_rounds,
+                    budget=RetrievalBudget.from_options(options)
             ):
                 # 直接转发 retrieve_with_process 产生的 process 事件
 
@@ -527,21 +680,68 @@ class AgenticRAGService:
         }
 
         # 构建对话消息
-        conversation = [{"role": "system", "content": final_system_prompt}]
-        for msg in history:
-            if isinstance(msg, HumanMessage):
-                conversation.append({"role": "user", "content": msg.content})
-            elif isinstance(msg, AIMessage):
-                conversation.append({"role": "assistant", "content": msg.content})
+        conversation = [{"role": "system", "content": final_system_prompt}, *history_messages]
         # 添加当前问题
         conversation.append({"role": "user", "content": question})
 
-        llm = get_official_llm(
-            model_info,
-            enable_web_search=options.get('webSearch', False) if options else False,
-            enable_thinking=options.get('thinking', False) if options else False
-        )
-
         # 使用异步流式生成
         async for item in unified_llm_stream(llm, conversation):
             yield item
+
+
+# ============= 会话级状态 =============
+class AgenticSessionStore:
+    """
+    会话级 Agentic RAG 状态
+    同一会话的后续提问通常围绕相同的文件，按 (会话, 知识库) 复用已初始化的服务：
+    - 工具集、retriever、控制器 LLM 客户端无需重建
+    - 切片邻域缓存保留上一轮读取过的切片
+    - 上一轮涉及的文件列表提供给控制器，可直接使用文件级工具，无需重新发现
+
+    条目在 TTL 内未被使用即失效（每次使用后重新计时），总数超过 MAX_SESSIONS 时淘汰最久未使用的会话；
+    知识库版本号变化（文档入库、删除、迁移，各 worker 通过 MQ 广播同步）后旧状态不再复用
+
+    服务带有会话文件、切片邻域缓存等可变状态，每个会话配一把锁，请求期间独占使用；
+    同一会话的并发请求（重复提交、多个标签页）不排队等待，改用本次请求独立的服务
+    """
+
+    MAX_SESSIONS = 128
+    TTL = 30 * 60  # 30 分钟
+    # 单个会话切片邻域缓存的最大切片数
+    SESSION_CACHE_CHUNKS = 1024
+
+    # (会话标识, collection) -> (知识库版本号, AgenticRAGService, asyncio.Lock)
+    _sessions = LRUCache("agentic_session", maxsize=MAX_SESSIONS, ttl=TTL)
+
+    @classmethod
+    @asynccontextmanager
+    async def acquire(cls, session_key: Optional[str], user_id: int, kb_id: int) -> AsyncIterator[AgenticRAGService]:
+        """在请求期间独占会话对应的服务，无会话标识或会话正被占用时使用本次请求独立的服务"""
+        if not session_key:
+            yield AgenticRAGService(user_id=user_id, kb_id=kb_id)
+            return
+
+        collection_key = MilvusClientManager.collection_key(user_id, kb_id)
+        version = CollectionVersionRegistry.get(collection_key)
+        key = (session_key, collection_key)
+        entry = cls._sessions.get(key)
+        if entry is not None and entry[0] == version:
+            _, service, lock = entry
+        else:
+            service = AgenticRAGService(
+                user_id=user_id,
+                kb_id=kb_id,
+                chunk_cache=ChunkNeighborhoodCache(max_chunks=cls.SESSION_CACHE_CHUNKS),
+            )
+            lock = asyncio.Lock()
+
+        if lock.locked():
+            logger.info(f"⏳ 会话状态正被并发请求使用，本次请求使用独立状态: {session_key}")
+            yield AgenticRAGService(user_id=user_id, kb_id=kb_id)
+            return
+
+        async with lock:
+            if entry is not None and entry[1] is service:
+                logger.info(f"♻️ 复用会话状态: {session_key}, 已知文件 {len(service.session_files)} 个")
+            cls._sessions.set(key, (version, service, lock))
+            yield service
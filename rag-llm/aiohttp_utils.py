@@ -1,19 +1,33 @@
 import asyncio
+import hashlib
 import logging
 from typing import Optional
 
-import aiohttp
-
+from cache_utils import LRUCache
+from rerank_backends import get_rerank_backend
 from utils import _load_config_cached
 
 logger = logging.getLogger(__name__)
 
+# 单个 rerank 分片的字符预算与文档数上限
+RERANK_SHARD_CHARS = 16000
+RERANK_SHARD_DOCS = 20
+
+# rerank 分数缓存：相同 (模型, 指令, 查询, 文档内容) 的分数不随时间变化，TTL 仅用于控制内存占用
+_rerank_score_cache = LRUCache("rerank_score", maxsize=20000, ttl=60 * 60)
+
+
+def _score_key(model_name: str, instruction: Optional[str], query: str, document: str) -> tuple:
+    # rerank 模型对大小写、全半角敏感，按原始查询作为 key
+    doc_hash = hashlib.blake2b(document.encode("utf-8"), digest_size=16).digest()
+    return model_name, instruction, query, doc_hash
+
 
 async def rerank(
         query: str,
         documents: list[str],
-        provider: str = "qwen",
-        model_name: str = "qwen3-rerank",
+        provider: Optional[str] = None,
+        model_name: Optional[str] = None,
         grade_top_n: Optional[int] = None,
         return_documents: bool = True,
         grade_score_threshold: Optional[float] = None
@@ -24,8 +38,8 @@ async def rerank(
     Args:
         query: 查询文本
         documents: 待排序的文档列表
-        provider: 服务提供商，默认"qwen"
-        model_name: 模型名称，默认"qwen3-rank"
+        provider: 服务提供商，None 时使用配置中的 rerank.default_provider（默认"qwen"）
+        model_name: 模型名称，None 时使用该 provider 的默认模型
         grade_top_n: 返回前N个文档，None则返回全部
         return_documents: 是否返回文档内容
         grade_score_threshold: 相关性分数阈值（斩杀线），低于此分数的文档将被过滤，默认None（不过滤）
@@ -66,93 +80,111 @@ async def rerank(
         return {"results": []}
 
     config = _load_config_cached()
-
+    backend = get_rerank_backend(config['rerank'], provider, model_name)
+    # 候选集超出后端上限时（如 CPU onnx 后端）改用配置的 fallback 后端
+    if backend.max_documents and len(documents) > backend.max_documents and backend.fallback_provider:
+        logger.info(
+            f"Rerank 候选集 {len(documents)} 超出 {backend.model_name} 上限 {backend.max_documents}，"
+            f"改用 {backend.fallback_provider}"
+        )
+        backend = get_rerank_backend(config['rerank'], backend.fallback_provider)
+
+    # 先查分数缓存，只把未缓存的文档发给 rerank 服务
+    score_keys = [_score_key(backend.model_name, backend.instruction, query, doc) for doc in documents]
+    all_results = []
+    pending = []
+    for i, key in enumerate(score_keys):
+        score = _rerank_score_cache.get(key)
+        if score is None:
+            pending.append(i)
+        else:
+            all_results.append({"index": i, "relevance_score": score})
+    if all_results:
+        logger.info(f"Rerank 分数缓存命中 {len(all_results)}/{len(documents)} 个文档")
+
+    # 候选集较大时按字符预算分片并发请求，单个慢请求不再拖住整批
+    shards = _shard_documents([documents[i] for i in pending])
+    shards = [[pending[j] for j in shard] for shard in shards]
+    if len(shards) > 1:
+        logger.info(f"Rerank 分片并发: {len(pending)} 个文档 -> {len(shards)} 个分片")
+
+    async def request_shard(indices: list[int]) -> tuple[list[int], list[dict], int]:
+        items, tokens = await backend.score(query, [documents[i] for i in indices])
+        return indices, items, tokens
+
+    tasks = [asyncio.create_task(request_shard(indices)) for indices in shards]
     try:
-        rerank_config = config['rerank'][provider]
-        model_config = rerank_config.get(model_name, {})
-        settings = rerank_config.get('settings', {})
-
-        endpoint = model_config.get('endpoint')
-        api_key = settings.get('api_key')
-
-        if not endpoint:
-            raise ValueError(f"未找到模型 {model_name} 的 endpoint 配置")
-        if not api_key:
-            raise ValueError(f"未找到 {provider} 的 api_key 配置")
-
-    except KeyError as e:
-        logger.error(f"配置错误: {e}")
-        raise ValueError(f"无效的rerank配置: provider={provider}, model={model_name}")
-
-    # 构建请求体 - 请求所有文档的排序结果
-    payload = {
-        "model": model_name,
-        "input": {
-            "query": query,
-            "documents": documents
-        },
-        "parameters": {
-            "return_documents": return_documents
-            # 不在这里设置top_n，让API返回所有文档的排序结果
-        }
-    }
+        # 分片结果按完成顺序合并，索引映射回原始文档位置
+        total_tokens = 0
+        for finished in asyncio.as_completed(tasks):
+            indices, items, tokens = await finished
+            for item in items:
+                item["index"] = indices[item["index"]]
+                _rerank_score_cache.set(score_keys[item["index"]], item["relevance_score"])
+                all_results.append(item)
+            total_tokens += tokens
+    except Exception:
+        for task in tasks:
+            task.cancel()
+        raise
+
+    if return_documents:
+        for item in all_results:
+            item["document"] = {"text": documents[item["index"]]}
 
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
+    all_results.sort(key=lambda item: item.get("relevance_score", 0), reverse=True)
+    result = {
+        "output": {"results": all_results},
+        "usage": {"total_tokens": total_tokens},
     }
 
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                    endpoint,
-                    json=payload,
-                    headers=headers,
-            ) as response:
-                if response.status != 200:
-                    error_text = await response.text()
-                    logger.error(f"Rerank API 错误: {response.status}, {error_text}")
-                    raise RuntimeError(f"Rerank API 请求失败: {response.status}")
-
-                result = await response.json()
-
-                # 在本地应用过滤逻辑
-                all_results = result.get("output", {}).get("results", [])
-                filtered_results = all_results
-
-                # 1. 应用分数阈值过滤（斩杀线）
-                if grade_score_threshold is not None:
-                    original_count = len(all_results)
-                    filtered_results = [
-                        item for item in all_results
-                        if item.get("relevance_score", 0) >= grade_score_threshold
-                    ]
-
-                    if len(filtered_results) < original_count:
-                        logger.info(
-                            f"应用斩杀线 {grade_score_threshold}：过滤掉 {original_count - len(filtered_results)} 个低分文档，"
-                            f"保留 {len(filtered_results)} 个高质量文档"
-                        )
-
-                # 2. 应用top_n限制
-                if grade_top_n is not None and len(filtered_results) > grade_top_n:
-                    filtered_results = filtered_results[:grade_top_n]
-                    logger.info(f"应用top_n={grade_top_n}：返回前 {grade_top_n} 个文档")
-
-                # 更新结果
-                result["output"]["results"] = filtered_results
-
-                logger.info(
-                    f"重排序完成，处理了 {len(documents)} 个文档，"
-                    f"返回 {len(filtered_results)} 个结果"
-                )
-                return result
-    except asyncio.TimeoutError:
-        logger.error("Rerank API 请求超时")
-        raise RuntimeError("Rerank API 请求超时")
-    except aiohttp.ClientError as e:
-        logger.error(f"Rerank API 网络错误: {e}")
-        raise RuntimeError(f"Rerank API 网络错误: {str(e)}")
-    except Exception as e:
-        logger.error(f"Rerank 处理失败: {e}")
-        raise
+    # 在本地应用过滤逻辑
+    filtered_results = all_results
+
+    # 1. 应用分数阈值过滤（斩杀线）
+    if grade_score_threshold is not None:
+        original_count = len(all_results)
+        filtered_results = [
+            item for item in all_results
+            if item.get("relevance_score", 0) >= grade_score_threshold
+        ]
+
+        if len(filtered_results) < original_count:
+            logger.info(
+                f"应用斩杀线 {grade_score_threshold}：过滤掉 {original_count - len(filtered_results)} 个低分文档，"
+                f"保留 {len(filtered_results)} 个高质量文档"
+            )
+
+    # 2. 应用top_n限制
+    if grade_top_n is not None and len(filtered_results) > grade_top_n:
+        filtered_results = filtered_results[:grade_top_n]
+        logger.info(f"应用top_n={grade_top_n}：返回前 {grade_top_n} 个文档")
+
+    # 更新结果
+    result["output"]["results"] = filtered_results
+
+    logger.info(
+        f"重排序完成，处理了 {len(documents)} 个文档，"
+        f"返回 {len(filtered_results)} 个结果"
+    )
+    return result
+
+
+def _shard_documents(
+        documents: list[str],
+        max_chars: int = RERANK_SHARD_CHARS,
+        max_docs: int = RERANK_SHARD_DOCS
+) -> list[list[int]]:
+    """按字符预算与文档数将候选集顺序切分为若干分片，返回每个分片的原始索引"""
+    shards = []
+    current = []
+    current_chars = 0
+    for i, doc in enumerate(documents):
+        if current and (current_chars + len(doc) > max_chars or len(current) >= max_docs):
+            shards.append(current)
+            current, current_chars = [], 0
+        current.append(i)
+        current_chars += len(doc)
+    if current:
+        shards.append(current)
+    return shards
@@ -0,0 +1,177 @@
+"""
+进程内缓存工具
+- LRUCache: 容量受限的 LRU 缓存（可选 TTL），带命中统计
+- CollectionVersionRegistry: 知识库 collection 版本号，入库 / 删除 / 迁移后递增，使相关缓存精确失效
+- RetrievalCache: 检索结果缓存，key 为 (collection, 版本号, 检索类型, 查询, top_k, 参数)
+"""
+import logging
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional
+
+from langchain_core.documents import Document
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    线程安全的 LRU 缓存
+    - maxsize: 最大条目数，超出后淘汰最久未使用的条目
+    - ttl: 条目存活秒数，None 表示不过期
+    """
+
+    # 每隔多少次查询输出一次统计
+    LOG_INTERVAL = 1000
+
+    def __init__(self, name: str, maxsize: int = 1024, ttl: Optional[float] = None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key, _MISSING)
+            if item is not _MISSING and self.ttl is not None and time.monotonic() - item[0] > self.ttl:
+                del self._data[key]
+                item = _MISSING
+            if item is _MISSING:
+                self.misses += 1
+                value = default
+            else:
+                self._data.move_to_end(key)
+                self.hits += 1
+                value = item[1]
+            lookups = self.hits + self.misses
+        if lookups % self.LOG_INTERVAL == 0:
+            logger.info(f"[Cache:{self.name}] {self.stats()}")
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+class CollectionVersionRegistry:
+    """
+    collection 版本号
+    文档入库、删除与 collection 迁移后递增，缓存 key 中包含版本号，旧条目自然失效。
+    版本号保存在进程内，各 worker 通过 MQ 广播（mq/collection_events.py）同步递增：
+    写入方发布变更，每个 worker 独立订阅，rag-server 删除文档时同样发布
+    """
+
+    _versions: Dict[str, int] = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(cls, collection_key: str) -> int:
+        return cls._versions.get(collection_key, 0)
+
+    @classmethod
+    def bump(cls, collection_key: str) -> int:
+        with cls._lock:
+            version = cls._versions.get(collection_key, 0) + 1
+            cls._versions[collection_key] = version
+        logger.info(f"[Cache] collection version bumped: {collection_key} -> {version}")
+        return version
+
+
+def normalize_query(query: str) -> str:
+    """查询归一化：全半角统一、大小写折叠、空白合并"""
+    query = unicodedata.normalize("NFKC", query).casefold()
+    return re.sub(r"\s+", " ", query).strip()
+
+
+def _copy_docs(docs: List[Document]) -> List[Document]:
+    # 调用方会改写 metadata（rerank_score 等），缓存内外各持独立副本
+    return [Document(page_content=d.page_content, metadata=dict(d.metadata)) for d in docs]
+
+
+class RetrievalCache:
+    """
+    检索结果缓存
+    版本号在所有 worker 间广播同步，入库与删除后精确失效；
+    TTL 只兜底 MQ 重连期间错过的广播
+
+    版本号由调用方在检索开始时读取，get 与 put 使用同一个版本：
+    检索期间发生入库时，旧结果写入旧版本的 key，不会冒充新版本
+
+    归一化查询只用于纯向量检索。关键词类检索（LIKE / 倒排子串校验）区分大小写且按空格切分关键词，
+    "API" 与 "api"、多余空格都会匹配不同的行，这些类型按原始查询作为 key
+    """
+
+    MAX_ENTRIES = 2048
+    TTL = 10 * 60  # 10 分钟
+    # 结果依赖原始查询字面值的检索类型
+    EXACT_QUERY_KINDS = frozenset({"keyword", "toolkit_vector"})
+
+    _cache = LRUCache("retrieval", maxsize=MAX_ENTRIES, ttl=TTL)
+
+    @classmethod
+    def _key(cls, collection_key: str, version: int, kind: str, query: str, top_k: int, params: Optional[dict]) -> tuple:
+        return (
+            collection_key,
+            version,
+            kind,
+            query if kind in cls.EXACT_QUERY_KINDS else normalize_query(query),
+            top_k,
+            tuple(sorted((params or {}).items())),
+        )
+
+    @classmethod
+    def get(
+            cls,
+            collection_key: str,
+            version: int,
+            kind: str,
+            query: str,
+            top_k: int,
+            params: Optional[dict] = None
+    ) -> Optional[List[Document]]:
+        docs = cls._cache.get(cls._key(collection_key, version, kind, query, top_k, params))
+        return _copy_docs(docs) if docs is not None else None
+
+    @classmethod
+    def put(
+            cls,
+            collection_key: str,
+            version: int,
+            kind: str,
+            query: str,
+            top_k: int,
+            docs: List[Document],
+            params: Optional[dict] = None
+    ):
+        cls._cache.set(cls._key(collection_key, version, kind, query, top_k, params), _copy_docs(docs))
+
+    @classmethod
+    def stats(cls) -> Dict[str, Any]:
+        return cls._cache.stats()
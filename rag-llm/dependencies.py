@@ -4,7 +4,9 @@ from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
 
+from http_client_utils import HttpClientManager
 from milvus_utils import MilvusClientManager
+from mq.collection_events import COLLECTION_CHANGE_EXCHANGE, collection_change_consumer
 from mq.connection import rabbit_async_client
 from mq.document_embedding import document_embedding_consumer
 
@@ -17,6 +19,9 @@ async def app_lifespan(app: FastAPI):
 
     consume_background_tasks = []
 
+    # 出站 HTTP 连接池（rerank / gemini 等共享）
+    await HttpClientManager.open()
+
     # RabbitMQ
     await rabbit_async_client.connect()
 
@@ -32,6 +37,15 @@ async def app_lifespan(app: FastAPI):
                 )
             )
         )
+        # 知识库变更广播：每个 worker 独立订阅，同步 collection 版本号
+        consume_background_tasks.append(
+            asyncio.create_task(
+                rabbit_async_client.subscribe_fanout(
+                    exchange_name=COLLECTION_CHANGE_EXCHANGE,
+                    callback=collection_change_consumer.on_receive_message
+                )
+            )
+        )
 
         yield
 
@@ -53,3 +67,6 @@ async def app_lifespan(app: FastAPI):
 
         # 关闭 MQ
         await rabbit_async_client.close()
+
+        # 关闭出站 HTTP 连接池
+        await HttpClientManager.close_all()
@@ -0,0 +1,204 @@
+"""
+RAG Gateway 本地预分类器
+
+在调用 LLM 判断之前先做两级本地判断，只有无法确定的问题才交给 LLM：
+1. 规则：问候、致谢、身份类元问题（仅在没有对话历史时）、针对上一轮回答的明确格式调整（需有对话历史）
+   → direct_answer；明确提到文档 / 资料 / 知识库等 → use_rag。纯正则匹配，微秒级。
+   "继续"、"好的" 等在已有检索上下文时可能需要继续检索，不由规则判断
+2. 近邻投票：历史上由 LLM 做出的网关决策记录在 GATEWAY_DECISION_LOG（JSONL）中，
+   启动后在后台向量化并加载到内存；新问题与最相似的若干条记录标签一致且相似度足够高时直接采用。
+   有无对话历史时同一问题的判断可能不同，只在同类（有历史 / 无历史）记录中投票
+
+规则与近邻判断的结果不写回决策日志，避免分类器自我强化
+
+决策日志保存用户问题原文：按 GATEWAY_DECISION_LOG_MAX_BYTES 轮转（保留一个 .1 备份），
+GATEWAY_DECISION_LOG 设为空字符串时不落盘，只保留进程内样本
+"""
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import re
+import threading
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from semantic_cache_utils import embed_texts
+
+logger = logging.getLogger(__name__)
+
+DECISION_LOG_PATH = os.environ.get("GATEWAY_DECISION_LOG", "./gateway_decisions.jsonl")
+# 决策日志单个文件的大小上限，超出后轮转为 .1 备份（旧备份被覆盖）
+DECISION_LOG_MAX_BYTES = int(os.environ.get("GATEWAY_DECISION_LOG_MAX_BYTES", str(8 * 1024 * 1024)))
+
+_END = r"[\s!！。.~～?？,，]*$"
+
+# 问候 / 致谢 / 身份类元问题：只在没有对话历史时直接回答
+# "好的"、"明白了" 等简短确认不在其中，已有检索上下文时它们往往引出下一步追问
+_SMALL_TALK_PATTERNS = [
+    re.compile(r"^(你好|您好|嗨|哈喽|hi|hello|hey|早上好|中午好|下午好|晚上好|早安|晚安|在吗|在不在)(呀|啊|哦)?" + _END, re.I),
+    re.compile(r"^(谢谢|多谢|感谢|谢啦|谢了|thanks|thank you|thx)(你|您)?(啦|了|哈)?" + _END, re.I),
+    re.compile(r"^(你是谁|你叫什么(名字)?|你能做什么|你会(做)?什么|你有什么功能|介绍一下(你自己|自己)|who are you|what can you do)" + _END, re.I),
+]
+
+# 针对上一轮回答的格式调整：只有存在对话历史时才成立
+# "继续"、"接着说" 可能需要检索更多内容，不在其中
+_FOLLOW_UP_FORMAT_PATTERNS = [
+    re.compile(r"^(请|帮我|麻烦)?(把(它|这个|上面的?(内容|回答)?|以上(内容)?)?)?(翻译|译)成?(英文|中文|日文|英语|汉语)" + _END),
+    re.compile(r"^(请|帮我|麻烦)?(把(它|这个|上面的?(内容|回答)?|以上(内容)?)?)?用(表格|列表|markdown|代码块)(的?形式)?(展示|列出|输出|呈现|整理|总结)?(一下)?" + _END, re.I),
+    re.compile(r"^(请|帮我|麻烦)?(再)?(说|写|回答)?得?(简短|简洁|精简|通俗|口语化)(一点|一些|点)?" + _END),
+    re.compile(r"^(请|帮我|麻烦)?(总结|概括|归纳)一下(上面|以上|你的回答)(的内容)?" + _END),
+    re.compile(r"^(请)?(换个说法|换一种说法)" + _END),
+    re.compile(r"^(please )?(translate (it|this|that) (in)?to \w+|make it (shorter|simpler)|summari[sz]e (your answer|the above))" + _END, re.I),
+]
+
+# 明确指向知识库内容
+_RAG_KEYWORD_PATTERN = re.compile(
+    r"(文档|资料|知识库|文件|附件|报告|手册|规范|制度|条款|合同|根据.{0,10}(内容|材料)|检索|查一下|"
+    r"\bdocuments?\b|\bfiles?\b|according to the|in the (report|manual|pdf))",
+    re.I,
+)
+
+
+class GatewayPreClassifier:
+    """
+    RAG Gateway 的本地前置分类器
+    classify_by_rules / classify_by_examples 返回 (action, reason)，无法确定时返回 None，由 LLM 判断
+    """
+
+    # 加载的历史决策条数上限（取最近的记录）
+    MAX_EXAMPLES = 5000
+    # 启用近邻投票所需的最少样本数
+    MIN_EXAMPLES = 50
+    # 参与投票的近邻数
+    TOP_K = 5
+    # 最近邻的最低相似度
+    MIN_TOP_SIMILARITY = 0.92
+    # 参与投票的近邻均需达到的相似度
+    MIN_VOTE_SIMILARITY = 0.85
+
+    def __init__(self, log_path: str = DECISION_LOG_PATH):
+        self.log_path = log_path
+        self._vectors = np.empty((0, 0), dtype=np.float32)
+        self._labels = np.empty(0, dtype=bool)  # True 表示 use_rag
+        self._with_history = np.empty(0, dtype=bool)
+        self._lock = threading.Lock()
+        self._load_task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def classify_by_rules(question: str, has_history: bool) -> Optional[Tuple[str, str]]:
+        text = question.strip()
+        if not text:
+            return None
+        if _RAG_KEYWORD_PATTERN.search(text):
+            return "use_rag", "问题明确指向知识库内容（本地规则）"
+        if not has_history:
+            for pattern in _SMALL_TALK_PATTERNS:
+                if pattern.match(text):
+                    return "direct_answer", "问候、致谢或元问题，无需检索（本地规则）"
+            return None
+        for pattern in _FOLLOW_UP_FORMAT_PATTERNS:
+            if pattern.match(text):
+                return "direct_answer", "针对上一轮回答的格式调整，无需检索（本地规则）"
+        return None
+
+    def classify_by_examples(self, embedding: np.ndarray, has_history: bool) -> Optional[Tuple[str, str]]:
+        with self._lock:
+            vectors, labels, with_history = self._vectors, self._labels, self._with_history
+        if len(labels) < self.MIN_EXAMPLES:
+            return None
+
+        same_context = with_history == has_history
+        if same_context.sum() < self.TOP_K:
+            return None
+        vectors, labels = vectors[same_context], labels[same_context]
+        similarities = vectors @ embedding
+        k = self.TOP_K
+        top = np.argpartition(-similarities, k - 1)[:k]
+        if similarities[top].max() < self.MIN_TOP_SIMILARITY or similarities[top].min() < self.MIN_VOTE_SIMILARITY:
+            return None
+        votes = labels[top]
+        if votes.all():
+            return "use_rag", f"与 {k} 条历史决策高度相似（本地近邻）"
+        if not votes.any():
+            return "direct_answer", f"与 {k} 条历史决策高度相似（本地近邻）"
+        return None
+
+    def ensure_loaded(self):
+        """首次使用时在后台加载历史决策，加载完成前只使用规则"""
+        if self._load_task is None:
+            self._load_task = asyncio.create_task(self._load_examples())
+
+    async def _load_examples(self):
+        try:
+            records = await asyncio.to_thread(self._read_log)
+            if not records:
+                return
+            vectors = await embed_texts([r["question"] for r in records])
+            labels = np.array([r["action"] == "use_rag" for r in records], dtype=bool)
+            with_history = np.array([bool(r.get("has_history")) for r in records], dtype=bool)
+            with self._lock:
+                self._vectors = _append(self._vectors, vectors, self.MAX_EXAMPLES)
+                self._labels = np.concatenate([labels, self._labels])[-self.MAX_EXAMPLES:]
+                self._with_history = np.concatenate([with_history, self._with_history])[-self.MAX_EXAMPLES:]
+            logger.info(f"[Gateway] 已加载 {len(labels)} 条历史决策用于本地预分类")
+        except Exception as e:
+            logger.warning(f"[Gateway] 加载历史决策失败，仅使用规则预分类: {e}")
+
+    def _read_log(self) -> List[dict]:
+        if not self.log_path:
+            return []
+        records = []
+        # 轮转备份中的记录较旧，先读
+        for path in (self.log_path + ".1", self.log_path):
+            if not os.path.exists(path):
+                continue
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    if record.get("question") and record.get("action") in ("use_rag", "direct_answer"):
+                        records.append(record)
+        return records[-self.MAX_EXAMPLES:]
+
+    async def record(self, question: str, has_history: bool, embedding: Optional[np.ndarray], action: str):
+        """记录一次 LLM 决策：追加到决策日志，并加入内存样本"""
+        if action not in ("use_rag", "direct_answer"):
+            return
+        if embedding is not None:
+            with self._lock:
+                self._vectors = _append(self._vectors, embedding[None, :], self.MAX_EXAMPLES, at_end=True)
+                self._labels = np.append(self._labels, action == "use_rag")[-self.MAX_EXAMPLES:]
+                self._with_history = np.append(self._with_history, has_history)[-self.MAX_EXAMPLES:]
+        if not self.log_path:
+            return
+        try:
+            record = {"question": question, "has_history": has_history, "action": action}
+            line = json.dumps(record, ensure_ascii=False) + "\n"
+            await asyncio.to_thread(self._append_log, line)
+        except Exception as e:
+            logger.warning(f"[Gateway] 写入决策日志失败: {e}")
+
+    def _append_log(self, line: str):
+        """追加一条记录，超过大小上限时先轮转；多个 worker 共享日志文件，持有文件锁"""
+        with open(self.log_path + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if os.path.exists(self.log_path) and os.path.getsize(self.log_path) >= DECISION_LOG_MAX_BYTES:
+                    os.replace(self.log_path, self.log_path + ".1")
+                with open(self.log_path, "a", encoding="utf-8") as f:
+                    f.write(line)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _append(vectors: np.ndarray, new: np.ndarray, limit: int, at_end: bool = False) -> np.ndarray:
+    """合并向量矩阵并保留最近的 limit 条（日志加载的旧样本在前，运行期新增样本在后）"""
+    if vectors.size == 0:
+        return new[-limit:]
+    merged = np.vstack([vectors, new] if at_end else [new, vectors])
+    return merged[-limit:]
@@ -1,12 +1,13 @@
 import json
 import logging
-from typing import AsyncGenerator
+from typing import AsyncGenerator, Optional
 
 import aiohttp
 from google import genai
 from google.genai import types
 from google.genai.types import ThinkingConfig
 
+from http_client_utils import HttpClientManager
 from wrapper import ResponseWrapper
 
 logger = logging.getLogger(__name__)
@@ -22,6 +23,7 @@ class GeminiInstance:
             enable_thinking: bool = True,
             timeout: int = 30,
             max_retries: int = 2,
+            client: Optional[genai.Client] = None,
     ):
         """
         初始化 Gemini 实例
@@ -29,6 +31,7 @@ class GeminiInstance:
         :param model_name: 模型名称，例如 "gemini-2.0-flash", "gemini-3-pro-preview"
         :param enable_web_search: 是否开启谷歌搜索 (Grounding)
         :param base_url: API 基础地址
+        :param client: 共享的 SDK 客户端（按配置复用连接池），为空时新建
         """
         self.model_name = model_name
         self.enable_thinking = enable_thinking
@@ -41,6 +44,15 @@ class GeminiInstance:
         self.timeout = timeout
 
         # --- SDK 初始化 (保留给 ainvoke 使用) ---
+        self.client = client or self.create_client(api_key, base_url, timeout, max_retries)
+
+        # 预定义搜索工具
+        self.grounding_tool = types.Tool(
+            google_search=types.GoogleSearch()
+        )
+
+    @staticmethod
+    def create_client(api_key: str, base_url: str, timeout: int = 30, max_retries: int = 2) -> genai.Client:
         # 配置 HTTP 选项
         retry_options = types.HttpRetryOptionsDict(attempts=max_retries)
         http_options = types.HttpOptionsDict(
@@ -50,16 +62,11 @@ class GeminiInstance:
         )
 
         # 初始化客户端
-        self.client = genai.Client(
+        return genai.Client(
             api_key=api_key,
             http_options=http_options
         )
 
-        # 预定义搜索工具
-        self.grounding_tool = types.Tool(
-            google_search=types.GoogleSearch()
-        )
-
     def _parse_messages(self, messages: list):
         """
         SDK 专用的消息解析 (供 ainvoke 使用)
@@ -118,6 +125,27 @@ class GeminiInstance:
             logger.error(f"Gemini ainvoke error: {e}")
             return ResponseWrapper(content=f"Error: {str(e)}")
 
+    async def warmup(self):
+        """预先建立到模型服务的连接（astream 使用的共享连接池），失败不影响后续请求"""
+        url = f"{self.base_url}/v1beta/models/{self.model_name}"
+        try:
+            session = await HttpClientManager.get_session(url)
+            async with session.get(url, headers={'Authorization': f'Bearer {self.api_key}'}, timeout=self.timeout) as response:
+                await response.read()
+        except Exception as e:
+            logger.debug(f"Gemini warmup: {e}")
+
+    @staticmethod
+    def _parse_usage(usage_metadata: dict) -> dict:
+        """转换 usageMetadata，输出 token 包含思考 token"""
+        prompt_tokens = usage_metadata.get("promptTokenCount", 0)
+        completion_tokens = usage_metadata.get("candidatesTokenCount", 0) + usage_metadata.get("thoughtsTokenCount", 0)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": usage_metadata.get("totalTokenCount", prompt_tokens + completion_tokens),
+        }
+
     async def astream(self, messages: list) -> AsyncGenerator[ResponseWrapper, None]:
         # 1. 构建 URL
         endpoint = f"/v1beta/models/{self.model_name}:streamGenerateContent?alt=sse"
@@ -173,53 +201,61 @@ class GeminiInstance:
 
         # 3. 发起请求并处理 SSE
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=payload, headers=headers, timeout=self.timeout) as response:
-                    if response.status != 200:
-                        error_text = await response.text()
-                        logger.error(f"Gemini Request Failed [Status: {response.status}]: {error_text}")
-                        yield ResponseWrapper(content=f"Error {response.status}: {error_text}")
-                        return
-
-                    # 高性能流式读取
-                    async for line in response.content:
-                        line = line.strip()
-                        if not line:
+            session = await HttpClientManager.get_session(url)
+            async with session.post(url, json=payload, headers=headers, timeout=self.timeout) as response:
+                if response.status != 200:
+                    error_text = await response.text()
+                    logger.error(f"Gemini Request Failed [Status: {response.status}]: {error_text}")
+                    yield ResponseWrapper(content=f"Error {response.status}: {error_text}")
+                    return
+
+                # usageMetadata 在每个 chunk 中为累计值，以最后一次为准
+                usage = None
+                # 高性能流式读取
+                async for line in response.content:
+                    line = line.strip()
+                    if not line:
+                        continue
+
+                    decoded_line = line.decode('utf-8')
+
+                    # 处理 SSE 数据行
+                    if decoded_line.startswith("data: "):
+                        json_str = decoded_line[6:]  # 去掉 "data: " 前缀
+                        try:
+                            data = json.loads(json_str)
+
+                            if "usageMetadata" in data:
+                                usage = self._parse_usage(data["usageMetadata"])
+
+                            # 提取 candidates
+                            if "candidates" in data and data["candidates"]:
+                                candidate = data["candidates"][0]
+
+                                # 检查是否有内容
+                                if "content" in candidate and "parts" in candidate["content"]:
+                                    parts = candidate["content"]["parts"]
+                                    for part in parts:
+                                        text = part.get("text", "")
+                                        if text == "":
+                                            continue
+                                        is_thought = part.get("thought", False)
+                                        if is_thought:
+                                            # 封装思考内容
+                                            yield ResponseWrapper(content=[{"type": "reasoning", "text": text}])
+                                        else:
+                                            # 普通内容
+                                            yield ResponseWrapper(content=text)
+
+                        except json.JSONDecodeError:
+                            logger.warning(f"Failed to decode JSON chunk: {json_str}")
+                            continue
+                        except Exception as e:
+                            logger.error(f"Error parsing chunk: {e}")
                             continue
 
-                        decoded_line = line.decode('utf-8')
-
-                        # 处理 SSE 数据行
-                        if decoded_line.startswith("data: "):
-                            json_str = decoded_line[6:]  # 去掉 "data: " 前缀
-                            try:
-                                data = json.loads(json_str)
-
-                                # 提取 candidates
-                                if "candidates" in data and data["candidates"]:
-                                    candidate = data["candidates"][0]
-
-                                    # 检查是否有内容
-                                    if "content" in candidate and "parts" in candidate["content"]:
-                                        parts = candidate["content"]["parts"]
-                                        for part in parts:
-                                            text = part.get("text", "")
-                                            if text == "":
-                                                continue
-                                            is_thought = part.get("thought", False)
-                                            if is_thought:
-                                                # 封装思考内容
-                                                yield ResponseWrapper(content=[{"type": "reasoning", "text": text}])
-                                            else:
-                                                # 普通内容
-                                                yield ResponseWrapper(content=text)
-
-                            except json.JSONDecodeError:
-                                logger.warning(f"Failed to decode JSON chunk: {json_str}")
-                                continue
-                            except Exception as e:
-                                logger.error(f"Error parsing chunk: {e}")
-                                continue
+                if usage:
+                    yield ResponseWrapper(content="", usage=usage)
 
         except aiohttp.ClientError as e:
             logger.error(f"Network error in astream: {e}")
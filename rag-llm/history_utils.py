@@ -0,0 +1,177 @@
+"""
+对话历史压缩
+网关、多角度查询、检索控制器等辅助 LLM 调用不需要完整历史，按各自的 token 预算压缩：
+- 最近 KEEP_TURNS 轮已完成的对话原样保留，末尾的当前问题不计入（超出预算时从最早的一条开始移出）
+- 更早的对话替换为滚动摘要。摘要按历史前缀的链式哈希缓存，同一会话的后续轮次与请求直接复用；
+  新的前缀在后台基于上一份摘要增量生成，不阻塞当前请求（生成完成前使用已有的最近一份摘要）
+"""
+import asyncio
+import hashlib
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from cache_utils import LRUCache
+from token_utils import count_message_tokens
+from utils import get_langchain_llm
+
+logger = logging.getLogger(__name__)
+
+# 各调用方的历史 token 预算（含摘要）
+HISTORY_BUDGETS = {
+    "gateway": 1500,
+    "query_generation": 2000,
+    "controller": 3000,
+}
+DEFAULT_BUDGET = 2000
+# 原样保留的最近轮数（一问一答为一轮）
+KEEP_TURNS = 3
+
+SUMMARY_MODEL_INFO = {
+    "name": "deepseek/deepseek-v3.2-251201",
+    "provider": "other"
+}
+
+_SUMMARY_PROMPT = """请将以下对话压缩为一段不超过300字的摘要，供后续轮次理解上下文使用。
+要求：保留用户关注的主题、涉及的文件名 / 实体 / 专有名词、已得出的结论以及尚未解决的问题；不要编造对话中没有的内容；直接输出摘要正文。"""
+
+
+@dataclass
+class CompactedHistory:
+    """压缩后的历史：更早对话的摘要 + 最近若干条原始消息（{role, content}）"""
+    summary: Optional[str] = None
+    messages: List[dict] = field(default_factory=list)
+
+    def to_messages(self) -> List[dict]:
+        """转换为对话消息列表（摘要作为第一条用户消息）"""
+        if not self.summary:
+            return list(self.messages)
+        return [{"role": "user", "content": f"[此前对话摘要] {self.summary}"}] + self.messages
+
+    def to_text(self) -> str:
+        """转换为 "用户: ..." / "助手: ..." 的文本形式"""
+        lines = [f"此前对话摘要: {self.summary}"] if self.summary else []
+        for msg in self.messages:
+            role = "用户" if msg["role"] == "user" else "助手" if msg["role"] == "assistant" else msg["role"]
+            lines.append(f"{role}: {msg['content']}")
+        return "\n".join(lines)
+
+
+def _normalize(history: Optional[list]) -> List[dict]:
+    """字典格式与 LangChain 消息统一为 {role, content}"""
+    messages = []
+    for msg in history or []:
+        if isinstance(msg, dict):
+            role, content = msg.get("role", ""), msg.get("content")
+        else:
+            msg_type = getattr(msg, "type", "")
+            role = "user" if msg_type == "human" else "assistant" if msg_type == "ai" else msg_type
+            content = getattr(msg, "content", "")
+        if not isinstance(content, str):
+            content = str(content or "")
+        messages.append({"role": role, "content": content})
+    return messages
+
+
+def _prefix_hashes(messages: List[dict]) -> List[str]:
+    """hashes[k] 为前 k 条消息的链式哈希（hashes[0] 为空前缀）"""
+    hashes = [""]
+    for msg in messages:
+        h = hashlib.blake2b(digest_size=16)
+        h.update(hashes[-1].encode("ascii"))
+        h.update(msg["role"].encode("utf-8"))
+        h.update(b"\x00")
+        h.update(msg["content"].encode("utf-8"))
+        hashes.append(h.hexdigest())
+    return hashes
+
+
+class HistorySummaryStore:
+    """滚动摘要缓存（key 为历史前缀的链式哈希）"""
+
+    MAX_ENTRIES = 4096
+    TTL = 24 * 3600
+    # 每条消息送入摘要模型的最大字符数
+    MAX_MESSAGE_CHARS = 2000
+
+    _cache = LRUCache("history_summary", maxsize=MAX_ENTRIES, ttl=TTL)
+    _pending: Dict[str, asyncio.Task] = {}
+
+    @classmethod
+    def latest(cls, hashes: List[str], end: int) -> Tuple[Optional[str], int]:
+        """返回前缀长度不超过 end 的最近一份摘要及其前缀长度"""
+        for k in range(end, 0, -1):
+            summary = cls._cache.get(hashes[k])
+            if summary is not None:
+                return summary, k
+        return None, 0
+
+    @classmethod
+    def schedule(cls, messages: List[dict], hashes: List[str], end: int, base_summary: Optional[str], start: int):
+        """后台生成前 end 条消息的摘要（基于前 start 条的摘要增量合并）"""
+        key = hashes[end]
+        if key in cls._pending:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        task = loop.create_task(cls._summarize(key, base_summary, messages[start:end]))
+        cls._pending[key] = task
+        task.add_done_callback(lambda _: cls._pending.pop(key, None))
+
+    @classmethod
+    async def _summarize(cls, key: str, base_summary: Optional[str], messages: List[dict]):
+        parts = [f"已有摘要: {base_summary}"] if base_summary else []
+        parts.extend(
+            f"{'用户' if m['role'] == 'user' else '助手'}: {m['content'][:cls.MAX_MESSAGE_CHARS]}"
+            for m in messages
+        )
+        try:
+            llm = get_langchain_llm(SUMMARY_MODEL_INFO)
+            response = await llm.ainvoke([
+                {"role": "system", "content": _SUMMARY_PROMPT},
+                {"role": "user", "content": "\n".join(parts)},
+            ])
+            summary = response.content if isinstance(response.content, str) else str(response.content)
+            cls._cache.set(key, summary.strip())
+            logger.info(f"[History] 滚动摘要已更新: {len(messages)} 条新消息并入摘要")
+        except Exception as e:
+            logger.warning(f"[History] 生成对话摘要失败: {e}")
+
+
+def compact_history(history: Optional[list], consumer: str) -> CompactedHistory:
+    """
+    按调用方的 token 预算压缩对话历史
+
+    Args:
+        history: 对话历史（字典格式或 LangChain 消息）
+        consumer: 调用方（gateway / query_generation / controller），决定 token 预算
+    """
+    messages = _normalize(history)
+    if not messages:
+        return CompactedHistory()
+    budget = HISTORY_BUDGETS.get(consumer, DEFAULT_BUDGET)
+    counts = count_message_tokens(messages)
+
+    # 1. 最近 KEEP_TURNS 轮原样保留，超出预算时从最早的一条开始移出（至少保留最后一条）
+    #    末尾未得到回答的用户消息是当前问题（如控制器传入的历史），不占用 KEEP_TURNS
+    keep = KEEP_TURNS * 2 + (1 if messages[-1]["role"] == "user" else 0)
+    start = max(0, len(messages) - keep)
+    while start < len(messages) - 1 and sum(counts[start:]) > budget:
+        start += 1
+    recent = messages[start:]
+    if counts[-1] > budget:
+        # 单条消息超出预算时按比例截断（保留开头）
+        content = recent[-1]["content"]
+        recent[-1] = {"role": recent[-1]["role"], "content": content[:len(content) * budget // counts[-1]]}
+
+    if start == 0:
+        return CompactedHistory(messages=recent)
+
+    # 2. 更早的对话使用滚动摘要
+    hashes = _prefix_hashes(messages[:start])
+    summary, covered = HistorySummaryStore.latest(hashes, start)
+    if covered < start:
+        HistorySummaryStore.schedule(messages, hashes, start, summary, covered)
+    return CompactedHistory(summary=summary, messages=recent)
@@ -0,0 +1,87 @@
+"""
+出站 HTTP 连接池管理
+- 按目标地址（scheme://host:port）复用 aiohttp.ClientSession，保持 keep-alive 连接
+- 统一配置连接 / 读取超时（环境变量 HTTP_CONNECT_TIMEOUT / HTTP_READ_TIMEOUT）
+- 随应用生命周期打开与关闭（dependencies.app_lifespan）
+
+本模块不依赖 utils，避免与 gemini_utils / aiohttp_utils 形成循环导入
+"""
+import asyncio
+import logging
+import os
+from typing import Dict, Optional
+from urllib.parse import urlsplit
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+class HttpClientManager:
+    """进程级 HTTP 客户端管理（每个目标地址一个连接池）"""
+
+    _sessions: Dict[str, aiohttp.ClientSession] = {}
+    _lock = asyncio.Lock()
+
+    # 单个目标地址的最大并发连接数
+    LIMIT_PER_HOST = int(os.environ.get("HTTP_LIMIT_PER_HOST", 32))
+    # 空闲连接保持时间（秒）
+    KEEPALIVE_TIMEOUT = 60
+    # DNS 缓存时间（秒）
+    DNS_CACHE_TTL = 300
+
+    CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 5))
+    READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", 60))
+
+    @staticmethod
+    def _origin(url: str) -> str:
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    @classmethod
+    def default_timeout(cls) -> aiohttp.ClientTimeout:
+        # 不设置总超时，流式响应只受单次读取间隔限制
+        return aiohttp.ClientTimeout(total=None, sock_connect=cls.CONNECT_TIMEOUT, sock_read=cls.READ_TIMEOUT)
+
+    @classmethod
+    async def get_session(cls, url: str) -> aiohttp.ClientSession:
+        """获取目标地址对应的共享 session（首次访问时创建）"""
+        origin = cls._origin(url)
+        session = cls._sessions.get(origin)
+        if session is not None and not session.closed:
+            return session
+
+        async with cls._lock:
+            session = cls._sessions.get(origin)
+            if session is None or session.closed:
+                connector = aiohttp.TCPConnector(
+                    limit_per_host=cls.LIMIT_PER_HOST,
+                    keepalive_timeout=cls.KEEPALIVE_TIMEOUT,
+                    ttl_dns_cache=cls.DNS_CACHE_TTL,
+                )
+                session = aiohttp.ClientSession(connector=connector, timeout=cls.default_timeout())
+                cls._sessions[origin] = session
+                logger.info(f"[HTTP] create session: {origin}")
+            return session
+
+    @classmethod
+    async def open(cls, connect_timeout: Optional[float] = None, read_timeout: Optional[float] = None):
+        """应用启动时调用，可覆盖默认超时配置（session 在首次请求时按目标地址创建）"""
+        if connect_timeout is not None:
+            cls.CONNECT_TIMEOUT = connect_timeout
+        if read_timeout is not None:
+            cls.READ_TIMEOUT = read_timeout
+        logger.info(f"[HTTP] client manager ready: connect={cls.CONNECT_TIMEOUT}s, read={cls.READ_TIMEOUT}s")
+
+    @classmethod
+    async def close_all(cls):
+        """应用关闭时释放全部连接池"""
+        async with cls._lock:
+            sessions = list(cls._sessions.items())
+            cls._sessions.clear()
+        for origin, session in sessions:
+            try:
+                await session.close()
+                logger.info(f"[HTTP] close session: {origin}")
+            except Exception as e:
+                logger.warning(f"[HTTP] close session failed {origin}: {e}")
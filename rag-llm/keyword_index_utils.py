@@ -0,0 +1,486 @@
+"""
+知识库本地倒排关键词索引（LIKE 检索的替代方案）
+
+未迁移到 Milvus 全文检索的 collection，关键词检索只能使用 `text like "%kw%"` 全表扫描。
+这里为每个 `kb_{id}` 在本地维护一份紧凑的倒排索引：
+- 词元：ASCII/字母数字连续串取 3-gram，中日韩连续串取 2-gram（短于 n 的串整体作为词元）
+- 倒排表：词元哈希 → pk 列表，按段（segment）存储，每次入库写入一个新段，段数过多时合并
+- 查询时以 memmap 方式映射段文件，倒排求交/并得到候选 pk，再只从 Milvus 拉取候选并做子串校验
+- 多进程共享：写入（追加段 / 合并 / 清空）持有目录级 fcntl 文件锁并在锁内重新读取 manifest，
+  段名带进程号与随机后缀；查询前按 manifest 的 inode/mtime 判断是否需要重新加载
+
+段文件格式（小端）：
+    header: magic(4s) version(u32) n_terms(u64) n_postings(u64)
+    hashes: u64[n_terms]（升序）
+    offsets: u64[n_terms + 1]
+    postings: i64[n_postings]
+"""
+import asyncio
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import re
+import struct
+import threading
+import uuid
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+INDEX_ROOT = os.environ.get("KEYWORD_INDEX_DIR", "./kw_index")
+
+_MAGIC = b"KWIX"
+_VERSION = 1
+_HEADER = struct.Struct("<4sIQQ")
+
+_CJK = "\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff"
+_RUN_PATTERN = re.compile(rf"[{_CJK}]+|[^\W{_CJK}]+")
+_CJK_PATTERN = re.compile(rf"[{_CJK}]")
+
+_EMPTY = np.empty(0, dtype=np.int64)
+
+# 按候选 pk 拉取切片的候选数上限与并发批次数
+MAX_FETCH_CANDIDATES = 4096
+FETCH_CONCURRENCY = 4
+
+
+def _gram_size(run: str) -> int:
+    return 2 if _CJK_PATTERN.match(run) else 3
+
+
+def _hash(gram: str) -> int:
+    return int.from_bytes(hashlib.blake2b(gram.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+def document_grams(text: str) -> set[int]:
+    """文档侧词元哈希（短于 n 的串整体作为词元）"""
+    grams = set()
+    for run in _RUN_PATTERN.findall(text.lower()):
+        n = _gram_size(run)
+        if len(run) <= n:
+            grams.add(_hash(run))
+        else:
+            for i in range(len(run) - n + 1):
+                grams.add(_hash(run[i:i + n]))
+    return grams
+
+
+def keyword_grams(keyword: str) -> set[int]:
+    """
+    查询侧词元哈希
+
+    只使用长度 >= n 的串生成 n-gram：短串可能是文档中更长串的一部分，无法通过整串词元命中。
+    返回空集合表示该关键词无法由索引回答（需回退到 LIKE）。
+    """
+    grams = set()
+    for run in _RUN_PATTERN.findall(keyword.lower()):
+        n = _gram_size(run)
+        if len(run) >= n:
+            for i in range(len(run) - n + 1):
+                grams.add(_hash(run[i:i + n]))
+    return grams
+
+
+class _Segment:
+    """只读段，memmap 映射"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._mm = np.memmap(path, dtype=np.uint8, mode="r")
+        magic, version, n_terms, n_postings = _HEADER.unpack_from(self._mm, 0)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError(f"invalid keyword index segment: {path}")
+        offset = _HEADER.size
+        self.hashes = np.frombuffer(self._mm, dtype=np.uint64, count=n_terms, offset=offset)
+        offset += 8 * n_terms
+        self.offsets = np.frombuffer(self._mm, dtype=np.uint64, count=n_terms + 1, offset=offset)
+        offset += 8 * (n_terms + 1)
+        self.postings = np.frombuffer(self._mm, dtype=np.int64, count=n_postings, offset=offset)
+
+    def lookup(self, gram: int) -> np.ndarray:
+        i = int(np.searchsorted(self.hashes, np.uint64(gram)))
+        if i < len(self.hashes) and int(self.hashes[i]) == gram:
+            return self.postings[int(self.offsets[i]):int(self.offsets[i + 1])]
+        return _EMPTY
+
+    def items(self) -> Iterable[tuple[int, np.ndarray]]:
+        for i, gram in enumerate(self.hashes):
+            yield int(gram), self.postings[int(self.offsets[i]):int(self.offsets[i + 1])]
+
+    @staticmethod
+    def write(path: str, postings: Dict[int, np.ndarray]):
+        hashes = np.array(sorted(postings), dtype=np.uint64)
+        lists = [np.unique(np.asarray(postings[int(h)], dtype=np.int64)) for h in hashes]
+        offsets = np.zeros(len(hashes) + 1, dtype=np.uint64)
+        if lists:
+            offsets[1:] = np.cumsum([len(p) for p in lists])
+        data = np.concatenate(lists) if lists else _EMPTY
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(_HEADER.pack(_MAGIC, _VERSION, len(hashes), len(data)))
+            f.write(hashes.tobytes())
+            f.write(offsets.tobytes())
+            f.write(data.tobytes())
+        os.replace(tmp_path, path)
+
+
+class CollectionKeywordIndex:
+    """单个 collection 的倒排索引"""
+
+    # 段数超过该值时合并为一个段
+    MAX_SEGMENTS = 16
+    # 全量构建时每个段包含的行数
+    BUILD_SEGMENT_ROWS = 40000
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._manifest_path = os.path.join(directory, "manifest.json")
+        self._lock_path = os.path.join(directory, ".lock")
+        self._manifest = {"complete": False, "segments": []}
+        self._manifest_stamp = None
+        self._segments: List[_Segment] = []
+        if os.path.exists(self._manifest_path):
+            with self._locked(shared=True):
+                self._load()
+        self._build_task: Optional[asyncio.Task] = None
+
+    @property
+    def complete(self) -> bool:
+        return self._manifest["complete"]
+
+    @contextmanager
+    def _locked(self, shared: bool = False):
+        """
+        进程内线程锁 + 目录级文件锁
+        多个 uvicorn worker 与各自的入库消费者共享同一索引目录，写入需独占，重新加载 manifest 时共享
+        """
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self._lock_path, "a") as f:
+                fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _stamp(self) -> Optional[tuple]:
+        # manifest 通过 os.replace 原子替换，inode 变化即表示被改写
+        try:
+            st = os.stat(self._manifest_path)
+        except FileNotFoundError:
+            return None
+        return st.st_ino, st.st_mtime_ns
+
+    def _load(self):
+        """从磁盘重新读取 manifest 与段列表，已映射的段直接复用（调用方需持有锁）"""
+        stamp = self._stamp()
+        manifest = {"complete": False, "segments": []}
+        if stamp is not None:
+            with open(self._manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        loaded = {os.path.basename(segment.path): segment for segment in self._segments}
+        segments = []
+        for name in manifest["segments"]:
+            segment = loaded.get(name)
+            if segment is None:
+                try:
+                    segment = _Segment(os.path.join(self.directory, name))
+                except Exception as e:
+                    logger.warning(f"[KeywordIndex] load segment failed {name}: {e}")
+                    manifest["complete"] = False
+                    continue
+            segments.append(segment)
+        self._manifest, self._segments, self._manifest_stamp = manifest, segments, stamp
+
+    def refresh(self):
+        """
+        其他进程改写了 manifest 时重新加载（未变化时只有一次 stat）
+        锁被写入方（追加段 / 合并）占用时不等待，继续使用当前已映射的段，下次查询再重试
+        """
+        if self._stamp() == self._manifest_stamp:
+            return
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            with open(self._lock_path, "a") as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return
+                try:
+                    self._load()
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        except OSError as e:
+            logger.warning(f"[KeywordIndex] refresh failed {self.directory}: {e}")
+        finally:
+            self._lock.release()
+
+    def _save_manifest(self):
+        tmp_path = f"{self._manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._manifest, f)
+        os.replace(tmp_path, self._manifest_path)
+        self._manifest_stamp = self._stamp()
+
+    @staticmethod
+    def _segment_name() -> str:
+        # 段名带进程号与随机后缀，多进程同时写入不会互相覆盖
+        return f"seg_{os.getpid()}_{uuid.uuid4().hex[:12]}.kwix"
+
+    def add(self, rows: Iterable[tuple[int, str]]):
+        """写入一个新段，rows 为 (pk, 文本) 列表，同一 pk 可出现多次（text 与 fileName）"""
+        postings: Dict[int, list] = {}
+        for pk, text in rows:
+            if not text:
+                continue
+            for gram in document_grams(text):
+                postings.setdefault(gram, []).append(int(pk))
+        if not postings:
+            return
+
+        with self._locked():
+            # 持锁后以磁盘上的 manifest 为准，避免覆盖其他进程追加的段
+            self._load()
+            name = self._segment_name()
+            _Segment.write(os.path.join(self.directory, name), postings)
+            self._manifest["segments"].append(name)
+            self._segments = self._segments + [_Segment(os.path.join(self.directory, name))]
+            self._save_manifest()
+            if len(self._segments) > self.MAX_SEGMENTS:
+                self._compact()
+
+    def mark_complete(self):
+        with self._locked():
+            self._load()
+            self._manifest["complete"] = True
+            self._save_manifest()
+
+    def reset(self):
+        """清空索引（collection 重建导致 pk 变化后调用），下次访问时重新全量构建"""
+        with self._locked():
+            self._load()
+            old_names = list(self._manifest["segments"])
+            self._manifest = {"complete": False, "segments": []}
+            self._segments = []
+            self._save_manifest()
+            self._remove_segments(old_names)
+        logger.info(f"[KeywordIndex] reset: {self.directory}")
+
+    def _remove_segments(self, names: List[str]):
+        # 已映射的旧段文件在 unlink 后仍可被进行中的查询读取
+        for name in names:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    def _compact(self):
+        """合并所有段（调用方需持有锁）"""
+        merged: Dict[int, list] = {}
+        for segment in self._segments:
+            for gram, pks in segment.items():
+                merged.setdefault(gram, []).append(pks)
+        postings = {gram: np.concatenate(parts) for gram, parts in merged.items()}
+
+        old_names = list(self._manifest["segments"])
+        name = self._segment_name()
+        _Segment.write(os.path.join(self.directory, name), postings)
+        self._manifest["segments"] = [name]
+        self._segments = [_Segment(os.path.join(self.directory, name))]
+        self._save_manifest()
+        self._remove_segments(old_names)
+        logger.info(f"[KeywordIndex] compacted {len(old_names)} segments: {self.directory}")
+
+    def _gram_postings(self, segments: List[_Segment], gram: int) -> np.ndarray:
+        parts = [p for p in (s.lookup(gram) for s in segments) if len(p)]
+        if not parts:
+            return _EMPTY
+        return np.unique(np.concatenate(parts)) if len(parts) > 1 else np.unique(parts[0])
+
+    def _keyword_candidates(self, segments: List[_Segment], keyword: str) -> Optional[np.ndarray]:
+        grams = keyword_grams(keyword)
+        if not grams:
+            return None
+        result = None
+        # 先处理倒排表较短的词元，尽早收敛
+        for postings in sorted((self._gram_postings(segments, g) for g in grams), key=len):
+            result = postings if result is None else np.intersect1d(result, postings, assume_unique=True)
+            if not len(result):
+                break
+        return result
+
+    def match(self, keywords: List[str], match_type: str = "OR") -> Optional[np.ndarray]:
+        """
+        根据倒排表计算候选 pk（候选集是真实结果的超集，需调用方做子串校验）
+
+        Returns:
+            升序 pk 数组；索引未构建完成或无法由索引回答时返回 None
+        """
+        self.refresh()
+        if not self.complete:
+            return None
+        segments = self._segments
+        result = None
+        for keyword in keywords:
+            candidates = self._keyword_candidates(segments, keyword)
+            if candidates is None:
+                if match_type == "AND":
+                    # AND 模式下跳过无法索引的关键词仍是超集，由校验阶段过滤
+                    continue
+                return None
+            if result is None:
+                result = candidates
+            elif match_type == "AND":
+                result = np.intersect1d(result, candidates, assume_unique=True)
+            else:
+                result = np.union1d(result, candidates)
+        return result
+
+    def ensure_built(self, vector_store, has_file_name: bool = True, batch_size: int = 1000):
+        """索引不完整时在后台全量构建（从 Milvus 迭代全部切片）"""
+        self.refresh()
+        if self.complete or (self._build_task and not self._build_task.done()):
+            return
+        self._build_task = asyncio.create_task(
+            asyncio.to_thread(self._build, vector_store, has_file_name, batch_size)
+        )
+
+    def _build(self, vector_store, has_file_name: bool, batch_size: int):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, ".build.lock"), "a") as build_lock:
+            # 同一目录只允许一个进程全量构建，其余进程等待其完成后经 refresh 读到结果
+            try:
+                fcntl.flock(build_lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.info(f"[KeywordIndex] build already running in another process: {self.directory}")
+                return
+            try:
+                self.refresh()
+                if not self.complete:
+                    self._build_locked(vector_store, has_file_name, batch_size)
+            finally:
+                fcntl.flock(build_lock, fcntl.LOCK_UN)
+
+    def _build_locked(self, vector_store, has_file_name: bool, batch_size: int):
+        collection_name = vector_store.collection_name
+        logger.info(f"[KeywordIndex] build start: {self.directory}")
+        try:
+            output_fields = ["pk", "text"] + (["fileName"] if has_file_name else [])
+            iterator = vector_store.client.query_iterator(
+                collection_name, batch_size=batch_size, output_fields=output_fields
+            )
+            total = 0
+            pending = []
+            try:
+                while True:
+                    rows = iterator.next()
+                    if not rows:
+                        break
+                    for r in rows:
+                        pending.append((r["pk"], r.get("text", "")))
+                        pending.append((r["pk"], r.get("fileName", "")))
+                    total += len(rows)
+                    # 攒够一批再落段，避免全量构建时频繁合并
+                    if len(pending) >= self.BUILD_SEGMENT_ROWS:
+                        self.add(pending)
+                        pending = []
+                if pending:
+                    self.add(pending)
+            finally:
+                iterator.close()
+            self.mark_complete()
+            logger.info(f"[KeywordIndex] build done: {self.directory}, rows={total}")
+        except Exception as e:
+            logger.warning(f"[KeywordIndex] build failed {self.directory}: {e}")
+
+
+class KeywordIndexManager:
+    """按 collection 管理本地倒排索引"""
+
+    _indexes: Dict[str, CollectionKeywordIndex] = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def get_index(cls, user_id: int, kb_id: int) -> CollectionKeywordIndex:
+        db_name = f"group_{user_id // 1000}"
+        collection_name = f"kb_{kb_id}"
+        key = f"{db_name}.{collection_name}"
+        with cls._lock:
+            if key not in cls._indexes:
+                cls._indexes[key] = CollectionKeywordIndex(os.path.join(INDEX_ROOT, db_name, collection_name))
+            return cls._indexes[key]
+
+    @classmethod
+    def reset(cls, user_id: int, kb_id: int):
+        """清空 collection 的倒排索引（同步调用）"""
+        cls.get_index(user_id, kb_id).reset()
+
+    @classmethod
+    async def add_documents(cls, user_id: int, kb_id: int, pks: list, texts: list[str], file_name: str):
+        """入库后增量写入新切片"""
+        index = cls.get_index(user_id, kb_id)
+        rows = list(zip(pks, texts)) + [(pk, file_name) for pk in pks]
+        await asyncio.to_thread(index.add, rows)
+
+
+async def fetch_matched_rows(
+        vector_store,
+        pks: np.ndarray,
+        predicate: Callable[[dict], bool],
+        output_fields: List[str],
+        limit: int,
+        extra_filter: Optional[str] = None,
+        batch_size: int = 256,
+        max_candidates: int = MAX_FETCH_CANDIDATES,
+        concurrency: int = FETCH_CONCURRENCY,
+) -> Optional[List[dict]]:
+    """
+    按候选 pk 分批从 Milvus 拉取切片并做子串校验，直到凑够 limit 条
+    每次并发 concurrency 个批次，按候选顺序合并
+
+    Args:
+        vector_store: langchain Milvus 实例
+        pks: 候选 pk（倒排索引给出）
+        predicate: 校验函数，保留返回 True 的行
+        output_fields: 输出字段
+        limit: 最大返回条数
+        extra_filter: 额外的过滤表达式（如文件名范围）
+        max_candidates: 候选数上限，常见词元的候选过多时逐批拉取反而慢于 LIKE 扫描
+
+    Returns:
+        匹配的行；候选数超过 max_candidates 时返回 None，调用方回退到 LIKE
+    """
+    if len(pks) > max_candidates:
+        logger.info(f"[KeywordIndex] {len(pks)} candidates exceed {max_candidates}, fall back to LIKE")
+        return None
+
+    async def query_batch(start: int) -> list:
+        batch = ", ".join(str(int(pk)) for pk in pks[start:start + batch_size])
+        expr = f"pk in [{batch}]"
+        if extra_filter:
+            expr = f"({expr}) and ({extra_filter})"
+        return await vector_store.aclient.query(
+            collection_name=vector_store.collection_name,
+            filter=expr,
+            output_fields=output_fields,
+        )
+
+    rows = []
+    starts = list(range(0, len(pks), batch_size))
+    for i in range(0, len(starts), concurrency):
+        results = await asyncio.gather(*(query_batch(start) for start in starts[i:i + concurrency]))
+        for result in results:
+            for r in result:
+                if predicate(r):
+                    rows.append(r)
+                    if len(rows) >= limit:
+                        return rows
+    return rows
@@ -0,0 +1,61 @@
+"""
+Milvus collection 迁移脚本
+
+将旧版知识库 collection 迁移为混合检索 schema（dense + BM25 sparse）：
+    python milvus_migrate.py --user-id 1001 --kb-id 12 --kb-id 13
+
+迁移前先补齐可追加的元数据字段与 documentId/chunkIndex/fileName 标量索引（建索引时会短暂释放 collection）；
+只需补齐字段与索引、不重建 collection 时使用 --schema-only：
+    python milvus_migrate.py --user-id 1001 --kb-id 12 --schema-only
+
+连接信息读取环境变量 MILVUS_URI / MILVUS_TOKEN。
+迁移期间请暂停对应知识库的文档上传。完成后通过 RabbitMQ（RABBITMQ_* 环境变量）广播变更，
+各 worker 收到后重建缓存实例并使检索缓存失效；需在服务目录下运行以共享 KEYWORD_INDEX_DIR。
+"""
+import argparse
+import asyncio
+import logging
+import os
+
+from milvus_utils import MilvusClientManager
+
+logger = logging.getLogger(__name__)
+
+
+async def migrate(user_id: int, kb_ids: list[int], schema_only: bool = False):
+    milvus_uri = os.environ.get("MILVUS_URI")
+    milvus_token = os.environ.get("MILVUS_TOKEN")
+    if not milvus_uri:
+        raise ValueError("MILVUS_URI is required")
+
+    # mq.connection 在导入时校验 RabbitMQ 环境变量
+    from mq.collection_events import publish_collection_change
+    from mq.connection import rabbit_async_client
+    await rabbit_async_client.connect()
+
+    try:
+        for kb_id in kb_ids:
+            try:
+                capabilities = await MilvusClientManager.upgrade_schema(user_id, kb_id, milvus_uri, milvus_token)
+                logger.info(f"kb_{kb_id}: schema upgraded, {capabilities}")
+                await publish_collection_change(user_id, kb_id, "schema")
+                if schema_only:
+                    continue
+                migrated = await MilvusClientManager.migrate_to_hybrid(user_id, kb_id, milvus_uri, milvus_token)
+                logger.info(f"kb_{kb_id}: {'migrated' if migrated else 'skipped (already hybrid)'}")
+                if migrated:
+                    await publish_collection_change(user_id, kb_id, "migrate")
+            except Exception as e:
+                logger.error(f"kb_{kb_id}: migrate failed: {e}")
+    finally:
+        await rabbit_async_client.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description="Migrate knowledge base collections to hybrid search schema")
+    parser.add_argument("--user-id", type=int, required=True, help="知识库持有者的用户ID")
+    parser.add_argument("--kb-id", type=int, action="append", required=True, help="知识库ID，可重复指定")
+    parser.add_argument("--schema-only", action="store_true", help="只补齐字段与标量索引，不重建为混合检索 collection")
+    args = parser.parse_args()
+    asyncio.run(migrate(args.user_id, args.kb_id, args.schema_only))
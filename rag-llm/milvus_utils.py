@@ -1,26 +1,217 @@
 import asyncio
 import logging
 import time
-from typing import Dict, Optional
+from typing import Dict, List, Optional, Set
 
 from langchain_core.embeddings import Embeddings
-from langchain_milvus import Milvus
+from langchain_milvus import Milvus, BM25BuiltInFunction
+from pymilvus import MilvusClient, DataType, Function, FunctionType
 from pymilvus.client.types import LoadState
 
+from cache_utils import CollectionVersionRegistry
+from keyword_index_utils import KeywordIndexManager
+
 logger = logging.getLogger(__name__)
 
+TEXT_FIELD = "text"
+DENSE_VECTOR_FIELD = "vector"
+SPARSE_VECTOR_FIELD = "sparse"
+BM25_FUNCTION_NAME = "text_bm25_emb"
+
+# 切片元数据字段
+METADATA_FIELDS = ["documentId", "chunkIndex", "fileName", "maxChunkIndex", "startIndex", "endIndex"]
+# 检索工具过滤所依赖的标量索引
+SCALAR_INDEXES = {
+    "documentId": "STL_SORT",
+    "chunkIndex": "STL_SORT",
+    "fileName": "INVERTED",
+}
+# text 字段的 NGRAM 索引参数（与 rag-server 创建 collection 时一致，加速 LIKE 子串匹配）
+TEXT_NGRAM_PARAMS = {"min_gram": 2, "max_gram": 3}
+# 旧版 collection 可追加的字段（nullable，历史数据为空）
+MIGRATABLE_FIELDS = {
+    "chunkIndex": (DataType.INT64, {}),
+    "maxChunkIndex": (DataType.INT64, {}),
+    "fileName": (DataType.VARCHAR, {"max_length": 1024}),
+    "startIndex": (DataType.INT64, {}),
+    "endIndex": (DataType.INT64, {}),
+}
+
+
+class CollectionCapabilities:
+    """
+    collection 的 schema 能力标记（按 collection 缓存，避免每次查询探测 schema）
+    - hybrid: 存在 BM25 稀疏向量字段，可进行 dense + sparse 混合检索
+    - text_match: text 字段开启了 enable_match，可使用 PHRASE_MATCH 走倒排索引
+    - fields / indexed_fields: 现有字段与已建索引的字段
+    """
+
+    # RRF 融合参数
+    RRF_K = 60
+
+    def __init__(
+            self,
+            hybrid: bool = False,
+            text_match: bool = False,
+            fields: Optional[Set[str]] = None,
+            indexed_fields: Optional[Set[str]] = None
+    ):
+        self.hybrid = hybrid
+        self.text_match = text_match
+        # 未探测时按 rag-server 建表的标准字段处理
+        self.fields = fields if fields is not None else {TEXT_FIELD, "pk", *METADATA_FIELDS}
+        self.indexed_fields = indexed_fields or set()
+
+    @classmethod
+    def from_description(cls, description: dict, indexed_fields: Optional[Set[str]] = None) -> "CollectionCapabilities":
+        fields = {f.get("name"): f for f in description.get("fields", [])}
+        functions = description.get("functions") or []
+        hybrid = SPARSE_VECTOR_FIELD in fields and any(
+            SPARSE_VECTOR_FIELD in (fn.get("output_field_names") or []) for fn in functions
+        )
+        text_params = fields.get(TEXT_FIELD, {}).get("params", {}) or {}
+        text_match = bool(text_params.get("enable_match"))
+        return cls(hybrid=hybrid, text_match=text_match, fields=set(fields), indexed_fields=indexed_fields)
+
+    @property
+    def needs_keyword_index(self) -> bool:
+        """关键词检索是否依赖本地倒排索引（入库与两条检索链路统一使用该判断）"""
+        return not self.text_match
+
+    @property
+    def has_file_name(self) -> bool:
+        return "fileName" in self.fields
+
+    @property
+    def has_chunk_index(self) -> bool:
+        return "chunkIndex" in self.fields
+
+    @property
+    def output_fields(self) -> List[str]:
+        """查询切片时的输出字段（仅包含 collection 中存在的元数据字段）"""
+        return [TEXT_FIELD, "pk"] + [f for f in METADATA_FIELDS if f in self.fields]
+
+    def search_kwargs(self, k: int) -> dict:
+        """构造 retriever 的 search_kwargs，混合检索时使用 RRF 融合"""
+        if self.hybrid:
+            return {"k": k, "ranker_type": "rrf", "ranker_params": {"k": self.RRF_K}}
+        return {"k": k}
+
+    def __repr__(self):
+        return (
+            f"CollectionCapabilities(hybrid={self.hybrid}, text_match={self.text_match}, "
+            f"indexed_fields={sorted(self.indexed_fields)})"
+        )
+
+
+def _probe_capabilities(client: MilvusClient, collection_name: str) -> CollectionCapabilities:
+    """只读探测 collection 的字段与索引（同步调用，需放在线程中执行）"""
+    description = client.describe_collection(collection_name)
+    indexed_fields = set()
+    for index_name in client.list_indexes(collection_name):
+        info = client.describe_index(collection_name, index_name) or {}
+        if info.get("field_name"):
+            indexed_fields.add(info["field_name"])
+    return CollectionCapabilities.from_description(description, indexed_fields)
+
+
+def _add_missing_fields(client: MilvusClient, collection_name: str, existing: Set[str]) -> bool:
+    """
+    旧版 collection 缺少 fileName/chunkIndex/maxChunkIndex 时追加为 nullable 字段
+    （追加字段不需要释放 collection，入库前即可执行）
+
+    Returns:
+        是否追加了字段
+    """
+    fields_added = False
+    for field_name, (data_type, params) in MIGRATABLE_FIELDS.items():
+        if field_name in existing:
+            continue
+        try:
+            client.add_collection_field(
+                collection_name, field_name=field_name, data_type=data_type, nullable=True, **params
+            )
+            fields_added = True
+            logger.info(f"[Milvus] add field {field_name} to {collection_name}")
+        except Exception as e:
+            logger.warning(f"[Milvus] add field {field_name} to {collection_name} failed: {e}")
+    return fields_added
+
+
+def _upgrade_schema(client: MilvusClient, collection_name: str) -> CollectionCapabilities:
+    """
+    补齐可追加字段与标量索引（同步调用，由迁移脚本执行，不在查询路径上运行）
+    Milvus 建索引前需释放 collection，完成后恢复原加载状态
+    """
+    capabilities = _probe_capabilities(client, collection_name)
+    if _add_missing_fields(client, collection_name, capabilities.fields):
+        capabilities = _probe_capabilities(client, collection_name)
+
+    missing = [f for f in SCALAR_INDEXES if f in capabilities.fields and f not in capabilities.indexed_fields]
+    if missing:
+        state = client.get_load_state(collection_name).get("state", LoadState.NotLoad)
+        if state == LoadState.Loaded:
+            client.release_collection(collection_name)
+        try:
+            index_params = client.prepare_index_params()
+            for field_name in missing:
+                index_params.add_index(field_name=field_name, index_type=SCALAR_INDEXES[field_name])
+            client.create_index(collection_name, index_params)
+            capabilities.indexed_fields.update(missing)
+            logger.info(f"[Milvus] create scalar indexes on {collection_name}: {missing}")
+        finally:
+            if state == LoadState.Loaded:
+                client.load_collection(collection_name)
+    return capabilities
+
 
 class _MilvusWrapper:
     """
     单个 collection 的运行时包装
     """
 
-    def __init__(self, store: Milvus):
+    def __init__(
+            self,
+            store: Milvus,
+            capabilities: CollectionCapabilities,
+            embeddings: Embeddings,
+            connection_args: dict
+    ):
         self.store = store
+        self.capabilities = capabilities
+        self.embeddings = embeddings
+        self.connection_args = connection_args
         self.last_access = time.time()
         self.lock = asyncio.Lock()
 
 
+def _create_store(
+        embeddings: Embeddings,
+        connection_args: dict,
+        collection_name: str,
+        hybrid: bool = False
+) -> Milvus:
+    """创建 langchain Milvus 实例，混合检索模式下挂载 BM25 内置函数"""
+    if hybrid:
+        return Milvus(
+            embedding_function=embeddings,
+            connection_args=connection_args,
+            collection_name=collection_name,
+            auto_id=True,
+            builtin_function=BM25BuiltInFunction(
+                input_field_names=TEXT_FIELD,
+                output_field_names=SPARSE_VECTOR_FIELD,
+            ),
+            vector_field=[DENSE_VECTOR_FIELD, SPARSE_VECTOR_FIELD],
+        )
+    return Milvus(
+        embedding_function=embeddings,
+        connection_args=connection_args,
+        collection_name=collection_name,
+        auto_id=True,
+    )
+
+
 class MilvusClientManager:
     """
     Milvus 连接与 collection 生命周期管理
@@ -30,10 +221,17 @@ class MilvusClientManager:
 
     _instances: Dict[str, _MilvusWrapper] = {}
     _global_lock = asyncio.Lock()
+    # 正在创建实例的 collection 各自持有的锁
+    _create_locks: Dict[str, asyncio.Lock] = {}
 
     # 空闲释放阈值（秒）
     IDLE_TTL = 30 * 60  # 30 分钟
 
+    @staticmethod
+    def collection_key(user_id: int, kb_id: int) -> str:
+        """知识库对应的 "{db}.{collection}" 标识"""
+        return f"group_{user_id // 1000}.kb_{kb_id}"
+
     @classmethod
     async def get_instance(
             cls,
@@ -50,26 +248,36 @@ class MilvusClientManager:
         collection_name = f"kb_{kb_id}"
         key = f"{db_name}.{collection_name}"
 
+        # 全局锁只保护实例表，创建实例（连接、探测 schema）在各 collection 自己的锁内进行
         async with cls._global_lock:
-            if key not in cls._instances:
-                try:
-                    store = Milvus(
-                        embedding_function=embeddings,
-                        connection_args={
+            wrapper = cls._instances.get(key)
+            create_lock = cls._create_locks.setdefault(key, asyncio.Lock()) if wrapper is None else None
+
+        if wrapper is None:
+            async with create_lock:
+                wrapper = cls._instances.get(key)
+                if wrapper is None:
+                    try:
+                        connection_args = {
                             "uri": milvus_uri,
                             "token": milvus_token,
                             "db_name": db_name,
-                        },
-                        collection_name=collection_name,
-                        auto_id=True,
-                    )
-                    cls._instances[key] = _MilvusWrapper(store)
-                    logger.info(f"[Milvus] create instance: {key}")
-                except Exception as e:
-                    logger.error(f"[Milvus] create instance failed {key}: {e}")
-                    return None
-
-            wrapper = cls._instances[key]
+                        }
+                        store = await asyncio.to_thread(_create_store, embeddings, connection_args, collection_name)
+                        # 查询路径只读取 schema 能力，字段与索引的补齐由迁移脚本 / 入库流程负责
+                        capabilities = await asyncio.to_thread(_probe_capabilities, store.client, collection_name)
+                        if capabilities.hybrid:
+                            store = await asyncio.to_thread(
+                                _create_store, embeddings, connection_args, collection_name, hybrid=True
+                            )
+                        wrapper = _MilvusWrapper(store, capabilities, embeddings, connection_args)
+                        logger.info(f"[Milvus] create instance: {key}, {capabilities}")
+                    except Exception as e:
+                        logger.error(f"[Milvus] create instance failed {key}: {e}")
+                        return None
+                    async with cls._global_lock:
+                        cls._instances[key] = wrapper
+                        cls._create_locks.pop(key, None)
 
         # 单 collection 串行管理
         async with wrapper.lock:
@@ -86,6 +294,194 @@ class MilvusClientManager:
                     return None
         return wrapper.store
 
+    @classmethod
+    def get_capabilities(cls, user_id: int, kb_id: int) -> CollectionCapabilities:
+        """
+        获取 collection 的能力标记（需先调用 get_instance），未缓存时按旧版 collection 处理
+        """
+        wrapper = cls._instances.get(cls.collection_key(user_id, kb_id))
+        return wrapper.capabilities if wrapper else CollectionCapabilities()
+
+    @classmethod
+    async def invalidate(cls, user_id: int, kb_id: int):
+        """移除缓存实例（不释放 collection），下次访问时按当前 schema 重新探测"""
+        async with cls._global_lock:
+            cls._instances.pop(cls.collection_key(user_id, kb_id), None)
+
+    @classmethod
+    async def ensure_fields(cls, user_id: int, kb_id: int) -> Optional[Milvus]:
+        """
+        入库前补齐旧版 collection 缺少的元数据字段（需先调用 get_instance）
+        只追加 nullable 字段，不释放 collection；追加后重建实例使写入包含新字段
+
+        Returns:
+            可用于写入的 Milvus 实例
+        """
+        wrapper = cls._instances.get(cls.collection_key(user_id, kb_id))
+        if wrapper is None:
+            return None
+        if all(f in wrapper.capabilities.fields for f in MIGRATABLE_FIELDS):
+            return wrapper.store
+        async with wrapper.lock:
+            collection_name = wrapper.store.collection_name
+            if await asyncio.to_thread(
+                    _add_missing_fields, wrapper.store.client, collection_name, wrapper.capabilities.fields
+            ):
+                wrapper.capabilities = await asyncio.to_thread(
+                    _probe_capabilities, wrapper.store.client, collection_name
+                )
+                wrapper.store = await asyncio.to_thread(
+                    _create_store, wrapper.embeddings, wrapper.connection_args, collection_name,
+                    hybrid=wrapper.capabilities.hybrid
+                )
+        return wrapper.store
+
+    @classmethod
+    async def upgrade_schema(cls, user_id: int, kb_id: int, milvus_uri: str, milvus_token: str) -> CollectionCapabilities:
+        """
+        补齐旧版 collection 的可追加字段与标量索引（由 milvus_migrate.py 调用）
+        建索引需要短暂释放 collection，应在低峰期执行
+        """
+        db_name = f"group_{user_id // 1000}"
+        collection_name = f"kb_{kb_id}"
+
+        def upgrade() -> CollectionCapabilities:
+            client = MilvusClient(uri=milvus_uri, token=milvus_token, db_name=db_name)
+            try:
+                return _upgrade_schema(client, collection_name)
+            finally:
+                client.close()
+
+        capabilities = await asyncio.to_thread(upgrade)
+        await cls.invalidate(user_id, kb_id)
+        return capabilities
+
+    @classmethod
+    async def migrate_to_hybrid(
+            cls,
+            user_id: int,
+            kb_id: int,
+            milvus_uri: str,
+            milvus_token: str,
+            batch_size: int = 512
+    ) -> bool:
+        """
+        将旧版 collection 迁移为混合检索 schema（新增 BM25 稀疏向量字段并回填）
+
+        Milvus 不支持为已有 collection 追加 BM25 函数，因此采用重建方式：
+        1. 按原 schema 新建临时 collection，text 开启 analyzer/match，并新增 sparse 字段与 BM25 函数
+        2. 使用 query_iterator 分批拷贝原数据（含 dense 向量），sparse 字段由服务端在写入时计算
+        3. 原 collection 先重命名为备份名，再将临时 collection 重命名为原名称，成功后才删除备份
+           （任一步失败时原数据仍在，备份会在下次迁移时恢复）
+
+        注意：迁移期间需停止该知识库的文档写入；迁移后 pk 会重新生成，
+        因此迁移完成后清空该 collection 的本地倒排索引并递增版本号。
+
+        Returns:
+            是否执行了迁移（已是混合检索 schema 时返回 False）
+        """
+        db_name = f"group_{user_id // 1000}"
+        collection_name = f"kb_{kb_id}"
+        key = f"{db_name}.{collection_name}"
+
+        def migrate() -> bool:
+            client = MilvusClient(uri=milvus_uri, token=milvus_token, db_name=db_name)
+            try:
+                backup_name = f"{collection_name}_pre_hybrid_bak"
+                if client.has_collection(backup_name):
+                    if client.has_collection(collection_name):
+                        # 上次迁移已完成，仅备份删除失败
+                        client.drop_collection(backup_name)
+                    else:
+                        # 上次迁移在两次重命名之间中断，先恢复原 collection
+                        client.rename_collection(backup_name, collection_name)
+                        logger.warning(f"[Milvus] restored collection from backup: {key}")
+
+                description = client.describe_collection(collection_name)
+                if CollectionCapabilities.from_description(description).hybrid:
+                    logger.info(f"[Milvus] collection already hybrid: {key}")
+                    return False
+
+                tmp_name = f"{collection_name}_hybrid_tmp"
+                if client.has_collection(tmp_name):
+                    client.drop_collection(tmp_name)
+
+                schema = MilvusClient.create_schema(auto_id=True, enable_dynamic_field=False)
+                copy_fields = []
+                for field in description.get("fields", []):
+                    name = field.get("name")
+                    if field.get("is_primary"):
+                        schema.add_field(name, field["type"], is_primary=True, auto_id=True)
+                        continue
+                    params = dict(field.get("params") or {})
+                    if field.get("nullable"):
+                        params["nullable"] = True
+                    if name == TEXT_FIELD:
+                        params["enable_analyzer"] = True
+                        params["enable_match"] = True
+                    schema.add_field(name, field["type"], **params)
+                    copy_fields.append(name)
+                schema.add_field(SPARSE_VECTOR_FIELD, DataType.SPARSE_FLOAT_VECTOR)
+                schema.add_function(Function(
+                    name=BM25_FUNCTION_NAME,
+                    function_type=FunctionType.BM25,
+                    input_field_names=[TEXT_FIELD],
+                    output_field_names=[SPARSE_VECTOR_FIELD],
+                ))
+
+                index_params = client.prepare_index_params()
+                index_params.add_index(field_name=DENSE_VECTOR_FIELD, index_type="AUTOINDEX", metric_type="COSINE")
+                index_params.add_index(
+                    field_name=SPARSE_VECTOR_FIELD, index_type="SPARSE_INVERTED_INDEX", metric_type="BM25"
+                )
+                index_params.add_index(field_name=TEXT_FIELD, index_type="NGRAM", params=TEXT_NGRAM_PARAMS)
+                for field_name, index_type in SCALAR_INDEXES.items():
+                    if field_name in copy_fields:
+                        index_params.add_index(field_name=field_name, index_type=index_type)
+                client.create_collection(tmp_name, schema=schema, index_params=index_params)
+
+                # 原 collection 需处于加载状态才能迭代
+                client.load_collection(collection_name)
+                iterator = client.query_iterator(
+                    collection_name, batch_size=batch_size, output_fields=copy_fields
+                )
+                copied = 0
+                try:
+                    while True:
+                        rows = iterator.next()
+                        if not rows:
+                            break
+                        client.insert(tmp_name, [{k: r[k] for k in copy_fields if k in r} for r in rows])
+                        copied += len(rows)
+                finally:
+                    iterator.close()
+                client.flush(tmp_name)
+
+                client.release_collection(collection_name)
+                client.rename_collection(collection_name, backup_name)
+                try:
+                    client.rename_collection(tmp_name, collection_name)
+                except Exception:
+                    client.rename_collection(backup_name, collection_name)
+                    raise
+                try:
+                    client.drop_collection(backup_name)
+                except Exception as e:
+                    logger.warning(f"[Milvus] drop backup collection failed {key}: {e}")
+                logger.info(f"[Milvus] migrate to hybrid done: {key}, rows={copied}")
+                return True
+            finally:
+                client.close()
+
+        # 迁移前移除缓存实例，迁移完成后下次访问按新 schema 重建
+        await cls.invalidate(user_id, kb_id)
+        migrated = await asyncio.to_thread(migrate)
+        if migrated:
+            # pk 已重新生成：旧倒排索引与检索缓存均失效
+            await asyncio.to_thread(KeywordIndexManager.reset, user_id, kb_id)
+            CollectionVersionRegistry.bump(key)
+        return migrated
+
     @classmethod
     async def release_idle_collections(cls):
         """
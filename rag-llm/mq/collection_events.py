@@ -0,0 +1,58 @@
+import json
+import logging
+import os
+import uuid
+
+from aio_pika.abc import AbstractIncomingMessage
+
+from cache_utils import CollectionVersionRegistry
+from milvus_utils import MilvusClientManager
+from mq.connection import rabbit_async_client
+
+logger = logging.getLogger(__name__)
+
+# 知识库内容变更广播（fanout），rag-server 删除文档与本服务各 worker 入库 / 迁移后发布
+COLLECTION_CHANGE_EXCHANGE = "rag.collection.change.exchange"
+
+# 本进程标识，收到自己发布的广播时跳过（发布前已在本进程递增）
+INSTANCE_ID = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+# 需要按新 schema 重建缓存实例的变更类型
+SCHEMA_EVENTS = {"migrate", "schema"}
+
+
+async def publish_collection_change(user_id: int, kb_id: int, event: str):
+    """
+    递增本进程的 collection 版本并广播给其他 worker
+    广播失败只记录日志，不影响调用方（其他 worker 的缓存由 TTL 兜底）
+    """
+    CollectionVersionRegistry.bump(MilvusClientManager.collection_key(user_id, kb_id))
+    try:
+        await rabbit_async_client.publish(
+            exchange_name=COLLECTION_CHANGE_EXCHANGE,
+            routing_key="",
+            message={"userId": user_id, "kbId": kb_id, "event": event, "origin": INSTANCE_ID}
+        )
+    except Exception as e:
+        logger.warning(f"Broadcast collection change failed: kb_{kb_id}, event={event}, error={e}")
+
+
+class CollectionChangeConsumer:
+    async def on_receive_message(self, message: AbstractIncomingMessage):
+        try:
+            data = json.loads(message.body.decode())
+            if data.get("origin") == INSTANCE_ID:
+                return
+            user_id = int(data["userId"])
+            kb_id = int(data["kbId"])
+            event = data.get("event", "")
+            logger.info(f"Received collection change: kb_{kb_id}, event={event}")
+
+            CollectionVersionRegistry.bump(MilvusClientManager.collection_key(user_id, kb_id))
+            if event in SCHEMA_EVENTS:
+                await MilvusClientManager.invalidate(user_id, kb_id)
+        except Exception as e:
+            logger.error(f"Error processing collection change message: {e}")
+
+
+collection_change_consumer = CollectionChangeConsumer()
@@ -106,6 +106,28 @@ class AsyncRabbitMQClient:
             logger.error(f"Error starting consumer for queue '{queue_name}': {e}")
             raise AsyncRabbitMQError(f"Error starting consumer: {e}") from e
 
+    async def subscribe_fanout(
+            self,
+            exchange_name: str,
+            callback: Callable[[AbstractIncomingMessage], Awaitable[Any]],
+    ):
+        """
+        订阅 fanout 广播：每个进程声明独占的临时队列并绑定到交换机，所有订阅者都会收到同一条消息
+        """
+        if not self.channel:
+            raise AsyncRabbitMQError("Channel is not available.")
+        try:
+            exchange = await self.channel.declare_exchange(
+                exchange_name, aio_pika.ExchangeType.FANOUT, durable=True
+            )
+            queue = await self.channel.declare_queue(exclusive=True, auto_delete=True)
+            await queue.bind(exchange)
+            await queue.consume(callback, no_ack=True)
+            logger.info(f"Subscribed to fanout exchange '{exchange_name}' with queue '{queue.name}'.")
+        except Exception as e:
+            logger.error(f"Error subscribing to fanout exchange '{exchange_name}': {e}")
+            raise AsyncRabbitMQError(f"Error subscribing to fanout exchange: {e}") from e
+
     async def publish(
             self,
             exchange_name: str,
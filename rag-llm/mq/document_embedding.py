@@ -9,8 +9,10 @@ from aio_pika.abc import AbstractIncomingMessage
 from langchain_core.documents import Document
 
 import utils
+from keyword_index_utils import KeywordIndexManager
 from milvus_utils import MilvusClientManager
 from minio_utils import minio_client
+from mq.collection_events import publish_collection_change
 from mq.connection import rabbit_async_client
 from utils import get_embedding_instance
 
@@ -19,6 +21,18 @@ logger = logging.getLogger(__name__)
 
 
 class DocumentEmbeddingConsumer:
+    async def invalidate_keyword_index(self, user_id: int, kb_id: int, document_id: int):
+        """
+        已写入 Milvus 的切片未能进入本地倒排索引时清空索引
+        索引被视为权威的候选集，缺少切片会导致这些切片永远无法被关键词检索命中；
+        清空后查询回退到 LIKE，直到下次查询触发全量重建
+        """
+        try:
+            await asyncio.to_thread(KeywordIndexManager.reset, user_id, kb_id)
+            logger.warning(f"Keyword index reset after incomplete update for document {document_id}")
+        except Exception as e:
+            logger.error(f"Keyword index reset failed for document {document_id}: {e}")
+
     async def error_message_sender(self, document_id: int, error_msg: str):
         response_message = {
             "documentId": document_id,
@@ -69,17 +83,22 @@ class DocumentEmbeddingConsumer:
                     await asyncio.to_thread(write_temp_file)
 
                 vector_store = None
+                # 本地倒排索引是否已包含本文档的切片（或该 collection 不需要本地索引）
+                keyword_index_synced = False
+                # 切片的 start_index 是否为全文偏移（markdown 按标题分段后偏移只在段内有效）
+                global_offsets = False
                 try:
                     if suffix.lower() == ".pdf":
                         # chunk_overlap=0 可确保不重复
-                        texts = await asyncio.to_thread(utils.pdf_split, tmp_path)
-                        splits = [Document(page_content=t) for t in texts]
+                        splits = await asyncio.to_thread(utils.pdf_split, tmp_path, return_documents=True)
+                        global_offsets = True
                     elif suffix.lower() == ".txt":
                         def split_txt():
                             with open(tmp_path, "r", encoding="utf-8") as f:
-                                return [Document(page_content=t) for t in utils.plain_text_split(f.read())]
+                                return utils.plain_text_split(f.read(), return_documents=True)
 
                         splits = await asyncio.to_thread(split_txt)
+                        global_offsets = True
                     elif suffix.lower() == ".md":
                         with open(tmp_path, "r", encoding="utf-8") as f:
                             splits = await asyncio.to_thread(utils.markdown_split, f.read())
@@ -93,19 +112,21 @@ class DocumentEmbeddingConsumer:
                     elif suffix.lower() in [".py", ".java", ".js", ".ts", ".vue", ".html", ".rb"]:
                         def split_code(lang):
                             with open(tmp_path, "r", encoding="utf-8") as f:
-                                return [Document(page_content=t) for t in utils.code_split(f.read(), lang)]
+                                return utils.code_split(f.read(), lang, return_documents=True)
 
                         lang_map = {
                             ".py": "python", ".java": "java", ".js": "js", ".ts": "js", ".vue": "js",
                             ".html": "html", ".rb": "ruby"
                         }
                         splits = await asyncio.to_thread(split_code, lang_map[suffix.lower()])
+                        global_offsets = True
                     elif suffix.lower() in [".xml", ".yml", ".yaml", ".sh", ".css", ".scss"]:
                         def split_plain():
                             with open(tmp_path, "r", encoding="utf-8") as f:
-                                return [Document(page_content=t) for t in utils.plain_text_split(f.read())]
+                                return utils.plain_text_split(f.read(), return_documents=True)
 
                         splits = await asyncio.to_thread(split_plain)
+                        global_offsets = True
                     elif suffix.lower() in [".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp"]:
                         # Process image directly from bytes
                         splits = await utils.image_split(io.BytesIO(minio_byte))
@@ -119,6 +140,11 @@ class DocumentEmbeddingConsumer:
                         doc.metadata["chunkIndex"] = i
                         doc.metadata["maxChunkIndex"] = len(splits) - 1
                         doc.metadata["fileName"] = file_name
+                        # 记录切片在全文中的区间，合并相邻切片时直接按偏移去除重叠
+                        start_index = doc.metadata.pop("start_index", None)
+                        if global_offsets and start_index is not None:
+                            doc.metadata["startIndex"] = start_index
+                            doc.metadata["endIndex"] = start_index + len(doc.page_content)
                     # Embed and store
                     milvus_uri = os.environ.get("MILVUS_URI")
                     milvus_token = os.environ.get("MILVUS_TOKEN")
@@ -132,6 +158,8 @@ class DocumentEmbeddingConsumer:
                     vector_store = await MilvusClientManager.get_instance(
                         user_id, kb_id, milvus_uri, milvus_token, embeddings
                     )
+                    # 旧版 collection 入库前补齐元数据字段（查询路径不做 schema 变更）
+                    vector_store = await MilvusClientManager.ensure_fields(user_id, kb_id) or vector_store
 
                     max_batch = 32
 
@@ -147,6 +175,21 @@ class DocumentEmbeddingConsumer:
                     ids = await asyncio.to_thread(store_documents_batch)
 
                     logger.info(f"Document {document_id} processed and stored with {len(ids)} chunks.")
+
+                    # 不支持 Milvus 全文检索的 collection 增量更新本地倒排索引
+                    if MilvusClientManager.get_capabilities(user_id, kb_id).needs_keyword_index:
+                        try:
+                            await KeywordIndexManager.add_documents(
+                                user_id, kb_id, ids, [doc.page_content for doc in splits], file_name
+                            )
+                        except Exception as e:
+                            logger.warning(f"Keyword index update failed for document {document_id}: {e}")
+                            await self.invalidate_keyword_index(user_id, kb_id, document_id)
+                    keyword_index_synced = True
+
+                    # 新切片与倒排索引都已就绪后再递增 collection 版本并广播，使所有 worker 的检索缓存失效；
+                    # 提前递增会让期间开始的检索把缺少新切片的结果缓存到新版本下
+                    await publish_collection_change(user_id, kb_id, "ingest")
                     chunks_data = []
                     for i, (doc, vector_id) in enumerate(zip(splits, ids)):
                         chunks_data.append({
@@ -173,6 +216,12 @@ class DocumentEmbeddingConsumer:
                     logger.error(f"Error during embedding or storage: {e}")
                     error_stack = traceback.format_exc()
                     logger.error(error_stack)
+                    # 分批写入可能已部分成功，这些切片不在倒排索引中
+                    if (vector_store is not None and not keyword_index_synced
+                            and MilvusClientManager.get_capabilities(user_id, kb_id).needs_keyword_index):
+                        await self.invalidate_keyword_index(user_id, kb_id, document_id)
+                    # 同样使检索缓存失效
+                    await publish_collection_change(user_id, kb_id, "ingest")
                     await self.error_message_sender(document_id, str(e))
                 finally:
                     if os.path.exists(tmp_path):
@@ -1,5 +1,5 @@
 import logging
-from typing import AsyncGenerator
+from typing import AsyncGenerator, Optional
 
 from openai import AsyncOpenAI
 
@@ -19,19 +19,37 @@ class OpenAIInstance:
             enable_thinking: bool = False,
             enable_web_search: bool = False,
             provider: str = "openai",
+            client: Optional[AsyncOpenAI] = None,
     ):
         self.model_name = model_name
         self.provider = provider
         self.enable_thinking = enable_thinking
         self.enable_web_search = enable_web_search
 
-        self.client = AsyncOpenAI(
+        # 传入共享 client 时复用其连接池，本实例只携带单次请求的思考 / 搜索开关
+        self.client = client or AsyncOpenAI(
             api_key=api_key,
             base_url=base_url,
             timeout=timeout,
             max_retries=max_retries
         )
 
+    @staticmethod
+    def chat_api_usage(usage) -> dict:
+        return {
+            "prompt_tokens": usage.prompt_tokens or 0,
+            "completion_tokens": usage.completion_tokens or 0,
+            "total_tokens": usage.total_tokens or 0,
+        }
+
+    @staticmethod
+    def response_api_usage(usage) -> dict:
+        return {
+            "prompt_tokens": usage.input_tokens or 0,
+            "completion_tokens": usage.output_tokens or 0,
+            "total_tokens": usage.total_tokens or 0,
+        }
+
     def response_api_extract(self, chunk):
         if chunk.type == 'response.reasoning_summary_text.delta':
             return ResponseWrapper(content=[{"type": "reasoning", "text": chunk.delta}])
@@ -64,6 +82,14 @@ class OpenAIInstance:
             logger.error(f"OpenAI ainvoke error: {e}")
             raise e
 
+    async def warmup(self):
+        """预先建立到模型服务的连接（放入连接池），失败不影响后续请求"""
+        try:
+            await self.client.models.retrieve(self.model_name)
+        except Exception as e:
+            # 部分兼容服务不支持该接口，连接仍会被保留
+            logger.debug(f"OpenAI warmup: {e}")
+
     def get_generate_config(self):
         # 包含tools, extra_body, thinking, reasoning等配置
         tools = []
@@ -159,14 +185,21 @@ class OpenAIInstance:
                     model=self.model_name,
                     messages=messages,
                     stream=True,
+                    # 请求在流末尾返回用量（最后一个 chunk 的 choices 为空）
+                    stream_options={"include_usage": True},
                     **generate_config
                 )
+                usage = None
                 async for chunk in stream:
+                    if getattr(chunk, "usage", None):
+                        usage = self.chat_api_usage(chunk.usage)
                     if not chunk.choices:
                         continue
                     item = self.chat_api_extract(chunk)
                     if item:
                         yield item
+                if usage:
+                    yield ResponseWrapper(content="", usage=usage)
             else:
                 stream = await self.client.responses.create(
                     model=self.model_name,
@@ -175,6 +208,11 @@ class OpenAIInstance:
                     **generate_config
                 )
                 async for chunk in stream:
+                    if chunk.type == 'response.completed':
+                        usage = getattr(chunk.response, "usage", None)
+                        if usage:
+                            yield ResponseWrapper(content="", usage=self.response_api_usage(usage))
+                        continue
                     response = self.response_api_extract(chunk)
                     if response:
                         yield response
@@ -6,6 +6,7 @@ RAG Gateway - 判断是否需要使用RAG检索
 2. 或者需要从知识库中检索相关文档来辅助回答
 
 这样可以避免不必要的检索，节省时间和资源。
+简单问题由本地预分类器（gateway_classifier）直接判断，近似重复的问题复用语义缓存中的决策，均不发起LLM调用。
 """
 
 import logging
@@ -13,6 +14,9 @@ from typing import List, Optional
 
 from pydantic import BaseModel, Field
 
+from gateway_classifier import GatewayPreClassifier
+from history_utils import compact_history
+from semantic_cache_utils import collapse_history, embed_texts, gateway_decision_cache
 from utils import get_langchain_llm, get_structured_data_agent
 
 logger = logging.getLogger(__name__)
@@ -65,6 +69,8 @@ class RAGGateway:
             "name": "deepseek/deepseek-v3.2-251201",
             "provider": "other"
         }
+        # 本地预分类器：规则 + 历史决策近邻投票
+        self.pre_classifier = GatewayPreClassifier()
 
     async def initialize(self):
         """初始化决策模型和结构化输出agent"""
@@ -84,6 +90,7 @@ class RAGGateway:
             self,
             current_question: str,
             history: Optional[List] = None,
+            scope: Optional[str] = None,
     ) -> RAGGatewayDecision:
         """
         判断是否需要使用RAG检索
@@ -91,6 +98,7 @@ class RAGGateway:
         Args:
             current_question: 当前用户问题
             history: 对话历史（字典格式：[{role, content}, ...]）
+            scope: 语义缓存作用域（知识库collection），为空时不使用语义缓存
             
         Returns:
             RAGGatewayDecision对象，包含action和reason
@@ -100,10 +108,41 @@ class RAGGateway:
 
         history = history or []
 
+        # 1. 本地规则
+        local = self.pre_classifier.classify_by_rules(current_question, bool(history))
+        if local:
+            logger.info(f"RAG Gateway本地决策: {local[0]} - {local[1]}")
+            return RAGGatewayDecision(action=local[0], reason=local[1])
+
+        # 问题本身用于近邻投票，问题 + 最近历史用于语义缓存，一次批量向量化
+        self.pre_classifier.ensure_loaded()
+        embedding = cache_embedding = None
+        try:
+            cache_text = collapse_history(current_question, history)
+            texts = [current_question] if cache_text == current_question else [current_question, cache_text]
+            vectors = await embed_texts(texts)
+            embedding, cache_embedding = vectors[0], vectors[-1]
+        except Exception as e:
+            logger.warning(f"RAG Gateway问题向量化失败: {e}")
+
+        if embedding is not None:
+            # 2. 语义缓存
+            if scope:
+                cached = gateway_decision_cache.get(scope, cache_embedding)
+                if cached:
+                    logger.info(f"RAG Gateway缓存决策: {cached[0]} - {cached[1]}")
+                    return RAGGatewayDecision(action=cached[0], reason=cached[1])
+            # 3. 历史决策近邻投票
+            local = self.pre_classifier.classify_by_examples(embedding, bool(history))
+            if local:
+                logger.info(f"RAG Gateway本地决策: {local[0]} - {local[1]}")
+                return RAGGatewayDecision(action=local[0], reason=local[1])
+
         # 使用模块级常量，避免每次调用重建字符串
         messages = [{"role": "system", "content": RAG_GATEWAY_SYSTEM_PROMPT}]
 
-        messages.extend(history)
+        # 对话历史按网关的 token 预算压缩（较早的对话以摘要代替）
+        messages.extend(compact_history(history, "gateway").to_messages())
 
         # 添加当前问题
         messages.append({"role": "user", "content": f"用户问题：{current_question}"})
@@ -113,6 +152,10 @@ class RAGGateway:
             response = await self.structured_agent.ainvoke({"messages": messages})
             response = response['structured_response']
             logger.info(f"RAG Gateway决策: {response.action} - {response.reason}")
+            if scope and cache_embedding is not None:
+                gateway_decision_cache.set(scope, cache_embedding, (response.action, response.reason))
+            # LLM决策作为预分类器的样本
+            await self.pre_classifier.record(current_question, bool(history), embedding, response.action)
             return response
 
         except Exception as e:
@@ -17,7 +17,11 @@ from langchain_core.messages import HumanMessage, AIMessage
 from pydantic import BaseModel, Field
 
 from aiohttp_utils import rerank
+from cache_utils import CollectionVersionRegistry, RetrievalCache
+from history_utils import compact_history
+from keyword_index_utils import KeywordIndexManager, fetch_matched_rows
 from milvus_utils import MilvusClientManager
+from semantic_cache_utils import collapse_history, embed_texts, literal_signature, multi_query_cache
 from utils import get_official_llm, get_embedding_instance, get_structured_data_agent, get_display_docs, \
     unified_llm_stream, get_langchain_llm, filter_grade_threshold, merge_consecutive_chunks
 
@@ -39,7 +43,8 @@ class RAGService:
             self,
             question: str,
             history: list,
-            model_info: dict
+            model_info: dict,
+            scope: Optional[str] = None
     ) -> tuple[list[str], str]:
         """
         生成多角度查询
@@ -48,18 +53,29 @@ class RAGService:
             question: 当前用户问题
             history: 对话历史（LangChain消息格式）
             model_info: 模型配置信息
+            scope: 语义缓存作用域（知识库collection），为空时不使用语义缓存
 
         Returns:
             (多角度查询列表, 评分用查询)
         """
-        # 构建对话历史（最近4轮，即8条消息）
-        history_context = ""
-        if history:
-            recent_history = history[-8:] if len(history) > 8 else history
-            history_context = "\n".join([
-                f"{'用户' if isinstance(m, HumanMessage) else '助手'}: {m.content}"
-                for m in recent_history
-            ])
+        # 近似重复的问题（含最近历史）直接复用已生成的查询
+        cache_embedding = None
+        cache_signature = None
+        if scope:
+            try:
+                cache_text = collapse_history(question, history)
+                # 数字、年份、英文实体不同的问题语义相似度仍很高，要求字面签名一致才复用
+                cache_signature = literal_signature(cache_text)
+                cache_embedding = (await embed_texts([cache_text]))[0]
+                cached = multi_query_cache.get(scope, cache_embedding, cache_signature)
+                if cached:
+                    logger.info(f"多角度查询命中语义缓存: {cached[1]}")
+                    return list(cached[0]), cached[1]
+            except Exception as e:
+                logger.warning(f"多角度查询语义缓存不可用: {e}")
+
+        # 构建对话历史（按查询生成的 token 预算压缩，较早的对话以摘要代替）
+        history_context = compact_history(history, "query_generation").to_text() if history else ""
 
         # 静态指令部分 → SystemMessage（可被缓存）
         system_instruction = """你是检索查询优化专家，负责将用户问题转换为多个高效检索查询。
@@ -166,6 +182,13 @@ class RAGService:
 
         logger.info(f"生成的多角度查询: {result['structured_response'].queries}")
         logger.info(f"生成的评分查询(grade_query): {result['structured_response'].grade_query}")
+        if cache_embedding is not None:
+            multi_query_cache.set(
+                scope,
+                cache_embedding,
+                (tuple(result['structured_response'].queries), result['structured_response'].grade_query),
+                cache_signature
+            )
         return result['structured_response'].queries, result['structured_response'].grade_query
 
     async def parallel_retrieve(
@@ -209,21 +232,37 @@ class RAGService:
                 return []
 
             # 1. 向量检索器 (大幅提高Top-K以增加候选集)
-            retriever = vector_store.as_retriever(search_kwargs={"k": top_k})
+            # 混合检索 collection 使用 dense + BM25 sparse 的 RRF 融合检索
+            capabilities = MilvusClientManager.get_capabilities(user_id, kb_id)
+            retriever = vector_store.as_retriever(search_kwargs=capabilities.search_kwargs(top_k))
+            collection_key = MilvusClientManager.collection_key(user_id, kb_id)
 
             # 定义单个查询的异步检索函数（向量检索）
             async def retrieve_vector(query: str) -> list[Document]:
+                # 检索开始时的版本，检索期间入库则结果写入旧版本
+                version = CollectionVersionRegistry.get(collection_key)
+                cached = RetrievalCache.get(collection_key, version, "vector", query, top_k)
+                if cached is not None:
+                    return cached
                 try:
-                    return await retriever.ainvoke(query)
+                    docs = await retriever.ainvoke(query)
                 except Exception as e:
                     logger.error(f"向量检索出错: {e}")
                     return []
+                RetrievalCache.put(collection_key, version, "vector", query, top_k, docs)
+                return docs
+
+            # 与入库、agentic 检索使用同一判断，保证建索引与增量写入的 collection 一致
+            keyword_index = None
+            if capabilities.needs_keyword_index:
+                keyword_index = KeywordIndexManager.get_index(user_id, kb_id)
+                keyword_index.ensure_built(vector_store, capabilities.has_file_name)
 
             # 定义关键词检索函数（基于Milvus scalar filtering）
             async def retrieve_keyword(query: str) -> list[Document]:
                 """
                 使用 text like '%keyword%' 进行模糊匹配
-                注意：Milvus 的 like 性能较差，仅适合短关键词或作为辅助召回
+                注意：Milvus 的 like 性能较差，本地倒排索引可用时改为按候选 pk 拉取
                 """
                 # 简单的关键词提取策略：如果查询较短，直接用；否则按空格切分取最长的词
                 keywords = []
@@ -236,52 +275,45 @@ class RAGService:
                 if not keywords:
                     return []
 
+                version = CollectionVersionRegistry.get(collection_key)
+                cached = RetrievalCache.get(collection_key, version, "keyword", query, 5)
+                if cached is not None:
+                    return cached
+
                 docs = []
                 try:
-                    # 获取集合对象
-                    # langchain_milvus.Milvus 实例通常有 col 或 collection 属性
-                    col = getattr(vector_store, "col", getattr(vector_store, "collection", None))
-                    if not col:
-                        logger.error("无法获取 Milvus 集合对象")
-                        return []
-
-                    # 检查 fileName 和 chunkIndex 字段是否存在，防止旧版本 collection 报错
-                    has_filename = False
-                    has_chunkindex = False
-                    try:
-                        if hasattr(col, 'schema') and hasattr(col.schema, 'fields'):
-                            fields = col.schema.fields
-                            has_filename = any(field.name == 'fileName' for field in fields)
-                            has_chunkindex = any(field.name == 'chunkIndex' for field in fields)
-                    except Exception as e:
-                        logger.warning(f"检查 schema 失败: {e}")
-
-                    # 准备输出字段
-                    query_output_fields = ["text", "pk", "documentId"]
-                    if has_chunkindex:
-                        query_output_fields.append("chunkIndex")
-                    if has_filename:
-                        logger.info(f"包含文件名检索")
-                        query_output_fields.append("fileName")
+                    # schema 能力在创建实例时已探测并缓存，无需每次查询检查字段
+                    has_filename = capabilities.has_file_name
+                    query_output_fields = capabilities.output_fields
 
                     for kw in keywords:
-                        # 转义特殊字符
-                        safe_kw = kw.replace("'", "\\'").replace('"', '\\"')
-
-                        # 构造表达式: text 字段包含关键词 或 fileName 包含关键词
-                        if has_filename:
-                            expr = f'text like "%{safe_kw}%" or fileName like "%{safe_kw}%"'
-                        else:
-                            expr = f'text like "%{safe_kw}%"'
-
-                        # 使用 run_in_executor 避免阻塞
+                        candidates = await asyncio.to_thread(keyword_index.match, [kw]) if keyword_index else None
+                        res = None
+                        if candidates is not None:
+                            # 倒排索引给出候选 pk，仅拉取候选并校验子串（候选过多时返回 None）
+                            res = await fetch_matched_rows(
+                                vector_store,
+                                candidates,
+                                predicate=lambda r, kw=kw: kw in r.get('text', '') or kw in (r.get('fileName') or ''),
+                                output_fields=query_output_fields,
+                                limit=5
+                            )
+                        if res is None:
+                            # 转义特殊字符
+                            safe_kw = kw.replace("'", "\\'").replace('"', '\\"')
+
+                            # 构造表达式: text 字段包含关键词 或 fileName 包含关键词
+                            if has_filename:
+                                expr = f'text like "%{safe_kw}%" or fileName like "%{safe_kw}%"'
+                            else:
+                                expr = f'text like "%{safe_kw}%"'
 
-                        res = await vector_store.aclient.query(
-                            collection_name=vector_store.collection_name,
-                            filter=expr,
-                            output_fields=query_output_fields,  # 确保获取必要字段
-                            limit=5  # 限制关键词召回数量，避免过多
-                        )
+                            res = await vector_store.aclient.query(
+                                collection_name=vector_store.collection_name,
+                                filter=expr,
+                                output_fields=query_output_fields,  # 确保获取必要字段
+                                limit=5  # 限制关键词召回数量，避免过多
+                            )
 
                         # 转换为 Document 对象
                         for item in res:
@@ -298,17 +330,20 @@ class RAGService:
                             ))
 
                 except Exception as e:
-                    # 关键词检索失败不影响主流程
+                    # 关键词检索失败不影响主流程（失败结果不缓存）
                     logger.warning(f"关键词检索失败: {e}")
+                    return docs
 
+                RetrievalCache.put(collection_key, version, "keyword", query, 5, docs)
                 return docs
 
             # 并行执行所有检索任务
             tasks = []
             for query in query_list:
                 tasks.append(retrieve_vector(query))
-                # 对每个查询也尝试关键词检索
-                tasks.append(retrieve_keyword(query))
+                # 混合检索已包含 BM25 关键词召回（索引查找），仅旧版 collection 需要 LIKE 扫描补充
+                if not capabilities.hybrid:
+                    tasks.append(retrieve_keyword(query))
 
             results = await asyncio.gather(*tasks, return_exceptions=True)
 
@@ -471,7 +506,9 @@ class RAGService:
                 }
 
                 logger.info("开始生成多角度查询...")
-                query_list, grade_query = await self.generate_multi_queries(question, history, model_info)
+                query_list, grade_query = await self.generate_multi_queries(
+                    question, history, model_info, MilvusClientManager.collection_key(user_id, kb_id)
+                )
 
                 yield {
                     "type": "process",
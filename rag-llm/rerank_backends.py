@@ -0,0 +1,303 @@
+"""
+Rerank 后端适配层
+统一不同 rerank 服务的请求 / 响应格式，对外只暴露 score(query, documents) -> [{"index", "relevance_score"}]
+
+- dashscope: 远程 DashScope 风格接口（input.query / input.documents，响应 output.results）
+- pairs: 本地 vLLM rerank 服务（embedding_rerank/service/rerank_service.py 的 /v1/rerank，pairs 列表）
+- onnx: 本地 CPU ONNX（int8）cross-encoder，适合小候选集；依赖 onnxruntime、tokenizers（按需安装）
+
+后端在 model_config.json 的 rerank.<provider> 中通过 "backend" 指定（settings 或模型配置均可，模型配置优先），
+未指定时按 dashscope 处理。合并后的配置按各后端构造参数过滤，其他后端的配置项（如 onnx 的 model_path）会被忽略。
+
+分数尺度：所有后端对外统一返回 [0, 1] 的相关概率，filter_grade_threshold 的高分阈值与检索预算的
+earlyAnswerScore 都按该尺度设定。dashscope / pairs 服务本身返回概率；onnx 模型输出 logit，由 sigmoid 换算。
+服务返回原始 logit 时在配置中设置 "score_scale": "logit"。不同模型的概率分布仍有差异，
+切换后端（含 max_documents 触发的 fallback）时阈值需按模型重新校准。
+"""
+import asyncio
+import inspect
+import logging
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+import numpy as np
+
+from http_client_utils import HttpClientManager
+
+logger = logging.getLogger(__name__)
+
+
+class RerankBackend:
+    """rerank 后端基类"""
+
+    backend_name = "base"
+    # 后端原始分数的尺度："probability"（[0, 1]）或 "logit"
+    default_score_scale = "probability"
+
+    def __init__(
+            self,
+            model_name: str,
+            instruction: Optional[str] = None,
+            max_documents: Optional[int] = None,
+            fallback_provider: Optional[str] = None,
+            score_scale: Optional[str] = None
+    ):
+        self.model_name = model_name
+        # 任务指令（部分模型支持），同时作为分数缓存 key 的一部分
+        self.instruction = instruction
+        # 单次调用的候选文档数上限，超过时改用 fallback_provider 对应的后端
+        self.max_documents = max_documents
+        self.fallback_provider = fallback_provider
+        self.score_scale = score_scale or self.default_score_scale
+        if self.score_scale not in ("probability", "logit"):
+            raise ValueError(f"未知的 rerank 分数尺度: {self.score_scale}")
+
+    async def score(self, query: str, documents: List[str]) -> Tuple[List[dict], int]:
+        """
+        Returns:
+            ([{"index": 分片内索引, "relevance_score": [0, 1] 概率}, ...], 消耗的 token 数)
+        """
+        items, usage = await self._score(query, documents)
+        if items:
+            raw = np.array([float(item["relevance_score"]) for item in items])
+            if self.score_scale == "logit":
+                raw = 1.0 / (1.0 + np.exp(-raw))
+            for item, value in zip(items, np.clip(raw, 0.0, 1.0).tolist()):
+                item["relevance_score"] = value
+        return items, usage
+
+    async def _score(self, query: str, documents: List[str]) -> Tuple[List[dict], int]:
+        """后端原始打分（分数尺度见 score_scale）"""
+        raise NotImplementedError
+
+
+async def _post_json(endpoint: str, payload: dict, headers: dict) -> dict:
+    """发送单个 rerank 请求（复用进程级连接池）"""
+    try:
+        session = await HttpClientManager.get_session(endpoint)
+        async with session.post(
+                endpoint,
+                json=payload,
+                headers=headers,
+        ) as response:
+            if response.status != 200:
+                error_text = await response.text()
+                logger.error(f"Rerank API 错误: {response.status}, {error_text}")
+                raise RuntimeError(f"Rerank API 请求失败: {response.status}")
+            return await response.json()
+    except asyncio.TimeoutError:
+        logger.error("Rerank API 请求超时")
+        raise RuntimeError("Rerank API 请求超时")
+    except aiohttp.ClientError as e:
+        logger.error(f"Rerank API 网络错误: {e}")
+        raise RuntimeError(f"Rerank API 网络错误: {str(e)}")
+
+
+class DashScopeRerankBackend(RerankBackend):
+    """远程 DashScope 风格 rerank 接口"""
+
+    backend_name = "dashscope"
+
+    def __init__(self, model_name: str, endpoint: str, api_key: str, **kwargs):
+        super().__init__(model_name, **kwargs)
+        self.endpoint = endpoint
+        self.headers = {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        }
+
+    async def _score(self, query: str, documents: List[str]) -> Tuple[List[dict], int]:
+        parameters = {
+            # 文档内容由调用方按索引回填，无需服务端返回，节省带宽
+            "return_documents": False
+            # 不在这里设置top_n，让API返回所有文档的排序结果
+        }
+        if self.instruction:
+            parameters["instruct"] = self.instruction
+        payload = {
+            "model": self.model_name,
+            "input": {
+                "query": query,
+                "documents": documents
+            },
+            "parameters": parameters
+        }
+        result = await _post_json(self.endpoint, payload, self.headers)
+        items = result.get("output", {}).get("results", [])
+        usage = (result.get("usage") or {}).get("total_tokens", 0)
+        return [{"index": item["index"], "relevance_score": item.get("relevance_score", 0)} for item in items], usage
+
+
+class PairsRerankBackend(RerankBackend):
+    """本地 vLLM rerank 服务（/v1/rerank，query-document pairs）"""
+
+    backend_name = "pairs"
+
+    def __init__(self, model_name: str, endpoint: str, api_key: Optional[str] = None, **kwargs):
+        super().__init__(model_name, **kwargs)
+        self.endpoint = endpoint
+        self.headers = {"Content-Type": "application/json"}
+        if api_key:
+            self.headers["Authorization"] = f"Bearer {api_key}"
+
+    async def _score(self, query: str, documents: List[str]) -> Tuple[List[dict], int]:
+        payload = {
+            "pairs": [{"query": query, "document": doc} for doc in documents],
+            "model": self.model_name,
+        }
+        # 未配置时使用服务端默认指令
+        if self.instruction:
+            payload["instruction"] = self.instruction
+        result = await _post_json(self.endpoint, payload, self.headers)
+        items = result.get("results", [])
+        return [{"index": item["index"], "relevance_score": item.get("relevance_score", 0)} for item in items], 0
+
+
+class OnnxCrossEncoderBackend(RerankBackend):
+    """
+    本地 CPU ONNX cross-encoder（如 int8 量化的 bge-reranker）
+    model_path 指向包含 model.onnx 与 tokenizer.json 的目录，首次调用时加载
+    """
+
+    backend_name = "onnx"
+    default_score_scale = "logit"
+
+    def __init__(
+            self,
+            model_name: str,
+            model_path: str,
+            max_length: int = 512,
+            batch_size: int = 16,
+            num_threads: Optional[int] = None,
+            **kwargs
+    ):
+        super().__init__(model_name, **kwargs)
+        self.model_path = model_path
+        self.max_length = max_length
+        self.batch_size = batch_size
+        self.num_threads = num_threads
+        self._session = None
+        self._tokenizer = None
+        self._input_names: List[str] = []
+        self._load_lock = threading.Lock()
+
+    def _load(self):
+        with self._load_lock:
+            if self._session is not None:
+                return
+            try:
+                import onnxruntime as ort
+                from tokenizers import Tokenizer
+            except ImportError as e:
+                raise RuntimeError(f"onnx rerank 后端需要安装 onnxruntime 与 tokenizers: {e}")
+
+            options = ort.SessionOptions()
+            if self.num_threads:
+                options.intra_op_num_threads = self.num_threads
+            session = ort.InferenceSession(
+                os.path.join(self.model_path, "model.onnx"),
+                sess_options=options,
+                providers=["CPUExecutionProvider"],
+            )
+            tokenizer = Tokenizer.from_file(os.path.join(self.model_path, "tokenizer.json"))
+            tokenizer.enable_truncation(max_length=self.max_length)
+            tokenizer.enable_padding()
+
+            self._input_names = [i.name for i in session.get_inputs()]
+            self._tokenizer = tokenizer
+            self._session = session
+            logger.info(f"[Rerank] onnx cross-encoder loaded: {self.model_path}")
+
+    def _score_sync(self, query: str, documents: List[str]) -> List[float]:
+        self._load()
+        scores: List[float] = []
+        for start in range(0, len(documents), self.batch_size):
+            encodings = self._tokenizer.encode_batch([(query, doc) for doc in documents[start:start + self.batch_size]])
+            inputs = {
+                "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+                "attention_mask": np.array([e.attention_mask for e in encodings], dtype=np.int64),
+                "token_type_ids": np.array([e.type_ids for e in encodings], dtype=np.int64),
+            }
+            logits = self._session.run(None, {k: v for k, v in inputs.items() if k in self._input_names})[0]
+            if logits.ndim == 2 and logits.shape[1] == 2:
+                # 二分类输出取正负类 logit 之差，sigmoid 后即正类概率
+                logits = logits[:, 1] - logits[:, 0]
+            scores.extend(logits.reshape(-1).tolist())
+        return scores
+
+    async def _score(self, query: str, documents: List[str]) -> Tuple[List[dict], int]:
+        scores = await asyncio.to_thread(self._score_sync, query, documents)
+        return [{"index": i, "relevance_score": s} for i, s in enumerate(scores)], 0
+
+
+_BACKENDS = {
+    DashScopeRerankBackend.backend_name: DashScopeRerankBackend,
+    PairsRerankBackend.backend_name: PairsRerankBackend,
+    OnnxCrossEncoderBackend.backend_name: OnnxCrossEncoderBackend,
+}
+
+_instances: Dict[Tuple[str, str], RerankBackend] = {}
+
+
+def _accepted_settings(backend_cls: type) -> set:
+    """后端构造函数（含基类）接受的配置项"""
+    names = set()
+    for cls in backend_cls.__mro__:
+        if "__init__" in vars(cls) and issubclass(cls, RerankBackend):
+            for param in inspect.signature(cls.__init__).parameters.values():
+                if param.kind in (inspect.Parameter.POSITIONAL_OR_KEYWORD, inspect.Parameter.KEYWORD_ONLY):
+                    names.add(param.name)
+    return names - {"self", "model_name"}
+
+
+def get_rerank_backend(rerank_config: dict, provider: Optional[str] = None, model_name: Optional[str] = None) -> RerankBackend:
+    """
+    根据 model_config.json 的 rerank 配置获取后端实例（按 provider/model 缓存）
+
+    Args:
+        rerank_config: model_config.json 中的 rerank 配置
+        provider: 服务提供商，None 时使用 rerank.default_provider（默认 "qwen"）
+        model_name: 模型名称，None 时使用 settings.default_model 或该 provider 下的第一个模型
+    """
+    provider = provider or rerank_config.get("default_provider", "qwen")
+    try:
+        provider_config = rerank_config[provider]
+    except KeyError:
+        raise ValueError(f"无效的rerank配置: provider={provider}")
+
+    settings = provider_config.get("settings", {})
+    if model_name is None:
+        model_name = settings.get("default_model") or next(
+            (k for k in provider_config if k != "settings"), None
+        )
+    if model_name is None:
+        raise ValueError(f"未找到 {provider} 的 rerank 模型配置")
+
+    key = (provider, model_name)
+    if key in _instances:
+        return _instances[key]
+
+    # 合并配置：公共配置 < 模型特定配置
+    merged = {k: v for k, v in settings.items() if k != "default_model"}
+    merged.update(provider_config.get(model_name, {}))
+    backend_name = merged.pop("backend", DashScopeRerankBackend.backend_name)
+    backend_cls = _BACKENDS.get(backend_name)
+    if backend_cls is None:
+        raise ValueError(f"未知的 rerank 后端: {backend_name}")
+
+    if backend_cls is not OnnxCrossEncoderBackend and not merged.get("endpoint"):
+        raise ValueError(f"未找到模型 {model_name} 的 endpoint 配置")
+    if backend_cls is DashScopeRerankBackend and not merged.get("api_key"):
+        raise ValueError(f"未找到 {provider} 的 api_key 配置")
+
+    # settings 为 provider 下所有模型共享，只传入该后端支持的配置项
+    accepted = _accepted_settings(backend_cls)
+    ignored = sorted(k for k in merged if k not in accepted)
+    if ignored:
+        logger.info(f"[Rerank] {backend_name} 后端忽略配置项: {ignored}")
+    backend = backend_cls(model_name=model_name, **{k: v for k, v in merged.items() if k in accepted})
+    _instances[key] = backend
+    logger.info(f"[Rerank] backend ready: provider={provider}, model={model_name}, backend={backend_name}")
+    return backend
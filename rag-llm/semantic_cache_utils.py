@@ -0,0 +1,188 @@
+"""
+语义缓存
+跨会话、跨用户的近似重复问题复用结构化 LLM 调用的结果（RAG Gateway 决策、多角度查询）
+
+- key 文本：当前问题 + 最近几条对话历史（截断），经本地 embedding 服务向量化
+- 按作用域（知识库 collection）隔离，每个作用域一个内存向量矩阵，余弦相似度超过阈值即命中
+- 可选的字面签名（key 文本中的数字与拉丁词元）：相似度只反映语义，"2023年营收" 与 "2024年营收"
+  的余弦相似度也会超过阈值，带签名的条目仅在签名完全一致时命中
+- 条目带 TTL，作用域内超出容量时优先淘汰过期条目，否则淘汰最久未命中的条目
+- 命中率等统计每隔 LOG_INTERVAL 次查询输出一次
+"""
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional
+
+import numpy as np
+
+from utils import get_embedding_instance
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_CONFIG = {
+    "name": "text-embedding-v4",
+    "provider": "qwen",
+}
+
+
+def collapse_history(question: str, history: Optional[list], max_messages: int = 2, max_chars: int = 200) -> str:
+    """
+    构建缓存 key 文本：最近 max_messages 条历史（各截断到 max_chars）+ 当前问题
+    history 支持字典格式（{role, content}）与 LangChain 消息
+    """
+    if not history:
+        return question
+    lines = []
+    for msg in history[-max_messages:]:
+        content = msg.get("content") if isinstance(msg, dict) else getattr(msg, "content", "")
+        if isinstance(content, str) and content:
+            lines.append(content[:max_chars])
+    lines.append(question)
+    return "\n".join(lines)
+
+
+_LITERAL_PATTERN = re.compile(r"\d+(?:\.\d+)?|[A-Za-z][A-Za-z0-9_\-]*")
+
+
+def literal_signature(text: str) -> tuple:
+    """提取文本中的数字与拉丁词元（年份、版本号、型号、英文实体等），作为语义缓存的命中前提"""
+    return tuple(sorted({token.casefold() for token in _LITERAL_PATTERN.findall(text)}))
+
+
+async def embed_texts(texts: List[str]) -> np.ndarray:
+    """批量向量化并归一化（行向量）"""
+    embeddings = get_embedding_instance(EMBEDDING_CONFIG)
+    vectors = np.asarray(await embeddings.aembed_documents(texts), dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+
+class _Scope:
+    """单个作用域内的向量矩阵与条目（容量按需倍增）"""
+
+    INITIAL_CAPACITY = 16
+
+    def __init__(self, dim: int):
+        self.vectors = np.zeros((self.INITIAL_CAPACITY, dim), dtype=np.float32)
+        self.values: List[Any] = [None] * self.INITIAL_CAPACITY
+        self.signatures: List[Optional[Hashable]] = [None] * self.INITIAL_CAPACITY
+        self.created = np.full(self.INITIAL_CAPACITY, -np.inf)
+        self.last_used = np.full(self.INITIAL_CAPACITY, -np.inf)
+        self.size = 0
+
+    def grow(self, capacity: int):
+        extra = capacity - len(self.values)
+        self.vectors = np.vstack([self.vectors, np.zeros((extra, self.vectors.shape[1]), dtype=np.float32)])
+        self.values.extend([None] * extra)
+        self.signatures.extend([None] * extra)
+        self.created = np.concatenate([self.created, np.full(extra, -np.inf)])
+        self.last_used = np.concatenate([self.last_used, np.full(extra, -np.inf)])
+
+
+class SemanticCache:
+    """
+    按作用域隔离的语义缓存（线程安全）
+    - threshold: 命中所需的最低余弦相似度
+    - max_entries: 单个作用域的最大条目数
+    - max_scopes: 最多保留的作用域数，超出后淘汰最久未使用的作用域
+    - ttl: 条目存活秒数
+    """
+
+    LOG_INTERVAL = 1000
+
+    def __init__(
+            self,
+            name: str,
+            threshold: float = 0.95,
+            max_entries: int = 1000,
+            max_scopes: int = 64,
+            ttl: float = 3600
+    ):
+        self.name = name
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.max_scopes = max_scopes
+        self.ttl = ttl
+        self._scopes: "OrderedDict[str, _Scope]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, scope: str, embedding: np.ndarray, signature: Optional[Hashable] = None) -> Any:
+        """
+        Args:
+            signature: 字面签名，非空时只匹配写入时签名相同的条目
+        """
+        now = time.monotonic()
+        value = None
+        with self._lock:
+            entries = self._scopes.get(scope)
+            if entries is not None and entries.size and entries.vectors.shape[1] == embedding.shape[0]:
+                self._scopes.move_to_end(scope)
+                n = entries.size
+                similarities = entries.vectors[:n] @ embedding
+                similarities[now - entries.created[:n] > self.ttl] = -np.inf
+                if signature is not None:
+                    mismatched = [i for i in range(n) if entries.signatures[i] != signature]
+                    similarities[mismatched] = -np.inf
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    entries.last_used[best] = now
+                    value = entries.values[best]
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            lookups = self.hits + self.misses
+        if lookups % self.LOG_INTERVAL == 0:
+            logger.info(f"[SemanticCache:{self.name}] {self.stats()}")
+        return value
+
+    def set(self, scope: str, embedding: np.ndarray, value: Any, signature: Optional[Hashable] = None):
+        now = time.monotonic()
+        with self._lock:
+            entries = self._scopes.get(scope)
+            if entries is None or entries.vectors.shape[1] != embedding.shape[0]:
+                entries = _Scope(embedding.shape[0])
+                self._scopes[scope] = entries
+                while len(self._scopes) > self.max_scopes:
+                    self._scopes.popitem(last=False)
+            self._scopes.move_to_end(scope)
+
+            if entries.size < self.max_entries:
+                if entries.size == len(entries.values):
+                    entries.grow(min(entries.size * 2, self.max_entries))
+                slot = entries.size
+                entries.size += 1
+            else:
+                expired = np.flatnonzero(now - entries.created > self.ttl)
+                slot = int(expired[0]) if len(expired) else int(np.argmin(entries.last_used))
+                self.evictions += 1
+            entries.vectors[slot] = embedding
+            entries.values[slot] = value
+            entries.signatures[slot] = signature
+            entries.created[slot] = now
+            entries.last_used[slot] = now
+
+    def invalidate(self, scope: str):
+        with self._lock:
+            self._scopes.pop(scope, None)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "scopes": len(self._scopes),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+# RAG Gateway 决策：(action, reason)
+gateway_decision_cache = SemanticCache("gateway_decision", threshold=0.95, ttl=6 * 3600)
+# 多角度查询：(queries, grade_query)，读写时需带 literal_signature，数字 / 英文实体不同的问题不复用
+multi_query_cache = SemanticCache("multi_query", threshold=0.97, ttl=3600)
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import logging
 import time
@@ -8,9 +9,13 @@ from fastapi.responses import StreamingResponse
 from langchain_core.messages import HumanMessage, AIMessage
 from pydantic import BaseModel, Field
 
-from agentic_rag_utils import AgenticRAGService
+from agentic_rag_utils import AgenticSessionStore
+from gateway_classifier import GatewayPreClassifier
+from milvus_utils import MilvusClientManager
 from rag_gateway import get_rag_gateway
 from rag_utils import rag_service
+from sse_utils import text_frame, json_frame, coalesce_deltas
+from token_utils import IncrementalTokenCounter
 from utils import get_official_llm, cut_history, get_token_count, unified_llm_stream, get_langchain_llm, \
     get_structured_data_agent
 
@@ -51,11 +56,34 @@ async def get_session_name(body: dict = Body()):
     return {"title": title}
 
 
+def _resolve_usage(
+        provider_usage: Optional[dict],
+        prompt_tokens: int,
+        cot_counter: IncrementalTokenCounter,
+        content_counter: IncrementalTokenCounter
+) -> dict:
+    """
+    计算用量：优先使用服务商返回的用量（按模型自身分词器计算，准确），
+    缺失时回退到本地 cl100k_base 估算（思考内容与回答内容已在流式过程中增量计数）
+    """
+    if provider_usage and provider_usage.get("completion_tokens"):
+        prompt = provider_usage.get("prompt_tokens") or prompt_tokens
+        completion = provider_usage["completion_tokens"]
+    else:
+        prompt = prompt_tokens
+        completion = cot_counter.total + content_counter.total
+    return {
+        "prompt_tokens": prompt,
+        "completion_tokens": completion,
+        "total_tokens": prompt + completion,
+    }
+
+
 async def process_rag_stream_events(stream_iterator, prompt_tokens: int = 0):
     """
     处理RAG流式事件的通用逻辑
     
-    处理所有类型的事件：process, thinking, content, system_prompt
+    处理所有类型的事件：process, thinking, content, system_prompt, usage
     并在结束时发送汇总和使用统计
     
     Args:
@@ -65,70 +93,52 @@ async def process_rag_stream_events(stream_iterator, prompt_tokens: int = 0):
     Yields:
         SSE格式的流式数据
     """
-    full_content = ""
-    cot_content = ""
+    # 思考内容与回答内容分别增量计数，不再拼接全文
+    content_counter = IncrementalTokenCounter()
+    cot_counter = IncrementalTokenCounter()
+    provider_usage = None
     rag_process_data = []
     start_time = time.time()
 
-    # 处理流式事件
-    async for item in stream_iterator:
+    # 处理流式事件（连续的小增量合并后再编码发送）
+    async for item in coalesce_deltas(stream_iterator):
         if item["type"] == "process":
             # 检索过程信息
             rag_process_data.append(item["payload"])
-            # 对payload进行json.dumps包裹，防止特殊字符导致JSON解析错误
-            process_data = {
-                "type": "process",
-                "payload": json.dumps(item["payload"], ensure_ascii=False)
-            }
-            yield f"data: {json.dumps(process_data, ensure_ascii=False)}\n\n"
+            # payload编码为JSON字符串后写入，防止特殊字符导致JSON解析错误
+            yield json_frame("process", item["payload"])
         elif item["type"] == "thinking":
             # 思考内容
             content = item["payload"]
             if content:
-                cot_content += content
-                # 对content进行json.dumps包裹，防止特殊字符导致JSON解析错误
-                data = {
-                    "type": "thinking",
-                    "payload": json.dumps(content, ensure_ascii=False)
-                }
-                yield f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+                cot_counter.add(content)
+                yield text_frame("thinking", content)
         elif item["type"] == "content":
             # 答案内容
             content = item["payload"]
             if content:
-                full_content += content
-                # 对content进行json.dumps包裹，防止特殊字符导致JSON解析错误
-                data = {
-                    "type": "content",
-                    "payload": json.dumps(content, ensure_ascii=False)
-                }
-                yield f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+                content_counter.add(content)
+                yield text_frame("content", content)
         elif item["type"] == "system_prompt":
             # 接收系统提示词，用于计算token数
             system_prompt_text = item["payload"]
             # 将系统提示词的token数计入prompt_tokens
             prompt_tokens += get_token_count(system_prompt_text)
+        elif item["type"] == "usage":
+            # 服务商返回的生成阶段用量
+            provider_usage = item["payload"]
 
     # 发送RAG过程汇总
     if rag_process_data:
-        # 对payload进行json.dumps包裹，防止特殊字符导致JSON解析错误
-        rag_summary = {
-            "type": "rag_summary",
-            "payload": json.dumps(rag_process_data, ensure_ascii=False)
-        }
-        yield f"data: {json.dumps(rag_summary, ensure_ascii=False)}\n\n"
+        yield json_frame("rag_summary", rag_process_data)
 
     # 发送使用统计
     end_time = time.time()
     latency_ms = int((end_time - start_time) * 1000)
-    # 计算输出token：包括思考内容和回答内容
-    completion_tokens = get_token_count(cot_content) + get_token_count(full_content)
     usage_data = {
         "type": "usage",
         "payload": {
-            "prompt_tokens": prompt_tokens,
-            "completion_tokens": completion_tokens,
-            "total_tokens": prompt_tokens + completion_tokens,
+            **_resolve_usage(provider_usage, prompt_tokens, cot_counter, content_counter),
             "latency_ms": latency_ms
         }
     }
@@ -137,40 +147,85 @@ async def process_rag_stream_events(stream_iterator, prompt_tokens: int = 0):
 
 async def stream_generator(model_instance, messages, prompt_tokens: int = 0, options: dict = None):
     """纯LLM流式响应生成器"""
-    cot_content = ""
-    full_content = ""
+    cot_counter = IncrementalTokenCounter()
+    content_counter = IncrementalTokenCounter()
+    provider_usage = None
     start_time = time.time()  # Start timing
 
-    async for item in unified_llm_stream(model_instance, messages):
+    async for item in coalesce_deltas(unified_llm_stream(model_instance, messages)):
         content = item["payload"]
+        if item["type"] == "usage":
+            provider_usage = content
+            continue
         if item["type"] == "thinking":
-            cot_content += content
+            cot_counter.add(content)
         elif item["type"] == "content":
-            full_content += content
+            content_counter.add(content)
 
-        # 对content进行json.dumps包裹，防止特殊字符导致JSON解析错误
-        data = {
-            "type": item["type"],
-            "payload": json.dumps(content, ensure_ascii=False)
-        }
-        yield f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+        yield text_frame(item["type"], content)
 
     end_time = time.time()
     latency_ms = int((end_time - start_time) * 1000)  # Calculate latency
-    # 计算输出token：包括思考内容和回答内容
-    completion_tokens = get_token_count(cot_content) + get_token_count(full_content)
     usage_data = {
         "type": "usage",
         "payload": {
-            "prompt_tokens": prompt_tokens,
-            "completion_tokens": completion_tokens,
-            "total_tokens": prompt_tokens + completion_tokens,
+            **_resolve_usage(provider_usage, prompt_tokens, cot_counter, content_counter),
             "latency_ms": latency_ms  # Add latency_ms
         }
     }
     yield f"data: {json.dumps(usage_data)}\n\n"
 
 
+def _rag_events(
+        question: str,
+        history: list,
+        model_info: dict,
+        kb_id: Optional[int],
+        user_id: Optional[int],
+        system_prompt: Optional[str],
+        options: Optional[dict],
+):
+    """传统RAG事件流（未编码为SSE）"""
+    return rag_service.stream_rag_response_with_process(
+        question=question,
+        history=history,
+        model_info=model_info,
+        kb_id=kb_id,
+        user_id=user_id,
+        system_prompt=system_prompt,
+        options=options,
+        retrieve_k=30,
+        grade_top_n=50,
+        grade_score_threshold=0.35,
+        context_top_n=25,
+    )
+
+
+async def _agentic_rag_events(
+        question: str,
+        history: list,
+        model_info: dict,
+        kb_id: Optional[int],
+        user_id: Optional[int],
+        max_rounds: int,
+        system_prompt: Optional[str],
+        options: Optional[dict],
+        session_key: Optional[str] = None,
+):
+    """Agentic RAG事件流（未编码为SSE）"""
+    # 获取Agentic RAG服务（同一会话内复用，事件流结束前独占）
+    async with AgenticSessionStore.acquire(session_key, user_id, kb_id) as agentic_rag:
+        async for event in agentic_rag.stream_agentic_rag_response_with_process(
+                question=question,
+                history=history,
+                model_info=model_info,
+                system_prompt=system_prompt,
+                options=options,
+                max_rounds=max_rounds
+        ):
+            yield event
+
+
 async def rag_stream_generator(
         question: str,
         history: list,
@@ -190,19 +245,7 @@ async def rag_stream_generator(
     3. 并行评估文档相关性
     4. 流式生成答案
     """
-    stream_iterator = rag_service.stream_rag_response_with_process(
-        question=question,
-        history=history,
-        model_info=model_info,
-        kb_id=kb_id,
-        user_id=user_id,
-        system_prompt=system_prompt,
-        options=options,
-        retrieve_k=30,
-        grade_top_n=50,
-        grade_score_threshold=0.35,
-        context_top_n=25,
-    )
+    stream_iterator = _rag_events(question, history, model_info, kb_id, user_id, system_prompt, options)
 
     # 使用通用的事件处理逻辑
     async for item in process_rag_stream_events(stream_iterator, prompt_tokens):
@@ -219,6 +262,7 @@ async def agentic_rag_stream_generator(
         system_prompt: Optional[str] = None,
         prompt_tokens: int = 0,
         options: dict = None,
+        session_key: Optional[str] = None,
 ):
     """
     Agentic RAG流式响应生成器
@@ -238,24 +282,13 @@ async def agentic_rag_stream_generator(
         system_prompt: 自定义系统提示词
         prompt_tokens: 已有的prompt tokens数
         options: 其他选项
+        session_key: 会话标识（用于复用会话级检索状态）
         
     Yields:
         SSE格式的流式数据
     """
-    # 初始化Agentic RAG服务
-    agentic_rag = AgenticRAGService(
-        user_id=user_id,
-        kb_id=kb_id
-    )
-
-    # 创建流式迭代器
-    stream_iterator = agentic_rag.stream_agentic_rag_response_with_process(
-        question=question,
-        history=history,
-        model_info=model_info,
-        system_prompt=system_prompt,
-        options=options,
-        max_rounds=max_rounds
+    stream_iterator = _agentic_rag_events(
+        question, history, model_info, kb_id, user_id, max_rounds, system_prompt, options, session_key
     )
 
     # 使用通用的事件处理逻辑
@@ -263,6 +296,119 @@ async def agentic_rag_stream_generator(
         yield item
 
 
+class _SpeculativeStream:
+    """
+    在网关决策返回前，于后台预先消费RAG事件流（查询生成 / 首轮Agentic检索 / Milvus连接预热）并缓存事件
+
+    - 遇到 system_prompt 事件（检索结束、即将调用LLM生成答案）时暂停，确认使用RAG后才继续，
+      避免为最终不走RAG的请求生成答案
+    - confirm 后按原顺序回放缓存事件并继续透传；cancel 取消后台检索
+    """
+
+    _END = object()
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._confirmed = asyncio.Event()
+        self._task = asyncio.create_task(self._pump())
+
+    async def _pump(self):
+        try:
+            async for item in self._stream:
+                self._queue.put_nowait(item)
+                if item["type"] == "system_prompt":
+                    await self._confirmed.wait()
+        except Exception as e:
+            # 异常在回放时抛给调用方，与非预测模式的行为一致
+            self._queue.put_nowait(e)
+        finally:
+            self._queue.put_nowait(self._END)
+            await self._stream.aclose()
+
+    async def confirm(self):
+        """确认使用RAG：回放已缓存的事件并继续透传后续事件"""
+        self._confirmed.set()
+        try:
+            while True:
+                item = await self._queue.get()
+                if item is self._END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            await self.cancel()
+
+    async def cancel(self):
+        """放弃预测结果，取消后台检索"""
+        if not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+
+async def _decide_use_rag(current_question: str, history: list, scope: Optional[str] = None) -> bool:
+    """调用RAG Gateway判断是否需要检索，失败时默认使用RAG"""
+    try:
+        gateway = await get_rag_gateway()
+        decision = await gateway.decide(
+            current_question=current_question,
+            history=history,
+            scope=scope
+        )
+        logger.info(f"RAG Gateway决策: {decision.action} - {decision.reason}")
+        # 根据决策结果设置是否使用RAG
+        if decision.action == "use_rag":
+            return True
+        logger.info(f"跳过RAG检索，直接使用LLM回答。原因: {decision.reason}")
+        return False
+    except Exception as e:
+        logger.error(f"RAG Gateway判断失败: {e}，默认使用RAG检索")
+        return True  # 默认使用RAG
+
+
+async def speculative_rag_stream_generator(
+        rag_events,
+        current_question: str,
+        gateway_history: list,
+        llm_stream_factory,
+        prompt_tokens: int = 0,
+        gateway_scope: Optional[str] = None,
+):
+    """
+    预测式RAG流式响应生成器
+
+    网关决策与检索同时启动：
+    - 决策为 use_rag：回放已完成的检索过程并继续生成答案，省去等待网关的一次LLM往返
+    - 决策为 direct_answer：取消检索，改用纯LLM回答
+
+    Args:
+        rag_events: RAG事件流（_rag_events / _agentic_rag_events）
+        current_question: 当前用户问题
+        gateway_history: 供网关判断的对话历史（不包含当前问题）
+        llm_stream_factory: 创建纯LLM流式响应的函数
+        prompt_tokens: 已有的prompt tokens数
+        gateway_scope: 网关语义缓存作用域
+    """
+    speculative = _SpeculativeStream(rag_events)
+    try:
+        use_rag = await _decide_use_rag(current_question, gateway_history, gateway_scope)
+    except BaseException:
+        await speculative.cancel()
+        raise
+
+    if use_rag:
+        async for item in process_rag_stream_events(speculative.confirm(), prompt_tokens):
+            yield item
+    else:
+        await speculative.cancel()
+        async for item in llm_stream_factory():
+            yield item
+
+
 def build_langchain_messages(history: list) -> list:
     """
     将历史消息转换为LangChain消息格式
@@ -294,6 +440,19 @@ options:
 """
 
 
+def _session_key(options: dict, history: list) -> Optional[str]:
+    """
+    会话标识：优先使用 options.sessionId（rag-server 传入），
+    否则使用会话第一条消息的 id（同一会话内不变）
+    """
+    session_id = options.get('sessionId')
+    if session_id is not None:
+        return f"session:{session_id}"
+    if history and isinstance(history[0], dict) and history[0].get('id') is not None:
+        return f"first_message:{history[0]['id']}"
+    return None
+
+
 @chat_service.post("/stream")
 async def chat_stream(
         request: Request,
@@ -316,6 +475,9 @@ async def chat_stream(
     if model.get("provider") == "anthropic":
         model["name"] = "claude-4.5-haiku"
 
+    # 会话标识需在截断历史之前确定
+    session_key = _session_key(options, history)
+
     prompt_tokens = 0
     if history:
         history, prompt_tokens = cut_history(history, model, context_multiplier)
@@ -341,68 +503,8 @@ async def chat_stream(
             media_type="text/event-stream"
         )
 
-    # 如果有知识库ID，先使用RAG Gateway判断是否需要检索
-    use_rag = False  # 标记是否使用RAG
-    if kb_id and user_id:
-        # 调用RAG Gateway进行判断
-        try:
-            gateway = await get_rag_gateway()
-            decision = await gateway.decide(
-                current_question=current_question,
-                history=history[:-1]  # 不包含当前问题
-            )
-            logger.info(f"RAG Gateway决策: {decision.action} - {decision.reason}")
-            # 根据决策结果设置是否使用RAG
-            if decision.action == "use_rag":
-                use_rag = True
-            else:
-                logger.info(f"跳过RAG检索，直接使用LLM回答。原因: {decision.reason}")
-                use_rag = False
-        except Exception as e:
-            logger.error(f"RAG Gateway判断失败: {e}，默认使用RAG检索")
-            use_rag = True  # 默认使用RAG
-
-    # 根据判断结果选择模式
-    if use_rag and kb_id and user_id:
-        # 使用RAG模式
-        # 检查是否使用 Agentic RAG 模式
-        use_agentic_rag = options.get('agenticRag', True)  # 默认使用Agentic RAG模式，除非明确设置为False
-        max_rounds = options.get('maxRounds', 10)  # Agentic RAG的最大轮次
-
-        if use_agentic_rag:
-            logger.info(f"使用Agentic RAG模式，知识库ID: {kb_id}, 用户ID: {user_id}, 最大轮次: {max_rounds}")
-            return StreamingResponse(
-                agentic_rag_stream_generator(
-                    question=current_question,
-                    history=langchain_messages,
-                    model_info=model,
-                    kb_id=kb_id,
-                    user_id=user_id,
-                    max_rounds=max_rounds,
-                    system_prompt=system_prompt,
-                    prompt_tokens=prompt_tokens,
-                    options=options
-                ),
-                media_type="text/event-stream"
-            )
-        else:
-            logger.info(f"使用传统RAG模式，知识库ID: {kb_id}, 用户ID: {user_id}")
-            return StreamingResponse(
-                rag_stream_generator(
-                    question=current_question,
-                    history=langchain_messages,
-                    model_info=model,
-                    kb_id=kb_id,
-                    user_id=user_id,
-                    system_prompt=system_prompt,
-                    prompt_tokens=prompt_tokens,
-                    options=options
-                ),
-                media_type="text/event-stream"
-            )
-
-    # 否则使用纯LLM模式
-    else:
+    def llm_stream():
+        """纯LLM模式"""
         logger.info("使用纯LLM模式")
         llm = get_official_llm(
             model,
@@ -418,7 +520,80 @@ async def chat_stream(
                 messages.append({"role": "user", "content": msg.content})
             elif isinstance(msg, AIMessage):
                 messages.append({"role": "assistant", "content": msg.content})
+        return stream_generator(llm, messages, prompt_tokens=prompt_tokens, options=options)
+
+    if not (kb_id and user_id):
+        return StreamingResponse(llm_stream(), media_type="text/event-stream")
+
+    # 检查是否使用 Agentic RAG 模式
+    use_agentic_rag = options.get('agenticRag', True)  # 默认使用Agentic RAG模式，除非明确设置为False
+    max_rounds = options.get('maxRounds', 10)  # Agentic RAG的最大轮次
+    # 网关决策按知识库缓存
+    gateway_scope = MilvusClientManager.collection_key(user_id, kb_id)
+
+    # 本地规则已判定无需检索（问候、对上一轮回答的格式调整等）时直接回答，不启动检索也不调用网关
+    local = GatewayPreClassifier.classify_by_rules(current_question, bool(history[:-1]))
+    if local is not None and local[0] == "direct_answer":
+        logger.info(f"跳过RAG检索，直接使用LLM回答。原因: {local[1]}")
+        return StreamingResponse(llm_stream(), media_type="text/event-stream")
+
+    # 预测模式（可选，options.speculativeRag）：网关决策与检索并行启动，决策为不检索时取消检索。
+    # 网关判定不检索时已发起的检索即为浪费，默认关闭
+    if options.get('speculativeRag', False):
+        if use_agentic_rag:
+            logger.info(f"预测式Agentic RAG，知识库ID: {kb_id}, 用户ID: {user_id}, 最大轮次: {max_rounds}")
+            rag_events = _agentic_rag_events(
+                current_question, langchain_messages, model, kb_id, user_id, max_rounds, system_prompt, options,
+                session_key
+            )
+        else:
+            logger.info(f"预测式传统RAG，知识库ID: {kb_id}, 用户ID: {user_id}")
+            rag_events = _rag_events(current_question, langchain_messages, model, kb_id, user_id, system_prompt, options)
         return StreamingResponse(
-            stream_generator(llm, messages, prompt_tokens=prompt_tokens, options=options),
+            speculative_rag_stream_generator(
+                rag_events,
+                current_question=current_question,
+                gateway_history=history[:-1],  # 不包含当前问题
+                llm_stream_factory=llm_stream,
+                prompt_tokens=prompt_tokens,
+                gateway_scope=gateway_scope,
+            ),
             media_type="text/event-stream"
         )
+
+    # 先使用RAG Gateway判断是否需要检索
+    if not await _decide_use_rag(current_question, history[:-1], gateway_scope):
+        return StreamingResponse(llm_stream(), media_type="text/event-stream")
+
+    # 使用RAG模式
+    if use_agentic_rag:
+        logger.info(f"使用Agentic RAG模式，知识库ID: {kb_id}, 用户ID: {user_id}, 最大轮次: {max_rounds}")
+        return StreamingResponse(
+            agentic_rag_stream_generator(
+                question=current_question,
+                history=langchain_messages,
+                model_info=model,
+                kb_id=kb_id,
+                user_id=user_id,
+                max_rounds=max_rounds,
+                system_prompt=system_prompt,
+                prompt_tokens=prompt_tokens,
+                options=options,
+                session_key=session_key
+            ),
+            media_type="text/event-stream"
+        )
+    logger.info(f"使用传统RAG模式，知识库ID: {kb_id}, 用户ID: {user_id}")
+    return StreamingResponse(
+        rag_stream_generator(
+            question=current_question,
+            history=langchain_messages,
+            model_info=model,
+            kb_id=kb_id,
+            user_id=user_id,
+            system_prompt=system_prompt,
+            prompt_tokens=prompt_tokens,
+            options=options
+        ),
+        media_type="text/event-stream"
+    )
@@ -0,0 +1,133 @@
+"""
+SSE 帧编码
+与 rag-server（ChatController）约定的帧格式保持不变：
+    data: {"type": "<type>", "payload": "<payload 的 JSON 字符串>"}\n\n
+即 payload 先编码为 JSON 字符串，再作为字符串字段写入外层对象（双重编码）。
+
+- text_frame: 文本增量（thinking / content），不含需转义字符时直接拼接，否则一次完成双重编码
+- json_frame: 结构化 payload（process / rag_summary）
+- coalesce_deltas: 将短时间内连续的同类型小增量合并为一帧，减少帧数与编码次数
+
+字符串编码优先使用 orjson（可选依赖），未安装时回退到标准库 json，两者对字符串的输出完全一致；
+结构化 payload 始终用标准库 json 编码（orjson 输出紧凑分隔符、浮点格式也不同），帧字节与原实现一致
+"""
+import asyncio
+import json
+import re
+from typing import AsyncIterator
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 需要 JSON 转义的字符（ensure_ascii=False 时只有控制字符、双引号与反斜杠）
+_NEEDS_ESCAPE = re.compile(r'[\x00-\x1f"\\]')
+
+# 参与合并的增量事件类型
+DELTA_TYPES = ("thinking", "content")
+# 合并窗口（秒）：增量最多延迟这么久发送
+FLUSH_INTERVAL = 0.02
+# 单帧合并的最大字符数
+MAX_COALESCE_CHARS = 512
+
+
+def _dumps(obj) -> str:
+    if orjson is not None and isinstance(obj, str):
+        try:
+            return orjson.dumps(obj).decode("utf-8")
+        except TypeError:
+            # 孤立代理项等 orjson 拒绝的字符串交给标准库处理
+            pass
+    return json.dumps(obj, ensure_ascii=False)
+
+
+def text_frame(event_type: str, text: str) -> str:
+    """
+    文本增量帧
+    event_type 为内部固定的事件名（不含需转义字符），直接拼接
+    """
+    if _NEEDS_ESCAPE.search(text) is None:
+        # 两层编码都只是加引号：外层中内层的引号需转义为 \"
+        return 'data: {"type": "' + event_type + '", "payload": "\\"' + text + '\\""}\n\n'
+    return 'data: {"type": "' + event_type + '", "payload": ' + _dumps(_dumps(text)) + '}\n\n'
+
+
+def json_frame(event_type: str, payload) -> str:
+    """结构化 payload 帧（payload 编码为 JSON 字符串后写入）"""
+    return 'data: {"type": "' + event_type + '", "payload": ' + _dumps(_dumps(payload)) + '}\n\n'
+
+
+async def coalesce_deltas(
+        stream: AsyncIterator[dict],
+        flush_interval: float = FLUSH_INTERVAL,
+        max_chars: int = MAX_COALESCE_CHARS
+) -> AsyncIterator[dict]:
+    """
+    合并连续的同类型文本增量（thinking / content）
+
+    - 第一个增量立即发送，不影响首字延迟
+    - 之后的增量在 flush_interval 内累积，到期、类型切换或超过 max_chars 时合并为一项发送
+    - 其他类型的事件先冲刷已累积的增量再原样透传，保持事件顺序
+    """
+    iterator = stream.__aiter__()
+    loop = asyncio.get_running_loop()
+    pending_type = None
+    pending: list[str] = []
+    pending_chars = 0
+    deadline = 0.0
+    first_delta_sent = False
+    next_item = None
+
+    def flush() -> dict:
+        nonlocal pending_type, pending, pending_chars
+        item = {"type": pending_type, "payload": "".join(pending)}
+        pending_type, pending, pending_chars = None, [], 0
+        return item
+
+    try:
+        while True:
+            if next_item is None:
+                next_item = asyncio.ensure_future(iterator.__anext__())
+            if pending:
+                done, _ = await asyncio.wait({next_item}, timeout=max(0.0, deadline - loop.time()))
+                if not done:
+                    # 合并窗口到期，上游仍在生成
+                    yield flush()
+                    continue
+            try:
+                item = await next_item
+            except StopAsyncIteration:
+                break
+            finally:
+                if next_item.done():
+                    next_item = None
+
+            if item["type"] not in DELTA_TYPES:
+                if pending:
+                    yield flush()
+                yield item
+                continue
+
+            text = item["payload"]
+            if not text:
+                continue
+            if not first_delta_sent:
+                first_delta_sent = True
+                yield item
+                continue
+            if pending and item["type"] != pending_type:
+                yield flush()
+            if not pending:
+                pending_type = item["type"]
+                deadline = loop.time() + flush_interval
+            pending.append(text)
+            pending_chars += len(text)
+            if pending_chars >= max_chars:
+                yield flush()
+
+        if pending:
+            yield flush()
+    finally:
+        if next_item is not None and not next_item.done():
+            next_item.cancel()
@@ -0,0 +1,66 @@
+"""
+基准脚本 - filter_grade_threshold
+对比前缀和精确切分与 sklearn KMeans(n_clusters=2) 的单次耗时
+用法：python test/bench_grade_threshold.py [--repeat 200]
+未安装 scikit-learn 时只测精确切分
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain_core.documents import Document  # noqa: E402
+
+from utils import _split_two_clusters, filter_grade_threshold  # noqa: E402
+
+try:
+    from sklearn.cluster import KMeans
+except ImportError:
+    KMeans = None
+
+SIZES = [10, 40, 100, 400, 2000]
+
+
+def _timeit(func, repeat: int) -> float:
+    """返回单次调用的中位耗时（微秒）"""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return float(np.median(samples)) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print("=" * 70)
+    print(f"{'n':>6} {'split (us)':>14} {'filter (us)':>14} {'KMeans (us)':>14} {'speedup':>10}")
+    print("=" * 70)
+    for n in SIZES:
+        scores = np.clip(np.concatenate([rng.normal(0.8, 0.05, n // 4), rng.normal(0.2, 0.1, n - n // 4)]), 0.0, 1.0)
+        sorted_scores = np.sort(scores)[::-1]
+        docs = [Document(page_content=str(i), metadata={"rerank_score": float(s)}) for i, s in enumerate(scores)]
+
+        split_us = _timeit(lambda: _split_two_clusters(sorted_scores), args.repeat)
+        filter_us = _timeit(lambda: filter_grade_threshold(docs), args.repeat)
+        if KMeans is not None:
+            column = sorted_scores.reshape(-1, 1)
+            kmeans_us = _timeit(
+                lambda: KMeans(n_clusters=2, random_state=42, n_init=10).fit(column),
+                max(args.repeat // 10, 5)
+            )
+            print(f"{n:>6} {split_us:>14.1f} {filter_us:>14.1f} {kmeans_us:>14.1f} {kmeans_us / split_us:>9.0f}x")
+        else:
+            print(f"{n:>6} {split_us:>14.1f} {filter_us:>14.1f} {'-':>14} {'-':>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""
+基准脚本 - SSE 帧编码
+单线程（单核）每秒编码帧数：原实现（两次 json.dumps）对比 text_frame / json_frame
+用法：python test/bench_sse_frames.py [--frames 200000]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sse_utils  # noqa: E402
+
+
+def _reference_frame(event_type: str, payload) -> str:
+    data = {"type": event_type, "payload": json.dumps(payload, ensure_ascii=False)}
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _frames_per_sec(encode, event_type: str, payloads: list) -> float:
+    start = time.perf_counter()
+    for payload in payloads:
+        encode(event_type, payload)
+    return len(payloads) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--frames", type=int, default=200000)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    words = ["检索", "文档", "the", "answer", "，", "。", "model", "知识库"]
+    workloads = {
+        "short plain": [rng.choice(words) for _ in range(args.frames)],
+        "short escaped": [rng.choice(words) + rng.choice(['"', "\n", "\\"]) for _ in range(args.frames)],
+        "300-char mixed": ["".join(rng.choice(words) for _ in range(80)) + "\n" for _ in range(args.frames // 10)],
+    }
+    process_payloads = [
+        {"step": "retrieve", "query": rng.choice(words), "docs": rng.randint(0, 20), "score": rng.random()}
+        for _ in range(args.frames // 10)
+    ]
+
+    print("=" * 70)
+    print(f"orjson: {'yes' if sse_utils.orjson is not None else 'no'}  (frames/sec, single core)")
+    print(f"{'workload':<18} {'json.dumps x2':>16} {'sse_utils':>16} {'speedup':>10}")
+    print("=" * 70)
+    for name, payloads in workloads.items():
+        old = _frames_per_sec(_reference_frame, "content", payloads)
+        new = _frames_per_sec(sse_utils.text_frame, "content", payloads)
+        print(f"{name:<18} {old:>16,.0f} {new:>16,.0f} {new / old:>9.2f}x")
+    old = _frames_per_sec(_reference_frame, "process", process_payloads)
+    new = _frames_per_sec(sse_utils.json_frame, "process", process_payloads)
+    print(f"{'process (json)':<18} {old:>16,.0f} {new:>16,.0f} {new / old:>9.2f}x")
+
+
+if __name__ == "__main__":
+    main()
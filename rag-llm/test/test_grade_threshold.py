@@ -0,0 +1,132 @@
+"""
+测试脚本 - filter_grade_threshold
+随机分数集上对比前缀和精确切分与 sklearn KMeans(n_clusters=2) 的阈值、中心与高分占比
+需要 scikit-learn（仅测试依赖）：pip install scikit-learn
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain_core.documents import Document  # noqa: E402
+
+from utils import _split_two_clusters, filter_grade_threshold  # noqa: E402
+
+KMeans = pytest.importorskip("sklearn.cluster").KMeans
+
+POSSIBLE_SEARCH_RATIO = 0.15
+TRIALS = 500
+
+
+def _docs(scores) -> list:
+    return [Document(page_content=str(i), metadata={"rerank_score": float(s)}) for i, s in enumerate(scores)]
+
+
+def _sse(sorted_scores: np.ndarray, high_count: int) -> float:
+    high, low = sorted_scores[:high_count], sorted_scores[high_count:]
+    return float(((high - high.mean()) ** 2).sum() + ((low - low.mean()) ** 2).sum())
+
+
+def _kmeans_reference(sorted_scores: np.ndarray) -> dict:
+    """原 KMeans 实现（输入为降序分数）"""
+    kmeans = KMeans(n_clusters=2, random_state=42, n_init=10)
+    kmeans.fit(sorted_scores.reshape(-1, 1))
+    labels = kmeans.labels_
+    sorted_idx = np.argsort(kmeans.cluster_centers_.flatten())
+    sorted_centers = kmeans.cluster_centers_.flatten()[sorted_idx]
+    low_center = sorted_centers[0]
+    high_subset = sorted_scores[labels == sorted_idx[1]]
+    min_high_score = high_subset[-1]
+    threshold = max(min_high_score - (min_high_score - low_center) * POSSIBLE_SEARCH_RATIO, low_center)
+    return {
+        "high_ratio": len(high_subset) / len(sorted_scores),
+        "threshold": float(threshold),
+        "kmeans_centers": sorted_centers.tolist(),
+        "inertia": float(kmeans.inertia_),
+    }
+
+
+def _random_scores(rng: np.random.Generator) -> np.ndarray:
+    n = int(rng.integers(2, 60))
+    kind = rng.integers(0, 4)
+    if kind == 0:
+        scores = rng.random(n)
+    elif kind == 1:
+        # 双峰分布
+        high = int(rng.integers(1, n))
+        scores = np.concatenate([rng.normal(0.8, 0.05, high), rng.normal(0.2, 0.1, n - high)])
+    elif kind == 2:
+        # 两位小数，产生大量相同分数
+        scores = np.round(rng.random(n), 2)
+    else:
+        # 只有少数几个取值
+        scores = rng.choice(rng.random(int(rng.integers(2, 4))), n)
+    return np.clip(scores, 0.0, 1.0)
+
+
+def test_split_matches_kmeans():
+    """精确切分的簇内平方和不高于 KMeans；KMeans 到达最优解时阈值、中心、高分占比一致"""
+    rng = np.random.default_rng(20240601)
+    compared = 0
+    for _ in range(TRIALS):
+        scores = _random_scores(rng)
+        sorted_scores = np.sort(scores)[::-1]
+        if sorted_scores[0] == sorted_scores[-1]:
+            continue
+
+        high_count, _, _ = _split_two_clusters(sorted_scores)
+        # 相同分数不会被切开
+        assert high_count == len(sorted_scores) or sorted_scores[high_count - 1] != sorted_scores[high_count]
+
+        expected = _kmeans_reference(sorted_scores)
+        sse = _sse(sorted_scores, high_count)
+        assert sse <= expected["inertia"] + 1e-9
+
+        # 高分直通车阈值设为 1.1，保证走聚类分支
+        result = filter_grade_threshold(_docs(scores), high_score_threshold=1.1, possible_search_ratio=POSSIBLE_SEARCH_RATIO)
+        if abs(sse - expected["inertia"]) > 1e-9:
+            # KMeans 停在局部最优
+            continue
+        reference_count = round(expected["high_ratio"] * len(sorted_scores))
+        if reference_count != high_count and abs(_sse(sorted_scores, reference_count) - sse) <= 1e-12:
+            # 两种切分代价相同，任取其一均为最优解
+            continue
+        compared += 1
+        assert result["high_ratio"] == pytest.approx(expected["high_ratio"])
+        assert result["threshold"] == pytest.approx(expected["threshold"])
+        assert result["kmeans_centers"] == pytest.approx(expected["kmeans_centers"])
+    assert compared > TRIALS // 2
+
+
+def test_ties_not_split():
+    """相同分数落在同一簇"""
+    scores = np.array([0.9, 0.9, 0.5, 0.5, 0.5, 0.1])
+    high_count, low_center, high_center = _split_two_clusters(scores)
+    assert high_count in (2, 5)
+    result = filter_grade_threshold(_docs(scores), high_score_threshold=1.1, possible_search_ratio=POSSIBLE_SEARCH_RATIO)
+    expected = _kmeans_reference(scores)
+    assert result["threshold"] == pytest.approx(expected["threshold"])
+    assert result["kmeans_centers"] == pytest.approx(expected["kmeans_centers"])
+
+
+def test_all_equal():
+    """所有分数相同：全部保留，阈值即该分数，两个中心相同"""
+    scores = np.full(8, 0.42)
+    assert _split_two_clusters(scores) == (8, 0.42, 0.42)
+    result = filter_grade_threshold(_docs(scores))
+    assert result["high_ratio"] == 1
+    assert result["threshold"] == pytest.approx(0.42)
+    assert result["kmeans_centers"] == pytest.approx([0.42, 0.42])
+    assert len(result["documents"]) == 8
+
+
+def test_short_circuits():
+    """空输入、单个分数与全部高分时不聚类"""
+    assert filter_grade_threshold([])["documents"] == []
+    assert filter_grade_threshold(_docs([0.3]))["threshold"] == pytest.approx(0.3)
+    result = filter_grade_threshold(_docs([0.95, 0.8, 0.75]))
+    assert result["high_ratio"] == 1
+    assert len(result["documents"]) == 3
@@ -0,0 +1,106 @@
+"""
+测试脚本 - SSE 帧编码
+帧字节与原实现（两次 json.dumps，ensure_ascii=False）完全一致，安装与未安装 orjson 时都要成立
+"""
+import asyncio
+import json
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sse_utils  # noqa: E402
+
+SAMPLE_TEXTS = [
+    "",
+    "hello",
+    "中文增量",
+    'say "hi"',
+    "back\\slash",
+    "line\nbreak\ttab\r",
+    "\x00\x01\x1f\x7f",
+    "  ",
+    "emoji 😀",
+    "lone \ud800 surrogate",
+    "</script>",
+]
+
+SAMPLE_PAYLOADS = [
+    {"step": "retrieve", "docs": 3, "score": 0.875},
+    {"nested": {"list": [1, 2.5, None, True, False]}, "text": "中文 \"引号\"\n"},
+    {"large": 1e16, "small": 1e-7, "neg": -0.0},
+    ["a", {"b": "c"}],
+    "plain string payload",
+    42,
+    None,
+]
+
+
+def _reference_frame(event_type: str, payload) -> str:
+    data = {"type": event_type, "payload": json.dumps(payload, ensure_ascii=False)}
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _random_text(rng: random.Random) -> str:
+    alphabet = ['"', "\\", "\n", "\t", "\x00", "\x1f", "a", "Z", " ", "中", "文", "😀", " ", "/"]
+    # 一半取自需转义 / 多字节字符，一半为 BMP 内任意字符（含代理项）
+    return "".join(rng.choice(alphabet) if rng.random() < 0.5 else chr(rng.randint(0x20, 0xffff))
+                   for _ in range(rng.randint(0, 40)))
+
+
+@pytest.fixture(params=["orjson", "json"])
+def encoder(request, monkeypatch):
+    """分别在 orjson 与标准库 json 下运行"""
+    if request.param == "orjson":
+        if sse_utils.orjson is None:
+            pytest.skip("orjson not installed")
+    else:
+        monkeypatch.setattr(sse_utils, "orjson", None)
+    return request.param
+
+
+@pytest.mark.parametrize("text", SAMPLE_TEXTS)
+def test_text_frame_identical(encoder, text):
+    for event_type in sse_utils.DELTA_TYPES:
+        assert sse_utils.text_frame(event_type, text) == _reference_frame(event_type, text)
+
+
+def test_text_frame_random(encoder):
+    rng = random.Random(7)
+    for _ in range(5000):
+        text = _random_text(rng)
+        assert sse_utils.text_frame("content", text) == _reference_frame("content", text)
+
+
+@pytest.mark.parametrize("payload", SAMPLE_PAYLOADS)
+def test_json_frame_identical(encoder, payload):
+    for event_type in ("process", "rag_summary"):
+        assert sse_utils.json_frame(event_type, payload) == _reference_frame(event_type, payload)
+
+
+def test_coalesce_deltas_preserves_content():
+    """合并后同类型文本拼接不变，非增量事件保持顺序"""
+
+    async def source():
+        yield {"type": "thinking", "payload": "t0"}
+        for i in range(50):
+            yield {"type": "thinking", "payload": f"t{i + 1}"}
+        yield {"type": "process", "payload": {"step": 1}}
+        for i in range(50):
+            yield {"type": "content", "payload": f"c{i}"}
+
+    async def collect():
+        return [item async for item in sse_utils.coalesce_deltas(source())]
+
+    items = asyncio.run(collect())
+    assert items[0] == {"type": "thinking", "payload": "t0"}
+    process_index = next(i for i, item in enumerate(items) if item["type"] == "process")
+    thinking = "".join(item["payload"] for item in items[:process_index])
+    content = "".join(item["payload"] for item in items[process_index + 1:])
+    assert thinking == "".join(f"t{i}" for i in range(51))
+    assert content == "".join(f"c{i}" for i in range(50))
+    assert all(item["type"] == "content" for item in items[process_index + 1:])
+    assert len(items) < 102
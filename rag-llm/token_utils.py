@@ -0,0 +1,135 @@
+"""
+Token 计数服务
+- 编码器按名称缓存，避免每次调用都执行 tiktoken.get_encoding
+- count_tokens_batch: 多段文本使用 encode_ordinary_batch 多线程编码
+- count_message_tokens: 历史消息的 token 数按内容哈希缓存，多轮对话中同一段历史不再重复编码
+- IncrementalTokenCounter: 流式输出边接收边计数，结束时无需对全文重新编码
+"""
+import hashlib
+import unicodedata
+from functools import lru_cache
+
+import tiktoken
+
+from cache_utils import LRUCache
+
+DEFAULT_ENCODING = "cl100k_base"
+# 批量编码的线程数
+BATCH_THREADS = 4
+
+_message_token_cache = LRUCache("message_tokens", maxsize=10000)
+
+
+@lru_cache(maxsize=8)
+def get_encoding(encoding_name: str = DEFAULT_ENCODING) -> tiktoken.Encoding:
+    try:
+        return tiktoken.get_encoding(encoding_name)
+    except Exception:
+        # Fallback to cl100k_base if specific encoding not found
+        return tiktoken.get_encoding(DEFAULT_ENCODING)
+
+
+def count_tokens(text: str, encoding_name: str = DEFAULT_ENCODING) -> int:
+    """计算文本的token数量（特殊 token 按普通文本处理）"""
+    if not text:
+        return 0
+    return len(get_encoding(encoding_name).encode_ordinary(text))
+
+
+def count_tokens_batch(texts: list[str], encoding_name: str = DEFAULT_ENCODING) -> list[int]:
+    """批量计算多段文本的token数量"""
+    if not texts:
+        return []
+    if len(texts) == 1:
+        return [count_tokens(texts[0], encoding_name)]
+    encoded = get_encoding(encoding_name).encode_ordinary_batch(list(texts), num_threads=BATCH_THREADS)
+    return [len(tokens) for tokens in encoded]
+
+
+def count_message_tokens(messages: list[dict], encoding_name: str = DEFAULT_ENCODING) -> list[int]:
+    """计算每条消息 content 的token数量，结果按内容哈希缓存"""
+    contents = [m.get('content') or "" for m in messages]
+    keys = [
+        (encoding_name, hashlib.blake2b(content.encode("utf-8"), digest_size=16).digest())
+        for content in contents
+    ]
+    counts = [_message_token_cache.get(key) for key in keys]
+
+    missing = [i for i, count in enumerate(counts) if count is None]
+    if missing:
+        fresh = count_tokens_batch([contents[i] for i in missing], encoding_name)
+        for i, count in zip(missing, fresh):
+            counts[i] = count
+            _message_token_cache.set(keys[i], count)
+    return counts
+
+
+def _is_safe_boundary(text: str, i: int) -> bool:
+    """
+    text[:i] 与 text[i:] 在 cl100k 预分词正则下是否必然属于不同片段
+    （两侧分别编码的 token 数之和与整体编码一致）
+    """
+    prev, cur = text[i - 1], text[i]
+    # 字母串之后紧跟标点（撇号可能构成 's 等缩写，组合附加符号归属前一字母，均排除）
+    if prev.isalpha() and not (cur.isalnum() or cur.isspace() or cur == "'"
+                               or unicodedata.category(cur).startswith("M")):
+        return True
+    # 换行之后紧跟非空白字符（换行不会作为下一个词的前缀）
+    if prev in "\r\n" and not cur.isspace():
+        return True
+    # 非空白字符之后的单个空格，且空格后是非空白字符（" word" 整体为一个片段）
+    if cur == " " and not prev.isspace() and i + 1 < len(text) and not text[i + 1].isspace():
+        return True
+    return False
+
+
+def _last_safe_boundary(text: str) -> int:
+    for i in range(len(text) - 1, 0, -1):
+        if _is_safe_boundary(text, i):
+            return i
+    return 0
+
+
+class IncrementalTokenCounter:
+    """
+    流式输出的增量 token 计数
+    - 增量文本先追加到缓冲区，累计超过 FLUSH_CHARS 后在最后一个安全分词边界处切分，
+      边界之前的部分立即编码计数，之后的部分留待与后续增量拼接
+    - 流结束时只需编码缓冲区中剩余的少量文本，usage 可立即发送
+    """
+
+    FLUSH_CHARS = 256
+
+    def __init__(self, encoding_name: str = DEFAULT_ENCODING):
+        self.encoding_name = encoding_name
+        self._pending: list[str] = []
+        self._pending_chars = 0
+        self._next_flush = self.FLUSH_CHARS
+        self._tokens = 0
+
+    def add(self, text: str):
+        if not text:
+            return
+        self._pending.append(text)
+        self._pending_chars += len(text)
+        if self._pending_chars >= self._next_flush:
+            self._flush(final=False)
+
+    def _flush(self, final: bool):
+        if not self._pending:
+            return
+        text = "".join(self._pending)
+        cut = len(text) if final else _last_safe_boundary(text)
+        rest = text[cut:]
+        if cut:
+            self._tokens += count_tokens(text[:cut], self.encoding_name)
+        self._pending = [rest] if rest else []
+        self._pending_chars = len(rest)
+        # 长时间找不到安全边界（如超长无标点文本）时放宽阈值，避免每个增量都重新拼接
+        self._next_flush = max(self.FLUSH_CHARS, self._pending_chars * 2)
+
+    @property
+    def total(self) -> int:
+        """已输入文本的 token 总数"""
+        self._flush(final=True)
+        return self._tokens
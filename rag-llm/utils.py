@@ -1,4 +1,5 @@
 import base64
+import hashlib
 import json
 import logging
 import os
@@ -7,7 +8,6 @@ from functools import lru_cache
 from typing import List
 
 import numpy as np
-import tiktoken
 from langchain.agents import create_agent
 from langchain.chat_models import init_chat_model
 from langchain.embeddings import init_embeddings
@@ -20,13 +20,18 @@ from langchain_text_splitters import (
     RecursiveJsonSplitter,
     MarkdownHeaderTextSplitter
 )
-from sklearn.cluster import KMeans
+from openai import AsyncOpenAI
 
+from cache_utils import LRUCache
 from gemini_utils import GeminiInstance
 from openai_utils import OpenAIInstance
+from token_utils import count_tokens, count_tokens_batch, count_message_tokens
 
 logger = logging.getLogger(__name__)
 
+_langchain_llm_cache = LRUCache("langchain_llm", maxsize=32)
+_structured_agent_cache = LRUCache("structured_agent", maxsize=32)
+
 
 # 统一返回结构
 
@@ -65,6 +70,22 @@ def _get_model_setting(model_info: dict):
     return settings
 
 
+@lru_cache(maxsize=32)
+def _cached_openai_client(base_url: str, api_key: str, timeout: int, max_retries: int) -> AsyncOpenAI:
+    # AsyncOpenAI 内部持有 httpx 连接池，按 (base_url, api_key, timeout, max_retries) 复用
+    return AsyncOpenAI(
+        api_key=api_key,
+        base_url=base_url,
+        timeout=timeout,
+        max_retries=max_retries
+    )
+
+
+@lru_cache(maxsize=8)
+def _cached_gemini_client(base_url: str, api_key: str, timeout: int, max_retries: int):
+    return GeminiInstance.create_client(api_key, base_url, timeout, max_retries)
+
+
 def get_official_llm(
         model_info: dict,
         enable_web_search: bool = False,
@@ -89,6 +110,7 @@ def get_official_llm(
             enable_thinking=True,
             timeout=timeout,
             max_retries=max_retries,
+            client=_cached_gemini_client(base_url, api_key, timeout, max_retries),
         )
     return OpenAIInstance(
         model_name=model_name,
@@ -98,13 +120,14 @@ def get_official_llm(
         max_retries=max_retries,
         enable_web_search=enable_web_search,
         enable_thinking=enable_thinking,
-        provider=model_info['provider']
+        provider=model_info['provider'],
+        client=_cached_openai_client(base_url, api_key, timeout, max_retries),
     )
 
 
-def get_local_embedding_instance(embedding_info: dict):
-    base_url = embedding_info.get("base_url", "http://192.168.188.6:8890")
-    model_name = embedding_info.get("name", "Qwen/Qwen3-Embedding-0.6B")
+@lru_cache(maxsize=8)
+def _cached_local_embedding(base_url: str, model_name: str):
+    # 实例内部持有 HTTP 客户端，按 (base_url, model) 复用以保持连接池
     return init_embeddings(
         model=model_name,
         api_key="local",
@@ -114,6 +137,12 @@ def get_local_embedding_instance(embedding_info: dict):
     )
 
 
+def get_local_embedding_instance(embedding_info: dict):
+    base_url = embedding_info.get("base_url", "http://192.168.188.6:8890")
+    model_name = embedding_info.get("name", "Qwen/Qwen3-Embedding-0.6B")
+    return _cached_local_embedding(base_url, model_name)
+
+
 def get_embedding_instance(embedding_info: dict):
     # 当前默认走本地部署的embedding服务，后续可以根据配置切换不同的embedding提供商
     return get_local_embedding_instance(embedding_info)
@@ -161,16 +190,30 @@ def get_langchain_llm(
     model_name = model_info.get("name")
     api_key = settings.get("api_key")
     base_url = settings.get("base_url")
-
-    llm = init_chat_model(
-        model=model_name,
-        api_key=api_key,
-        base_url=base_url,
-        model_provider=settings['model_provider'] if "model_provider" in settings else None,
-        timeout=timeout,
-        max_retries=max_retries,
-        **kwargs
+    model_provider = settings['model_provider'] if "model_provider" in settings else None
+
+    # 模型实例无请求级状态，按完整配置复用（内部 HTTP 客户端随之复用连接池）
+    key = (
+        model_name,
+        base_url,
+        hashlib.blake2b((api_key or "").encode("utf-8"), digest_size=16).hexdigest(),
+        model_provider,
+        timeout,
+        max_retries,
+        json.dumps(kwargs, sort_keys=True, ensure_ascii=False, default=str),
     )
+    llm = _langchain_llm_cache.get(key)
+    if llm is None:
+        llm = init_chat_model(
+            model=model_name,
+            api_key=api_key,
+            base_url=base_url,
+            model_provider=model_provider,
+            timeout=timeout,
+            max_retries=max_retries,
+            **kwargs
+        )
+        _langchain_llm_cache.set(key, llm)
     return llm
 
 
@@ -178,10 +221,17 @@ def get_structured_data_agent(
         llm: BaseChatModel,
         data_type,
 ):
-    return create_agent(
+    # 按 (llm, 输出类型) 复用已编译的 agent；同时保存 llm 引用，避免 id 被回收后误命中
+    key = (id(llm), data_type)
+    cached = _structured_agent_cache.get(key)
+    if cached is not None and cached[0] is llm:
+        return cached[1]
+    agent = create_agent(
         model=llm,
         response_format=data_type
     )
+    _structured_agent_cache.set(key, (llm, agent))
+    return agent
 
 
 def markdown_split(
@@ -221,10 +271,17 @@ def json_split(json_data: dict, min_chunk_size: int = 100, max_chunk_size: int =
     return json_splitter.split_json(json_data)
 
 
-def code_split(code_text: str, language: str, chunk_size: int = 1024, chunk_overlap: int = 100):
+def code_split(
+        code_text: str,
+        language: str,
+        chunk_size: int = 1024,
+        chunk_overlap: int = 100,
+        return_documents: bool = False
+):
+    """return_documents=True 时返回 Document 列表，metadata 中 start_index 为切片在全文中的起始位置"""
     language = Language(language)
     code_splitter = RecursiveCharacterTextSplitter.from_language(
-        language=language, chunk_size=chunk_size, chunk_overlap=chunk_overlap
+        language=language, chunk_size=chunk_size, chunk_overlap=chunk_overlap, add_start_index=return_documents
     )
     if language == Language.PYTHON:
         # 针对Python代码，增加特殊的切分逻辑
@@ -241,6 +298,8 @@ def code_split(code_text: str, language: str, chunk_size: int = 1024, chunk_over
             " ",
             "",
         ]
+    if return_documents:
+        return code_splitter.create_documents([code_text])
     return code_splitter.split_text(code_text)
 
 
@@ -248,8 +307,10 @@ def plain_text_split(
         plain_text: str,
         chunk_size: int = 1024, chunk_overlap: int = 100,
         separators: list = None, force_split: bool = False,
-        add_start_index: bool = True
+        add_start_index: bool = True,
+        return_documents: bool = False
 ):
+    """return_documents=True 时返回 Document 列表，metadata 中 start_index 为切片在（规整后）全文中的起始位置"""
     pattern = r'(?<=[\u4e00-\u9fa5\u3000-\u303f\uff00-\uffef])\s+(?=[\u4e00-\u9fa5\u3000-\u303f\uff00-\uffef])'
     plain_text = re.sub(pattern, '', plain_text)
     if separators is None:
@@ -266,8 +327,10 @@ def plain_text_split(
         chunk_size=chunk_size,
         chunk_overlap=chunk_overlap,
         separators=separators,
-        add_start_index=add_start_index
+        add_start_index=add_start_index or return_documents
     )
+    if return_documents:
+        return text_splitter.create_documents([plain_text])
     return text_splitter.split_text(plain_text)
 
 
@@ -275,6 +338,7 @@ def pdf_split(
         file_path: str,
         chunk_size: int = 1024,
         chunk_overlap: int = 100,
+        return_documents: bool = False,
 ):
     """
     对PDF进行完美划分：全文合并后切分，解决跨页段落问题。
@@ -284,6 +348,7 @@ def pdf_split(
         file_path: PDF文件路径
         chunk_size: 文本块大小
         chunk_overlap: 文本块重叠大小
+        return_documents: 是否返回带 start_index 的 Document 列表
     Returns:
         切分后的文本块列表
     """
@@ -300,7 +365,8 @@ def pdf_split(
     return plain_text_split(
         plain_text=text,
         chunk_size=chunk_size,
-        chunk_overlap=chunk_overlap
+        chunk_overlap=chunk_overlap,
+        return_documents=return_documents
     )
 
 
@@ -386,13 +452,8 @@ async def image_split(
 
 
 def get_token_count(text: str, encoding_name: str = "cl100k_base") -> int:
-    """计算文本的token数量"""
-    try:
-        encoding = tiktoken.get_encoding(encoding_name)
-    except Exception:
-        # Fallback to cl100k_base if specific encoding not found
-        encoding = tiktoken.get_encoding("cl100k_base")
-    return len(encoding.encode(text))
+    """计算文本的token数量（编码器已缓存）"""
+    return count_tokens(text, encoding_name)
 
 
 def cut_history(history: list, model: dict, context_multiplier: int = None):
@@ -401,6 +462,8 @@ def cut_history(history: list, model: dict, context_multiplier: int = None):
 
     processed_context = []
     current_token_count = get_token_count(current_msg.get('content') or "")
+    # 历史消息 token 数按内容缓存，每轮对话只需编码新增的消息
+    message_tokens = count_message_tokens(previous_msgs)
     n = len(previous_msgs)
     model_name = model.get("name", "")
 
@@ -432,7 +495,7 @@ def cut_history(history: list, model: dict, context_multiplier: int = None):
 
     for i in range(n, 1, -2):
         pair = previous_msgs[i - 2: i]
-        pair_tokens = sum(get_token_count(m.get('content') or "") for m in pair)
+        pair_tokens = message_tokens[i - 2] + message_tokens[i - 1]
 
         if current_token_count + pair_tokens < max_tokens:
             current_token_count += pair_tokens
@@ -473,12 +536,11 @@ def get_display_docs(documents: list, max_tokens: int = 2048, min_docs: int = 1)
     if len(documents) <= min_docs:
         return documents
     display_docs = [documents[i] for i in range(min_docs)]
-    total_tokens = sum(get_token_count(documents[i].page_content) for i in range(min_docs))
+    doc_token_counts = count_tokens_batch([doc.page_content for doc in documents])
+    total_tokens = sum(doc_token_counts[:min_docs])
     if total_tokens >= max_tokens:
         return display_docs
-    for doc in documents[min_docs:]:
-        content = doc.page_content
-        doc_tokens = get_token_count(content)
+    for doc, doc_tokens in zip(documents[min_docs:], doc_token_counts[min_docs:]):
         if total_tokens + doc_tokens <= max_tokens:
             display_docs.append(doc)
             total_tokens += doc_tokens
@@ -502,6 +564,14 @@ async def unified_llm_stream(model_instance, messages):
     """统一的LLM流式生成器"""
     try:
         async for chunk in model_instance.astream(messages):
+            # 服务商返回的用量（OpenAIInstance / GeminiInstance 在流末尾单独给出）
+            usage = getattr(chunk, "usage", None)
+            if usage:
+                yield {
+                    "type": "usage",
+                    "payload": usage
+                }
+                continue
             content = chunk.content or reasoning_content_wrapper(chunk)
             if content:
                 think_content, text_content = content_extractor(content)
@@ -519,6 +589,33 @@ async def unified_llm_stream(model_instance, messages):
         logger.error(f"LLM streaming error: {e}")
 
 
+def _split_two_clusters(sorted_scores: np.ndarray) -> tuple[int, float, float]:
+    """
+    一维 2-means 的精确解（输入为降序分数）
+    一维最优划分必为排序后的连续切分，借助前缀和枚举全部切分点，取簇内平方和最小者；
+    相同分数不会被切开（与按最近中心分配一致）
+
+    Returns:
+        (高分簇大小, 低分簇中心, 高分簇中心)，所有分数相同时高分簇包含全部分数
+    """
+    n = len(sorted_scores)
+    valid = sorted_scores[:-1] != sorted_scores[1:]
+    if not valid.any():
+        center = float(sorted_scores[0])
+        return n, center, center
+
+    k = np.arange(1, n)
+    prefix = np.cumsum(sorted_scores)
+    high_sum = prefix[:-1]
+    low_sum = prefix[-1] - high_sum
+    # 簇内平方和 = Σx² - S_high²/k - S_low²/(n-k)，Σx² 为常数，最小化后两项的相反数即可
+    cost = -(high_sum ** 2 / k + low_sum ** 2 / (n - k))
+    cost = np.where(valid, cost, np.inf)
+    best = int(np.argmin(cost))
+    high_count = best + 1
+    return high_count, float(low_sum[best] / (n - high_count)), float(high_sum[best] / high_count)
+
+
 def filter_grade_threshold(
         docs: List[Document],  # 修正类型提示，兼容 Document
         high_score_threshold: float = 0.7,
@@ -563,46 +660,25 @@ def filter_grade_threshold(
             "documents": sorted_docs
         }
 
-    # 5. K-Means聚类
-    kmeans = KMeans(n_clusters=2, random_state=42, n_init=10)
-    kmeans.fit(sorted_scores.reshape(-1, 1))
-
-    # 获取标签与中心
-    labels = kmeans.labels_
-    centers_raw = kmeans.cluster_centers_.flatten()
-
-    # 按中心值排序 (Low, High)
-    sorted_idx = np.argsort(centers_raw)
-    sorted_centers = centers_raw[sorted_idx]
-    low_center = sorted_centers[0]
+    # 5. 一维 2-means 聚类（前缀和精确求解，结果等价于 KMeans 的最优解）
+    high_count, low_center, high_center = _split_two_clusters(sorted_scores)
+    sorted_centers = np.array([low_center, high_center])
 
     # 计算高分占比
-    sorted_counts = np.array([np.sum(labels == label) for label in sorted_idx])
-    high_ratio = sorted_counts[1] / n
-    high_score_label = sorted_idx[1]
-
-    # 步骤 A: 先获取该簇的所有分数，不要直接 [-1]，防止列表为空
-    high_cluster_subset = sorted_scores[labels == high_score_label]
-    min_high_score = 0.0
-    if len(high_cluster_subset) == 0:
-        # 防御性逻辑：如果高分簇为空（极罕见），降级为低分中心或全保留
-        kmeans_threshold = low_center
-    else:
-        # 步骤 B: 取高分簇的最小值（因为是降序排列，所以是最后一个）
-        min_high_score = high_cluster_subset[-1]
-        # 步骤 C: 计算阈值
-        kmeans_threshold = min_high_score - (min_high_score - low_center) * possible_search_ratio
+    high_ratio = high_count / n
 
-    # 步骤 D: 安全兜底 防止传入 possible_search_ratio > 1
+    # 高分簇的最小值（降序排列，即高分簇最后一个）
+    min_high_score = sorted_scores[high_count - 1]
+    kmeans_threshold = min_high_score - (min_high_score - low_center) * possible_search_ratio
+
+    # 安全兜底 防止传入 possible_search_ratio > 1
     # 防止 buffer 太大导致阈值低于低分中心，这会导致把噪音全放进来
     kmeans_threshold = max(kmeans_threshold, low_center)
 
     filtered_docs = [doc for s, doc in zip(sorted_scores, sorted_docs) if s >= kmeans_threshold]
 
     # 获取低分区的最大边界值
-    low_score_label = sorted_idx[0]
-    low_cluster_subset = sorted_scores[labels == low_score_label]
-    max_low_score = low_cluster_subset[0] if len(low_cluster_subset) > 0 else 0.0
+    max_low_score = sorted_scores[high_count] if high_count < n else 0.0
 
     return {
         "high_ratio": high_ratio,
@@ -614,6 +690,62 @@ def filter_grade_threshold(
     }
 
 
+def _suffix_prefix_overlap(text1: str, text2: str, max_overlap: int = 500, min_overlap: int = 10) -> int:
+    """
+    text1 后缀与 text2 前缀的最长重叠长度（Z 函数，线性时间）
+    用于没有 startIndex/endIndex 的旧切片，重叠检测限制在 max_overlap 字符内
+    """
+    m = min(len(text1), len(text2), max_overlap)
+    if m < min_overlap:
+        return 0
+    # s = text2 前缀 + 分隔 + text1 后缀；位置 i 的 Z 值覆盖到末尾即为一个后缀-前缀匹配
+    s = text2[:m] + "\x00" + text1[-m:]
+    n = len(s)
+    z = [0] * n
+    left = right = 0
+    for i in range(1, n):
+        if i < right:
+            z[i] = min(right - i, z[i - left])
+        while i + z[i] < n and s[z[i]] == s[i + z[i]]:
+            z[i] += 1
+        if i + z[i] > right:
+            left, right = i, i + z[i]
+    # 最靠前的匹配位置即最长重叠（匹配长度 <= m，不会跨过分隔符）
+    for i in range(m + 1, n):
+        if z[i] == n - i:
+            return z[i] if z[i] >= min_overlap else 0
+    return 0
+
+
+def _chunk_overlap(prev_doc: Document, next_doc: Document) -> int:
+    """相邻切片的重叠长度：有全文偏移时直接计算，否则回退到字符串匹配"""
+    prev_end = prev_doc.metadata.get('endIndex')
+    next_start = next_doc.metadata.get('startIndex')
+    if prev_end is not None and next_start is not None:
+        return min(max(prev_end - next_start, 0), len(next_doc.page_content))
+    return _suffix_prefix_overlap(prev_doc.page_content, next_doc.page_content)
+
+
+def _merge_run(run: list[Document], contain_score: bool) -> Document:
+    """合并一段连续切片，只做一次拼接"""
+    head = run[0]
+    head.metadata['last_chunk_index'] = run[-1].metadata.get('chunkIndex')
+    if len(run) == 1:
+        return head
+
+    parts = [head.page_content]
+    for prev_doc, next_doc in zip(run, run[1:]):
+        parts.append(next_doc.page_content[_chunk_overlap(prev_doc, next_doc):])
+    head.page_content = ''.join(parts)
+    if head.metadata.get('startIndex') is not None:
+        head.metadata['endIndex'] = run[-1].metadata.get('endIndex')
+
+    # 更新分数为连续切片中的最大值
+    if contain_score:
+        head.metadata['rerank_score'] = max(doc.metadata.get('rerank_score', 0) for doc in run)
+    return head
+
+
 def merge_consecutive_chunks(
         docs: list[Document],
         contain_score: bool = False
@@ -633,77 +765,25 @@ def merge_consecutive_chunks(
 
     merged_results = []
 
-    # 对每组进行排序和合并
+    # 对每组进行排序，收集连续切片段后一次性合并
     for doc_id, group in docs_by_id.items():
         # 按 chunkIndex 排序
         group.sort(key=lambda x: x.metadata.get('chunkIndex'))
 
-        current_merged_doc = group[0]
-        # 初始化 last_chunk_index
-        current_merged_doc.metadata['last_chunk_index'] = current_merged_doc.metadata.get('chunkIndex')
-
-        for i in range(1, len(group)):
-            next_doc = group[i]
-
-            last_chunk_idx = current_merged_doc.metadata.get('last_chunk_index')
+        run = [group[0]]
+        for next_doc in group[1:]:
+            last_chunk_idx = run[-1].metadata.get('chunkIndex')
             curr_chunk_idx = next_doc.metadata.get('chunkIndex')
 
             if last_chunk_idx is not None and curr_chunk_idx is not None and curr_chunk_idx == last_chunk_idx + 1:
-                # 连续切片，进行合并
-                text1 = current_merged_doc.page_content
-                text2 = next_doc.page_content
-
-                # 尝试去除重叠
-                # 寻找 text1 的后缀与 text2 的前缀的最长匹配
-                overlap_found = False
-                # 限制最大检测长度，提高性能，通常重叠在 100-200 字符
-                max_overlap_check = min(len(text1), len(text2), 500)
-                min_overlap = 10
-
-                if max_overlap_check >= min_overlap:
-                    # 优化算法：使用 find 替代枚举
-                    # 取 text2 的前缀作为种子（长度为 min_overlap）
-                    seed = text2[:min_overlap]
-
-                    # 在 text1 的末尾区域搜索种子
-                    # 搜索范围从 len(text1) - max_overlap_check 开始
-                    start_search = len(text1) - max_overlap_check
-                    search_region = text1[start_search:]
-
-                    # 在区域内查找种子
-                    pos = search_region.find(seed)
-                    while pos != -1:
-                        # 计算在 text1 中的绝对位置
-                        abs_pos = start_search + pos
-                        # 潜在的重叠部分是 text1[abs_pos:]
-                        # 检查 text2 是否以这段文本开头
-                        potential_overlap = text1[abs_pos:]
-                        if text2.startswith(potential_overlap):
-                            current_merged_doc.page_content = text1 + text2[len(potential_overlap):]
-                            overlap_found = True
-                            break
-                        # 继续查找下一个匹配
-                        pos = search_region.find(seed, pos + 1)
-
-                if not overlap_found:
-                    current_merged_doc.page_content = text1 + text2  # 直接拼接
-
-                # 更新元数据
-                current_merged_doc.metadata['last_chunk_index'] = curr_chunk_idx
-                # 更新分数为两者的最大值
-                if contain_score:
-                    current_merged_doc.metadata['rerank_score'] = max(
-                        current_merged_doc.metadata.get('rerank_score', 0),
-                        next_doc.metadata.get('rerank_score', 0)
-                    )
-
+                # 连续切片，加入当前段
+                run.append(next_doc)
             else:
-                # 不连续，保存当前，开始新的
-                merged_results.append(current_merged_doc)
-                current_merged_doc = next_doc
-                current_merged_doc.metadata['last_chunk_index'] = current_merged_doc.metadata.get('chunkIndex')
+                # 不连续，合并当前段，开始新的
+                merged_results.append(_merge_run(run, contain_score))
+                run = [next_doc]
 
-        merged_results.append(current_merged_doc)
+        merged_results.append(_merge_run(run, contain_score))
 
     # 重新按 rerank_score 排序
     if contain_score:
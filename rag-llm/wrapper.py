@@ -1,6 +1,10 @@
 class ResponseWrapper:
-    def __init__(self, content: str | list):
+    def __init__(self, content: str | list, usage: dict | None = None):
         self.content = content
+        # 流式响应结束时由服务商返回的用量：{"prompt_tokens", "completion_tokens", "total_tokens"}
+        self.usage = usage
 
     def __repr__(self):
-        return f"ResponseWrapper(content='{self.content}')"
\ No newline at end of file
+        if self.usage:
+            return f"ResponseWrapper(content='{self.content}', usage={self.usage})"
+        return f"ResponseWrapper(content='{self.content}')"
@@ -41,4 +41,10 @@ public class RabbitConfig {
                 .to(serverInteractLLMExchange)
                 .with("rag.document.process.key");
     }
+
+    // 知识库内容变更广播（删除文档等），rag-llm 的每个 worker 各自绑定临时队列消费，用于使检索缓存失效
+    @Bean
+    public FanoutExchange collectionChangeExchange() {
+        return new FanoutExchange("rag.collection.change.exchange", true, false);
+    }
 }
@@ -361,6 +361,8 @@ public class ChatController {
             }
             options.putAll(userOpts);
         }
+        // 会话级检索状态按 sessionId 复用
+        options.put("sessionId", sessionId);
 
         if (kbId != null && kb != null) {
             options.put("userId", kb.getOwnerUserId());
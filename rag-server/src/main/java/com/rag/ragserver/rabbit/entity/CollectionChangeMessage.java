@@ -0,0 +1,19 @@
+package com.rag.ragserver.rabbit.entity;
+
+import lombok.AllArgsConstructor;
+import lombok.Builder;
+import lombok.Data;
+import lombok.NoArgsConstructor;
+
+import java.io.Serializable;
+
+@Data
+@Builder
+@NoArgsConstructor
+@AllArgsConstructor
+public class CollectionChangeMessage implements Serializable {
+    private Long userId;
+    private Long kbId;
+    // 变更类型：delete
+    private String event;
+}
@@ -8,6 +8,7 @@ import com.rag.ragserver.domain.Documents;
 import com.rag.ragserver.domain.KnowledgeBases;
 import com.rag.ragserver.exception.BusinessException;
 import com.rag.ragserver.mapper.DocumentsMapper;
+import com.rag.ragserver.rabbit.entity.CollectionChangeMessage;
 import com.rag.ragserver.rabbit.entity.DocumentProcessMessage;
 import com.rag.ragserver.service.DocumentsService;
 import com.rag.ragserver.service.KnowledgeBasesService;
@@ -197,6 +198,14 @@ public class DocumentsServiceImpl extends ServiceImpl<DocumentsMapper, Documents
             throw new BusinessException(500, "向量化内容删除失败");
         }
 
+        // 通知 rag-llm 各 worker 递增 collection 版本，使检索缓存与会话缓存失效
+        try {
+            CollectionChangeMessage changeMessage = CollectionChangeMessage.builder().userId(document.getUploaderId()).kbId(document.getKbId()).event("delete").build();
+            rabbitTemplate.convertAndSend("rag.collection.change.exchange", "", changeMessage);
+        } catch (Exception e) {
+            log.warn("Failed to broadcast collection change: docId={}, error={}", docId, e.getMessage());
+        }
+
         this.removeById(docId);
     }
 
@@ -8,6 +8,7 @@ import com.rag.ragserver.service.KbSharesService;
 import com.rag.ragserver.service.KnowledgeBasesService;
 import com.rag.ragserver.mapper.KnowledgeBasesMapper;
 import com.rag.ragserver.mapper.KbSharesMapper;
+import io.milvus.common.clientenum.FunctionType;
 import io.milvus.v2.client.MilvusClientV2;
 import io.milvus.v2.common.DataType;
 import io.milvus.v2.common.IndexParam;
@@ -23,6 +24,7 @@ import org.springframework.stereotype.Service;
 import org.springframework.transaction.annotation.Transactional;
 
 import java.util.ArrayList;
+import java.util.Collections;
 import java.util.List;
 import java.util.Map;
 
@@ -124,6 +126,8 @@ public class KnowledgeBasesServiceImpl extends ServiceImpl<KnowledgeBasesMapper,
                             .fieldName("text")
                             .dataType(DataType.VarChar)
                             .maxLength(6144)
+                            .enableAnalyzer(true)
+                            .enableMatch(true)
                             .build()
             );
             schema.addField(
@@ -166,6 +170,36 @@ public class KnowledgeBasesServiceImpl extends ServiceImpl<KnowledgeBasesMapper,
                             .maxLength(1024)
                             .build()
             );
+            // 切片在原文中的区间（仅全文整体切分的文件类型写入），用于合并相邻切片时按偏移去重
+            schema.addField(
+                    AddFieldReq.builder()
+                            .fieldName("startIndex")
+                            .dataType(DataType.Int64)
+                            .isNullable(true)
+                            .build()
+            );
+            schema.addField(
+                    AddFieldReq.builder()
+                            .fieldName("endIndex")
+                            .dataType(DataType.Int64)
+                            .isNullable(true)
+                            .build()
+            );
+            // BM25 稀疏向量字段，由 Milvus 根据 text 自动生成，用于混合检索
+            schema.addField(
+                    AddFieldReq.builder()
+                            .fieldName("sparse")
+                            .dataType(DataType.SparseFloatVector)
+                            .build()
+            );
+            schema.addFunction(
+                    CreateCollectionReq.Function.builder()
+                            .functionType(FunctionType.BM25)
+                            .name("text_bm25_emb")
+                            .inputFieldNames(Collections.singletonList("text"))
+                            .outputFieldNames(Collections.singletonList("sparse"))
+                            .build()
+            );
             // 创建索引
             List<IndexParam> indexParams = new ArrayList<>();
             indexParams.add(
@@ -175,6 +209,13 @@ public class KnowledgeBasesServiceImpl extends ServiceImpl<KnowledgeBasesMapper,
                             .metricType(IndexParam.MetricType.COSINE)
                             .build()
             );
+            indexParams.add(
+                    IndexParam.builder()
+                            .fieldName("sparse")
+                            .indexType(IndexParam.IndexType.SPARSE_INVERTED_INDEX)
+                            .metricType(IndexParam.MetricType.BM25)
+                            .build()
+            );
             indexParams.add(
                     IndexParam.builder()
                             .fieldName("pk")
@@ -187,6 +228,12 @@ public class KnowledgeBasesServiceImpl extends ServiceImpl<KnowledgeBasesMapper,
                             .indexType(IndexParam.IndexType.STL_SORT)
                             .build()
             );
+            indexParams.add(
+                    IndexParam.builder()
+                            .fieldName("chunkIndex")
+                            .indexType(IndexParam.IndexType.STL_SORT)
+                            .build()
+            );
             indexParams.add(
                     IndexParam.builder()
                             .fieldName("text")